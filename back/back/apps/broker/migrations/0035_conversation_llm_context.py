@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2024-06-24 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("broker", "0034_rename_feedback_userfeedback_feedback_comment_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="llm_context",
+            field=models.JSONField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="referenced_ki_ids",
+            field=models.JSONField(editable=False, null=True),
+        ),
+    ]
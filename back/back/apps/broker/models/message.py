@@ -2,8 +2,9 @@ from logging import getLogger
 from enum import Enum
 
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Q, Value
+from django.db.models.expressions import CombinedExpression
 from django.contrib.postgres.fields import ArrayField
 from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
 
@@ -46,6 +47,10 @@ class Conversation(ChangesMixin):
 
     platform_conversation_id = models.CharField(max_length=255, unique=True)
     name = models.CharField(max_length=255, null=True, blank=True)
+    # LLM context kept up to date as the messages are saved, so the LLM requests read this row instead of the whole
+    # message chain. Both are null until the first LLM request of the conversation builds them from the chain.
+    llm_context = models.JSONField(null=True, editable=False)
+    referenced_ki_ids = models.JSONField(null=True, editable=False)
 
     def get_first_msg(self):
         return Message.objects.filter(
@@ -61,6 +66,47 @@ class Conversation(ChangesMixin):
         msg_ids = chain.values_list('id', flat=True)
         return KnowledgeItem.objects.prefetch_related('knowledgeitemimage_set').filter(messageknowledgeitem__message_id__in=msg_ids).distinct().order_by("updated_date")
 
+    def get_llm_context(self):
+        """
+        Returns the messages of the conversation in the LLM format and the ids of the knowledge items referenced by them.
+        """
+        if self.llm_context is None or self.referenced_ki_ids is None:
+            with transaction.atomic():
+                # the rows locked so the messages saved meanwhile are appended after the context is built
+                conv = Conversation.objects.select_for_update().get(pk=self.pk)
+                if conv.llm_context is None:
+                    conv.llm_context = [
+                        entry for entry in (msg.to_llm_context() for msg in self.get_msgs_chain()) if entry
+                    ]
+                if conv.referenced_ki_ids is None:
+                    conv.referenced_ki_ids = list(dict.fromkeys(self.get_kis().values_list("id", flat=True)))
+                Conversation.objects.filter(pk=self.pk).update(
+                    llm_context=conv.llm_context, referenced_ki_ids=conv.referenced_ki_ids
+                )
+            self.llm_context, self.referenced_ki_ids = conv.llm_context, conv.referenced_ki_ids
+        return self.llm_context, self.referenced_ki_ids
+
+    def append_llm_context(self, entry):
+        """
+        Appends a message to the LLM context if it was already built.
+        """
+        Conversation.objects.filter(pk=self.pk, llm_context__isnull=False).update(
+            llm_context=CombinedExpression(F("llm_context"), "||", Value([entry], output_field=models.JSONField()))
+        )
+
+    def add_referenced_kis(self, ki_ids):
+        """
+        Adds the knowledge items referenced by a message to the LLM context.
+        """
+        _, referenced_ki_ids = self.get_llm_context()
+        new_ids = [ki_id for ki_id in dict.fromkeys(ki_ids) if ki_id not in referenced_ki_ids]
+        if not new_ids:
+            return
+        Conversation.objects.filter(pk=self.pk, referenced_ki_ids__isnull=False).update(
+            referenced_ki_ids=CombinedExpression(F("referenced_ki_ids"), "||", Value(new_ids, output_field=models.JSONField()))
+        )
+        self.referenced_ki_ids = referenced_ki_ids + new_ids
+
     def get_last_msg(self):
         return (
             Message.objects.filter(conversation=self).order_by("-created_date").first()
@@ -296,10 +342,38 @@ class Message(ChangesMixin):
 
         return f"{send_time} {sender['type']}: {stack_text}"
 
+    def to_llm_context(self):
+        """
+        Returns the message in the LLM format, None if it has no text for the LLM.
+        """
+        text = ""
+        if self.sender["type"] == AgentType.human.value:
+            role = "user"
+            for stack in self.stack or []:
+                if stack["type"] == StackPayloadType.text.value:
+                    text += stack["payload"]
+                else:
+                    logger.warning(f"Stack type {stack['type']} for sender {self.sender['type']} is not supported for LLM contextualization.")
+        elif self.sender["type"] == AgentType.bot.value:
+            role = "assistant"
+            for stack in self.stack or []:
+                if stack["type"] == StackPayloadType.lm_generated_text.value:
+                    text += stack['payload']['model_response']
+                else:
+                    logger.warning(f"Stack type {stack['type']} for sender {self.sender['type']} is not supported for LLM contextualization.")
+        if not text:
+            return None
+        return {"role": role, "content": text}
+
     def save(self, *args, **kwargs):
         if not self.prev: # avoid setting prev to itself if model is being updated
             self.prev = self.conversation.get_last_msg()
+        adding = self._state.adding
         super(Message, self).save(*args, **kwargs)
+        if adding:
+            entry = self.to_llm_context()
+            if entry:
+                self.conversation.append_llm_context(entry)
 
 
 class UserFeedback(ChangesMixin):
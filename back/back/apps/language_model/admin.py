@@ -9,6 +9,7 @@ from .models.data import (
     KnowledgeBase,
     KnowledgeItem,
     Embedding,
+    EmbeddingCache,
     AutoGeneratedTitle,
     Intent,
     MessageKnowledgeItem,
@@ -154,6 +155,7 @@ admin.site.register(PromptConfig, PromptConfigAdmin)
 admin.site.register(GenerationConfig)
 admin.site.register(RetrieverConfig)
 admin.site.register(Embedding)
+admin.site.register(EmbeddingCache)
 admin.site.register(DataSource, DataSourceAdmin)
 admin.site.register(Intent, IntentAdmin)
 admin.site.register(MessageKnowledgeItem, MessageKnowledgeItemAdmin)
@@ -1,7 +1,9 @@
+import os
 import json
 import uuid
 
 from logging import getLogger
+from django.core.cache import cache
 from django.forms.models import model_to_dict
 
 from channels.db import database_sync_to_async
@@ -10,64 +12,54 @@ from django.contrib.auth.models import AnonymousUser
 from ray.serve import get_deployment_handle
 
 from back.apps.broker.consumers.message_types import RPCMessageType
-from back.apps.broker.models.message import Conversation, StackPayloadType, AgentType, Message
+from back.apps.broker.models.message import Conversation
 from back.apps.broker.serializers.rpc import RPCLLMRequestSerializer
-from back.apps.language_model.models import RAGConfig, KnowledgeItem, MessageKnowledgeItem
+from back.apps.language_model.models import RAGConfig, KnowledgeItem, KnowledgeItemImage, MessageKnowledgeItem
 from back.utils import WSStatusCodes
 from back.utils.custom_channels import CustomAsyncConsumer
 
 logger = getLogger(__name__)
 
+# Per conversation cache of the resolved knowledge items, 0 disables it. It is kept short because the knowledge items
+# can be edited and the image urls of the private storages expire
+REFERENCES_CACHE_TTL_S = int(os.environ.get('REFERENCES_CACHE_TTL_S', 300))
+
 
 def format_msgs_chain_to_llm_context(msgs_chain):
-    messages = []
-    for msg in msgs_chain:
-        if msg.sender["type"] == AgentType.human.value:
-            text = ""
-            for stack in msg.stack:
-                if stack["type"] == StackPayloadType.text.value:
-                    text += stack["payload"]
-                else:
-                    logger.warning(f"Stack type {stack['type']} for sender {msg['sender']['type']} is not supported for LLM contextualization.")
-
-            if text:
-                messages.append({"role": "user", "content": text})
-        elif msg.sender["type"] == AgentType.bot.value:
-            text = ""
-            for stack in msg.stack:
-                if stack["type"] == StackPayloadType.lm_generated_text.value:
-                    text += stack['payload']['model_response']
-                else:
-                    logger.warning(f"Stack type {stack['type']} for sender {msg.sender['type']} is not supported for LLM contextualization.")
-            if text:
-                messages.append({"role": "assistant", "content": text})
-
-    return messages
+    return [entry for entry in (msg.to_llm_context() for msg in msgs_chain) if entry]
 
 
-async def resolve_references(reference_kis, conv, rag_conf, relate_kis_to_msgs=False):
-    # ColBERT only returns the k item id, similarity and content, so we need to get the full k item fields
-    # We also adapt the pgvector retriever to match colbert's output
-    prev_kis = await database_sync_to_async(conv.get_kis)()
+def _resolve_references(reference_kis, conv, relate_kis_to_msgs):
+    cache_key = f"conversation_references_{conv.pk}"
+    resolved = (cache.get(cache_key) or {}) if REFERENCES_CACHE_TTL_S else {}
+
+    # a single query for the new knowledge items and another one for their images
+    missing_ids = {ki["k_item_id"] for ki in reference_kis} - resolved.keys()
+    if missing_ids:
+        kis = KnowledgeItem.objects.prefetch_related("knowledgeitemimage_set").in_bulk(missing_ids)
+        resolved.update({pk: ki.to_retrieve_context() for pk, ki in kis.items()})
+        if REFERENCES_CACHE_TTL_S:
+            cache.set(cache_key, resolved, REFERENCES_CACHE_TTL_S)
 
-    for index, ki in enumerate(reference_kis):
-        ki_item = await database_sync_to_async(KnowledgeItem.objects.prefetch_related('knowledgeitemimage_set').get)(pk=ki['k_item_id'])
-        reference_kis[index] = {
-            **ki_item.to_retrieve_context(),
-            "similarity": ki["similarity"],
-        }
+    # the knowledge items deleted since the indexing are skipped
+    reference_kis = [
+        {**resolved[ki["k_item_id"]], "similarity": ki["similarity"]}
+        for ki in reference_kis
+        if ki["k_item_id"] in resolved
+    ]
 
     logger.info(f"References:\n{reference_kis}")
     # All images of the conversation so far
     reference_ki_images = {}
     for reference_ki in reference_kis:
-        reference_ki_images = {**reference_ki_images, **reference_ki["image_urls"]}
-    for ki in await database_sync_to_async(list)(prev_kis):
-        for ki_img in await database_sync_to_async(ki.knowledgeitemimage_set.all)():
-            reference_ki_images[ki_img.image_file.name] = ki_img.image_file.url
+        reference_ki_images.update(reference_ki["image_urls"])
+    _, referenced_ki_ids = conv.get_llm_context()
+    prev_ki_images = KnowledgeItemImage.objects.filter(knowledge_item_id__in=referenced_ki_ids)
+    for ki_img in prev_ki_images:
+        reference_ki_images[ki_img.image_file.name] = ki_img.image_file.url
 
     if relate_kis_to_msgs:  # Only when the generated text based on a human message then we will associate the generated text with it
-        last_human_mml = await database_sync_to_async(conv.get_last_human_mml)()
+        last_human_mml = conv.get_last_human_mml()
         msgs2kis = [
             MessageKnowledgeItem(
                 message=last_human_mml,
@@ -76,7 +68,18 @@ async def resolve_references(reference_kis, conv, rag_conf, relate_kis_to_msgs=F
             )
             for ki in reference_kis
         ]
-        await database_sync_to_async(MessageKnowledgeItem.objects.bulk_create)(msgs2kis)
+        MessageKnowledgeItem.objects.bulk_create(msgs2kis)
+        conv.add_referenced_kis([ki["knowledge_item_id"] for ki in reference_kis])
+
+    return reference_kis, reference_ki_images
+
+
+async def resolve_references(reference_kis, conv, rag_conf, relate_kis_to_msgs=False):
+    # ColBERT only returns the k item id, similarity and content, so we need to get the full k item fields
+    # We also adapt the pgvector retriever to match colbert's output
+    reference_kis, reference_ki_images = await database_sync_to_async(_resolve_references)(
+        reference_kis, conv, relate_kis_to_msgs
+    )
 
     return {
         "knowledge_base_id": rag_conf.knowledge_base.pk,
@@ -85,6 +88,12 @@ async def resolve_references(reference_kis, conv, rag_conf, relate_kis_to_msgs=F
     }
 
 
+def get_prev_contents(referenced_ki_ids):
+    return list(
+        KnowledgeItem.objects.filter(pk__in=referenced_ki_ids).order_by("updated_date").values_list("content", flat=True)
+    )
+
+
 async def query_ray(rag_config_name, conversation_id, input_text=None, use_conversation_context=True, only_context=False, streaming=True):
     """
     # for debuggin purposes send 100 messages waiting 0.1 seconds between each one
@@ -108,22 +117,30 @@ async def query_ray(rag_config_name, conversation_id, input_text=None, use_conve
     g_conf.pop("id")
 
     conv = await database_sync_to_async(Conversation.objects.get)(pk=conversation_id)
-    prev_kis = await database_sync_to_async(conv.get_kis)()
+    # materialized context of the conversation, a single row instead of the whole message chain
+    llm_context, referenced_ki_ids = await database_sync_to_async(conv.get_llm_context)()
 
-    messages = ""
+    messages = []
     if use_conversation_context:
-        messages = format_msgs_chain_to_llm_context(await database_sync_to_async(list)(conv.get_msgs_chain()))
+        messages = list(llm_context)
     if input_text:
         messages.append({"role": "user", "content": input_text})
 
     references = None
 
     try:
-        if streaming:
+        if only_context:
+            # retrieval only, the orchestrator skips the LLM and answers with the context at retriever latency
+            handle = get_deployment_handle('rag_orchestrator', app_name=rag_conf.get_deploy_name())
+            ray_res = await handle.retrieve.remote(messages, p_conf)
+            references = await resolve_references((ray_res.get("context") or [[]])[0], conv, rag_conf, relate_kis_to_msgs=not input_text)
+            yield {"model_response": "", "references": references, "final": True}
+            return
+        elif streaming:
             handle = get_deployment_handle('rag_orchestrator', app_name=rag_conf.get_deploy_name()).options(stream=True)
             response = handle.remote(
                 messages,
-                await database_sync_to_async(list)(prev_kis.values_list("content", flat=True)),
+                await database_sync_to_async(get_prev_contents)(referenced_ki_ids),
                 p_conf,
                 g_conf,
                 only_context
@@ -139,7 +156,17 @@ async def query_ray(rag_config_name, conversation_id, input_text=None, use_conve
 
                 yield {"model_response": ray_res.get("res", ""), "references": references, "final": False}
         else:
-            pass  # TODO: implement non-streaming version
+            # a single payload with the whole response
+            handle = get_deployment_handle('rag_orchestrator', app_name=rag_conf.get_deploy_name())
+            ray_res = await handle.generate.remote(
+                messages,
+                await database_sync_to_async(get_prev_contents)(referenced_ki_ids),
+                p_conf,
+                g_conf,
+            )
+            references = await resolve_references((ray_res.get("context") or [[]])[0], conv, rag_conf, relate_kis_to_msgs=not input_text)
+            yield {"model_response": ray_res.get("res", ""), "references": references, "final": True}
+            return
     except Exception as e:
         logger.error("Error during RAG query", exc_info=e)
         # return _send_message(bot_channel_name, lm_msg_id, channel_layer, chanel_name, msg='There was an error generating the response. Please try again or contact the administrator.')
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from back.apps.language_model.models import RAGConfig, Embedding
+
+
+# ./manage.py benchmark_vector_index my_rag_config --queries 200 --top-k 5
+
+class Command(BaseCommand):
+    help = "Reports recall@k and latency percentiles of the ANN vector index of a RAG config against the exact scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument("rag_config_name", type=str)
+        parser.add_argument("--queries", type=int, default=100, help="Number of sampled queries")
+        parser.add_argument("--top-k", type=int, default=5, help="Number of results per query")
+        parser.add_argument("--noise", type=float, default=0.05, help="Gaussian noise added to the sampled embeddings so the queries are not exact matches")
+
+    def time_queries(self, rag_config, queries, top_k, exact):
+        results, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            items = rag_config.retrieve_kitems(query, threshold=-np.inf, top_k=top_k, exact=exact)
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append([item["k_item_id"] for item in items])
+        return results, np.array(latencies)
+
+    def report(self, name, latencies):
+        self.stdout.write(
+            f"{name}: p50 {np.percentile(latencies, 50):.2f} ms | p99 {np.percentile(latencies, 99):.2f} ms | "
+            f"mean {latencies.mean():.2f} ms"
+        )
+
+    def handle(self, *args, **options):
+        rag_config = RAGConfig.objects.filter(name=options["rag_config_name"]).first()
+        if rag_config is None:
+            raise CommandError(f"RAG config {options['rag_config_name']} does not exist")
+
+        top_k = options["top_k"]
+        sampled = Embedding.objects.filter(rag_config=rag_config, embedding__isnull=False).order_by("?")
+        sampled = list(sampled.values_list("embedding", flat=True)[: options["queries"]])
+        if not sampled:
+            raise CommandError(f"RAG config {rag_config.name} has no embeddings, is it an E5 retriever?")
+
+        rng = np.random.default_rng(42)
+        queries = []
+        for embedding in sampled:
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query + rng.normal(0, options["noise"], query.shape).astype(np.float32)
+            queries.append(query / np.linalg.norm(query))
+
+        self.stdout.write(
+            f"RAG config: {rag_config.name} | index: {rag_config.retriever_config.get_vector_index().label} | "
+            f"embeddings: {Embedding.objects.filter(rag_config=rag_config).count()} | queries: {len(queries)} | k: {top_k}"
+        )
+        self.stdout.write(f"Existing ANN indexes: {', '.join(rag_config.get_vector_index_names()) or 'none'}")
+
+        # warm up the caches so the first queries of each mode are not penalized
+        self.time_queries(rag_config, queries[:5], top_k, exact=True)
+        self.time_queries(rag_config, queries[:5], top_k, exact=False)
+
+        exact_results, exact_latencies = self.time_queries(rag_config, queries, top_k, exact=True)
+        ann_results, ann_latencies = self.time_queries(rag_config, queries, top_k, exact=False)
+
+        recalls = [
+            len(set(exact) & set(ann)) / len(exact)
+            for exact, ann in zip(exact_results, ann_results)
+            if exact
+        ]
+
+        self.report("Exact scan", exact_latencies)
+        self.report("ANN index ", ann_latencies)
+        self.stdout.write(self.style.SUCCESS(f"Recall@{top_k}: {np.mean(recalls):.4f}"))
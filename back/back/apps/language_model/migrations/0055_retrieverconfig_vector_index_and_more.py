@@ -0,0 +1,51 @@
+# Generated by Django 4.1.13 on 2024-06-03 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0054_alter_datasource_splitter_alter_raytaskstate_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="vector_index",
+            field=models.CharField(
+                choices=[
+                    ("none", "Exact Search"),
+                    ("hnsw", "HNSW"),
+                    ("ivfflat", "IVFFlat"),
+                ],
+                default="hnsw",
+                max_length=10,
+            ),
+        ),
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="hnsw_m",
+            field=models.IntegerField(default=16),
+        ),
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="hnsw_ef_construction",
+            field=models.IntegerField(default=64),
+        ),
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="hnsw_ef_search",
+            field=models.IntegerField(default=40),
+        ),
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="ivfflat_lists",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="ivfflat_probes",
+            field=models.IntegerField(default=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-05 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0055_retrieverconfig_vector_index_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="in_process_search",
+            field=models.BooleanField(default=False),
+        ),
+    ]
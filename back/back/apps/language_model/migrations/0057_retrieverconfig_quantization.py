@@ -0,0 +1,27 @@
+# Generated by Django 4.1.13 on 2024-06-06 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0056_retrieverconfig_in_process_search"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="quantization",
+            field=models.CharField(
+                choices=[
+                    ("none", "None"),
+                    ("float16", "Float16"),
+                    ("int8", "Int8"),
+                    ("binary", "Binary"),
+                ],
+                default="none",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-07 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0057_retrieverconfig_quantization"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="raytaskstate",
+            name="progress",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
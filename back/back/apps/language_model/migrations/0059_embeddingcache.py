@@ -0,0 +1,40 @@
+# Generated by Django 4.1.13 on 2024-06-10 11:05
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0058_raytaskstate_progress"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingCache",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_date", models.DateTimeField(auto_now_add=True)),
+                ("updated_date", models.DateTimeField(auto_now=True)),
+                ("model_name", models.CharField(max_length=255)),
+                ("content_hash", models.CharField(max_length=64)),
+                ("embedding", pgvector.django.VectorField(editable=False)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="embeddingcache",
+            constraint=models.UniqueConstraint(
+                fields=("model_name", "content_hash"),
+                name="unique_embedding_cache_entry",
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.13 on 2024-06-11 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0059_embeddingcache"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retrieverconfig",
+            name="inference_backend",
+            field=models.CharField(
+                choices=[
+                    ("torch", "PyTorch"),
+                    ("torch_int8", "PyTorch Int8"),
+                    ("onnx", "ONNX Runtime"),
+                    ("onnx_int8", "ONNX Runtime Int8"),
+                ],
+                default="torch",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-12 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0060_retrieverconfig_inference_backend"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ragconfig",
+            name="index_version",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
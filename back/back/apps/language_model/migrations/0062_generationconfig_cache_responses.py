@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-13 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0061_ragconfig_index_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationconfig",
+            name="cache_responses",
+            field=models.BooleanField(default=False),
+        ),
+    ]
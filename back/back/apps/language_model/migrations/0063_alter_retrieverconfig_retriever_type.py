@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2024-06-14 08:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0062_generationconfig_cache_responses"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="retrieverconfig",
+            name="retriever_type",
+            field=models.CharField(
+                choices=[
+                    ("colbert", "ColBERT Search"),
+                    ("e5", "Standard Semantic Search"),
+                    ("hybrid", "Hybrid Search (BM25 + Semantic)"),
+                ],
+                default="colbert",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-17 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0063_alter_retrieverconfig_retriever_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ragconfig",
+            name="index_segments",
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2024-06-19 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0064_ragconfig_index_segments"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ragconfig",
+            name="deploy_version",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
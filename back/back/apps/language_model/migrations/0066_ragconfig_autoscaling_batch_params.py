@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2024-06-20 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0065_ragconfig_deploy_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ragconfig",
+            name="autoscaling",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="ragconfig",
+            name="min_replicas",
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name="ragconfig",
+            name="max_replicas",
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name="ragconfig",
+            name="target_ongoing_requests",
+            field=models.FloatField(default=2.0),
+        ),
+        migrations.AddField(
+            model_name="ragconfig",
+            name="retriever_max_batch_size",
+            field=models.IntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name="ragconfig",
+            name="retriever_batch_wait_timeout_s",
+            field=models.FloatField(default=0.2),
+        ),
+    ]
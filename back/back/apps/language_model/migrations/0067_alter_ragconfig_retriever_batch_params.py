@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2024-06-21 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0066_ragconfig_autoscaling_batch_params"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="ragconfig",
+            name="retriever_max_batch_size",
+            field=models.IntegerField(default=32),
+        ),
+        migrations.AlterField(
+            model_name="ragconfig",
+            name="retriever_batch_wait_timeout_s",
+            field=models.FloatField(default=0.05),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.13 on 2024-06-24 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("language_model", "0067_alter_ragconfig_retriever_batch_params"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="embeddingcache",
+            name="last_used",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -3,9 +3,12 @@ from io import StringIO
 from logging import getLogger
 from uuid import uuid4
 import base64
+import hashlib
 import os
+from datetime import timedelta
 
 from django.db import models
+from django.utils import timezone
 from django.apps import apps
 from django.core.files.base import ContentFile
 
@@ -28,6 +31,9 @@ from back.config.storage_backends import select_private_storage
 
 logger = getLogger(__name__)
 
+# The EmbeddingCache entries not used by any index task for this long are deleted at the end of the next one
+EMBEDDING_CACHE_TTL_DAYS = int(os.environ.get('EMBEDDING_CACHE_TTL_DAYS', 30))
+
 
 class KnowledgeBase(ChangesMixin):
     """
@@ -396,6 +402,71 @@ class Embedding(ChangesMixin):
         return f"Embedding for {self.knowledge_item}"
 
 
+class EmbeddingCache(ChangesMixin):
+    """
+    Content addressed cache of the embeddings, so unchanged contents are not encoded again when their
+    KnowledgeItem is modified or recreated.
+    model_name: str
+        The embedding model used.
+    content_hash: str
+        The sha256 of the prefix and the content that were encoded.
+    embedding: VectorField
+        The embedding of the content.
+    last_used: DateTimeField
+        When an index task last stored or reused the embedding, the entries unused for a while are pruned.
+    """
+
+    model_name = models.CharField(max_length=255)
+    content_hash = models.CharField(max_length=64)
+    embedding = VectorField(editable=False)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["model_name", "content_hash"], name="unique_embedding_cache_entry"),
+        ]
+
+    def __str__(self):
+        return f"{self.model_name} embedding {self.content_hash}"
+
+    @staticmethod
+    def hash_content(content, prefix=""):
+        return hashlib.sha256(f"{prefix}{content}".encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_embeddings(cls, model_name, content_hashes):
+        """
+        Returns a dict from content hash to embedding with the cached ones, and marks them as used.
+        """
+        cached = dict(
+            cls.objects.filter(model_name=model_name, content_hash__in=set(content_hashes))
+            .values_list("content_hash", "embedding")
+        )
+        if cached:
+            cls.objects.filter(model_name=model_name, content_hash__in=list(cached)).update(last_used=timezone.now())
+        return cached
+
+    @classmethod
+    def store(cls, model_name, content_hashes, embeddings, batch_size=256):
+        cls.objects.bulk_create(
+            [
+                cls(model_name=model_name, content_hash=content_hash, embedding=embedding)
+                for content_hash, embedding in zip(content_hashes, embeddings)
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True,  # the same content may be cached concurrently by another index task
+        )
+
+    @classmethod
+    def prune(cls, ttl_days=EMBEDDING_CACHE_TTL_DAYS):
+        """
+        Deletes the entries that no index task used in the last ttl_days, like the contents that were removed
+        from the knowledge bases or the ones of models no longer used. Returns the number of deleted entries.
+        """
+        deleted, _ = cls.objects.filter(last_used__lt=timezone.now() - timedelta(days=ttl_days)).delete()
+        return deleted
+
+
 class AutoGeneratedTitle(ChangesMixin):
     """
     An utterance is a synonym of an item.
@@ -16,6 +16,27 @@ class DeviceChoices(models.TextChoices):
 class RetrieverTypeChoices(models.TextChoices):
     COLBERT = "colbert", _("ColBERT Search")
     E5 = "e5", _("Standard Semantic Search")
+    HYBRID = "hybrid", _("Hybrid Search (BM25 + Semantic)")
+
+
+class VectorIndexChoices(models.TextChoices):
+    NONE = "none", _("Exact Search")
+    HNSW = "hnsw", _("HNSW")
+    IVFFLAT = "ivfflat", _("IVFFlat")
+
+
+class QuantizationChoices(models.TextChoices):
+    NONE = "none", _("None")
+    FLOAT16 = "float16", _("Float16")
+    INT8 = "int8", _("Int8")
+    BINARY = "binary", _("Binary")
+
+
+class InferenceBackendChoices(models.TextChoices):
+    TORCH = "torch", _("PyTorch")
+    TORCH_INT8 = "torch_int8", _("PyTorch Int8")
+    ONNX = "onnx", _("ONNX Runtime")
+    ONNX_INT8 = "onnx_int8", _("ONNX Runtime Int8")
 
 
 class LLMChoices(models.TextChoices):
@@ -1,15 +1,18 @@
 import os
 import uuid
+import base64
+from datetime import timedelta
 from urllib.parse import urljoin
 
-from django.db import models, transaction
+import numpy as np
+from django.db import models, transaction, connection
+from django.utils import timezone
 from django.conf import settings
-from pgvector.django import MaxInnerProduct
 
 from simple_history.models import HistoricalRecords
 
-from back.apps.language_model.models.enums import IndexStatusChoices, DeviceChoices, RetrieverTypeChoices, LLMChoices
-from back.apps.language_model.models.data import KnowledgeBase, KnowledgeItem
+from back.apps.language_model.models.enums import IndexStatusChoices, DeviceChoices, RetrieverTypeChoices, LLMChoices, VectorIndexChoices, QuantizationChoices, InferenceBackendChoices
+from back.apps.language_model.models.data import KnowledgeBase, KnowledgeItem, Embedding
 from back.common.models import ChangesMixin
 
 from back.apps.language_model.tasks import index_task
@@ -19,6 +22,9 @@ from logging import getLogger
 
 logger = getLogger(__name__)
 
+# The embeddings sync cursor is moved back this much, so the rows saved by transactions that committed after a sync
+# read them, with an earlier updated_date, are fetched on the next sync
+EMBEDDINGS_SYNC_OVERLAP_S = int(os.environ.get('EMBEDDINGS_SYNC_OVERLAP_S', 120))
 
 # First, define the Manager subclass.
 class EnabledRAGConfigManager(models.Manager):
@@ -43,6 +49,14 @@ class RAGConfig(ChangesMixin):
     enabled = models.BooleanField(default=True)
     s3_index_path = models.CharField(max_length=255, blank=True, null=True, editable=False)
     num_replicas = models.IntegerField(default=1)
+    # Ray Serve autoscaling of the orchestrator and retriever deployments, num_replicas is used when disabled
+    autoscaling = models.BooleanField(default=False)
+    min_replicas = models.IntegerField(default=1)
+    max_replicas = models.IntegerField(default=1)
+    target_ongoing_requests = models.FloatField(default=2.0)
+    # upper bounds of the adaptive batching of the retriever deployment, the replicas pick up changes without a redeploy
+    retriever_max_batch_size = models.IntegerField(default=32)
+    retriever_batch_wait_timeout_s = models.FloatField(default=0.05)
 
     index_status = models.CharField(
         max_length=20,
@@ -50,6 +64,12 @@ class RAGConfig(ChangesMixin):
         default=IndexStatusChoices.NO_INDEX,
         editable=False
     )
+    # incremented whenever the index status, path or segments change, the RAG deployments clear their retrieval cache on change
+    index_version = models.IntegerField(default=0, editable=False)
+    # delta segments of a ColBERT index on top of the base index at s3_index_path, compacted into a new base periodically
+    index_segments = models.JSONField(default=list, blank=True, editable=False)
+    # version of the Ray Serve application that serves the RAG, bumped when a new version takes over the traffic
+    deploy_version = models.IntegerField(default=0, editable=False)
 
     def generate_s3_index_path(self):
         unique_id = str(uuid.uuid4())[:8]
@@ -58,8 +78,44 @@ class RAGConfig(ChangesMixin):
     def get_index_status(self):
         return IndexStatusChoices(self.index_status)
 
-    def get_deploy_name(self):
-        return f'rag_{self.name}'
+    def get_deploy_name(self, version=None):
+        """
+        Returns the name of the Ray Serve application of a version of the RAG, by default the one serving the traffic.
+        The version 0 is the application deployed before the versioning, named without a version.
+        """
+        version = self.deploy_version if version is None else version
+        return self.format_deploy_name(self.name, version)
+
+    @staticmethod
+    def format_deploy_name(rag_name, version):
+        return f'rag_{rag_name}_v{version}' if version > 0 else f'rag_{rag_name}'
+
+    def get_autoscaling_config(self):
+        """
+        Returns the Ray Serve autoscaling config of the deployments of the RAG, None if autoscaling is disabled.
+        """
+        if not self.autoscaling:
+            return None
+        return {
+            "min_replicas": self.min_replicas,
+            "initial_replicas": max(self.min_replicas, min(self.num_replicas, self.max_replicas)),
+            "max_replicas": max(self.min_replicas, self.max_replicas),
+            "target_ongoing_requests": self.target_ongoing_requests,
+        }
+
+    def get_batch_params(self):
+        return {
+            "max_batch_size": self.retriever_max_batch_size,
+            "batch_wait_timeout_s": self.retriever_batch_wait_timeout_s,
+        }
+
+    @staticmethod
+    def is_deploy_name(rag_name, app_name):
+        """
+        Whether a Ray Serve application is any version of the RAG with this name.
+        """
+        prefix = f'rag_{rag_name}_v'
+        return app_name == RAGConfig.format_deploy_name(rag_name, 0) or (app_name.startswith(prefix) and app_name[len(prefix):].isdigit())
 
     def __str__(self):
         return self.name if self.name is not None else f"{self.llm_config.name} - {self.knowledge_base.name}"
@@ -79,12 +135,21 @@ class RAGConfig(ChangesMixin):
             if not old.enabled and self.enabled: # If the config was disabled and now is enabled
                 redeploy_rag = True
                 logger.info(f"RAG config {self.name} {'enabled' if self.enabled else 'disabled'} changed llm config...")
+            if self.get_autoscaling_config() != old.get_autoscaling_config() or \
+                    (not self.autoscaling and self.num_replicas != old.num_replicas):
+                redeploy_rag = True
+                logger.info(f"RAG config {self.name} changed replicas or autoscaling...")
             if self.knowledge_base != old.knowledge_base:
                 self.index_status = IndexStatusChoices.NO_INDEX
                 logger.info(f"RAG config {self.name} changed knowledge base. Index needs to be updated...")
             if self.retriever_config.model_name != old.retriever_config.model_name or self.retriever_config.get_retriever_type() != old.retriever_config.get_retriever_type():
                 self.index_status = IndexStatusChoices.NO_INDEX
                 logger.info(f"RAG config {self.name} changed retriever model. Index needs to be updated...")
+            if self.index_status != old.index_status or self.s3_index_path != old.s3_index_path \
+                    or self.index_segments != old.index_segments:
+                self.index_version = old.index_version + 1
+            # only launch_rag_deployment switches the version, a stale instance must not point back to a deleted one
+            self.deploy_version = old.deploy_version
 
         super().save(*args, **kwargs)
 
@@ -111,7 +176,85 @@ class RAGConfig(ChangesMixin):
         else:
             logger.info(f"RAG {self.name} is not enabled or index is not up to date, skipping deploy")
 
-    def retrieve_kitems(self, query_embedding, threshold, top_k):
+    def get_vector_index_prefix(self):
+        return f"lm_emb_ann_{self.pk}_"
+
+    def get_vector_index_names(self):
+        """
+        Returns the names of the ANN indexes that currently exist for this RAG config.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = %s",
+                [Embedding._meta.db_table],
+            )
+            index_names = [row[0] for row in cursor.fetchall()]
+        # LIKE would treat the underscores of the prefix as wildcards, so we filter here
+        return [name for name in index_names if name.startswith(self.get_vector_index_prefix())]
+
+    def drop_vector_index(self, keep: str = None, concurrently: bool = True):
+        """
+        Drops the ANN indexes of this RAG config, except the one named `keep` if given.
+        Concurrent drops cannot run inside a transaction.
+        """
+        for index_name in self.get_vector_index_names():
+            if index_name == keep:
+                continue
+            logger.info(f"Dropping vector index {index_name}")
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP INDEX {"CONCURRENTLY " if concurrently else ""}IF EXISTS "{index_name}"')
+
+    def build_vector_index(self):
+        """
+        Creates the approximate nearest neighbour index over the embeddings of this RAG config.
+        The index is partial (only the rows of this RAG config) and built over the embedding cast to its dimensions,
+        because pgvector can only index vectors of a fixed size and the embedding column is shared by all the RAG configs.
+        If an index with the same parameters already exists it is kept, as pgvector maintains it on inserts.
+        """
+        vector_index = self.retriever_config.get_vector_index()
+        if vector_index == VectorIndexChoices.NONE:
+            self.drop_vector_index()
+            return
+
+        table = Embedding._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT vector_dims(embedding), COUNT(*) OVER () FROM {table} "
+                f"WHERE rag_config_id = %s AND embedding IS NOT NULL LIMIT 1",
+                [self.pk],
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            logger.info(f"No embeddings for RAG config {self.name}, skipping vector index creation")
+            self.drop_vector_index()
+            return
+
+        dims, n_rows = row
+        if vector_index == VectorIndexChoices.HNSW:
+            params = (self.retriever_config.hnsw_m, self.retriever_config.hnsw_ef_construction)
+            options = "m = %d, ef_construction = %d" % params
+        else:
+            params = (self.retriever_config.get_ivfflat_lists(n_rows),)
+            options = "lists = %d" % params
+
+        index_name = f"{self.get_vector_index_prefix()}{vector_index.value}_{dims}_{'_'.join(map(str, params))}"
+        self.drop_vector_index(keep=index_name)
+
+        if index_name in self.get_vector_index_names():
+            logger.info(f"Vector index {index_name} already up to date")
+            return
+
+        logger.info(f"Building vector index {index_name} over {n_rows} embeddings")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index_name}" ON {table} '
+                f"USING {vector_index.value} ((embedding::vector({dims})) vector_ip_ops) "
+                f"WITH ({options}) WHERE rag_config_id = {int(self.pk)}"
+            )
+        logger.info(f"Vector index {index_name} built")
+
+    def retrieve_kitems(self, query_embedding, threshold, top_k, exact=False):
         """
         Returns the context for the given query_embedding.
         Parameters
@@ -122,31 +265,145 @@ class RAGConfig(ChangesMixin):
             Threshold for filtering the context.
         top_k : int
             Number of context to be returned. If -1, all context are returned.
-        rag_config : RAGConfig
-            RAGConfig to be used for filtering the KnowledgeItems.
+        exact : bool
+            Whether to force an exact (sequential) scan instead of using the ANN index, by default False.
         """
-        items_for_query = (
-                KnowledgeItem.objects.filter(embedding__rag_config=self)
-                .annotate(
-                    similarity=-MaxInnerProduct("embedding__embedding", query_embedding)
-                )
-                .filter(similarity__gt=threshold)
-                .order_by("-similarity")
-            )
-
-        if top_k != -1:
-            items_for_query = items_for_query[:top_k]
+        return self.retrieve_kitems_batch([query_embedding], threshold, top_k, exact=exact)[0]
 
-        query_results = [
-            {
-                "k_item_id": item.id,
-                "content": item.content,
-                "similarity": item.similarity,
-            }
-            for item in items_for_query
+    def retrieve_kitems_batch(self, query_embeddings, threshold, top_k, exact=False):
+        """
+        Returns the context for each one of the given query_embeddings in a single database round-trip.
+        The queries are unnested and each one is joined laterally with its own top_k search, so every query
+        can still use the ANN index.
+        Parameters
+        ----------
+        query_embeddings : torch.Tensor, np.ndarray or list
+            Query embeddings to be used for retrieval, one per row.
+        threshold : float
+            Threshold for filtering the context.
+        top_k : int
+            Number of context to be returned per query. If -1, all context are returned.
+        exact : bool
+            Whether to force an exact (sequential) scan instead of using the ANN index, by default False.
+        Returns
+        -------
+        List[List[dict]]
+            The ranked contexts of each query, in the same order as the queries.
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if query_embeddings.ndim == 1:
+            query_embeddings = query_embeddings[None, :]
+        if len(query_embeddings) == 0:
+            return []
+
+        use_index = (
+            not exact
+            and top_k != -1
+            and self.retriever_config.get_vector_index() != VectorIndexChoices.NONE
+        )
+        # The expression must match the one of the partial index for the planner to use it
+        embedding = f"e.embedding::vector({query_embeddings.shape[1]})" if use_index else "e.embedding"
+
+        sql = f"""
+            SELECT q.ord, r.knowledge_item_id, r.content, r.distance
+            FROM unnest(%s::vector[]) WITH ORDINALITY AS q(embedding, ord)
+            CROSS JOIN LATERAL (
+                SELECT e.knowledge_item_id, ki.content, {embedding} <#> q.embedding AS distance
+                FROM {Embedding._meta.db_table} e
+                JOIN {KnowledgeItem._meta.db_table} ki ON ki.id = e.knowledge_item_id
+                WHERE e.rag_config_id = %s AND {embedding} <#> q.embedding < %s
+                ORDER BY {embedding} <#> q.embedding
+                LIMIT %s
+            ) r
+            ORDER BY q.ord, r.distance
+        """
+        params = [
+            ["[" + ",".join(map(str, query.tolist())) + "]" for query in query_embeddings],
+            self.pk,
+            -threshold,
+            top_k if top_k != -1 else None,  # LIMIT NULL means no limit
         ]
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if exact:
+                    cursor.execute("SET LOCAL enable_indexscan = off")
+                elif use_index:
+                    self.retriever_config.set_vector_search_params(cursor, top_k)
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+
+        query_results = [[] for _ in range(len(query_embeddings))]
+        for query_ndx, k_item_id, content, distance in rows:
+            query_results[query_ndx - 1].append(
+                {
+                    "k_item_id": k_item_id,
+                    "content": content,
+                    "similarity": -distance,
+                }
+            )
         return query_results
 
+    def export_embeddings(self, since=None, after_id=0, limit=10000, ids_only=False):
+        """
+        Exports a page of the embeddings of this RAG config so retriever replicas can hold them in memory.
+        The embeddings are sent as a base64 encoded float32 buffer to avoid serializing the vectors as JSON floats.
+        Parameters
+        ----------
+        since : datetime, optional
+            Only return the embeddings created or updated after this moment, for incremental refreshes.
+            The `timestamp` of the response is the one to use on the next refresh, it overlaps with this one
+            by EMBEDDINGS_SYNC_OVERLAP_S so the late commits are not skipped, the repeated rows are upserted again.
+        after_id : int
+            Return the embeddings with an id greater than this one, for pagination.
+        limit : int
+            Maximum number of embeddings to return.
+        ids_only : bool
+            Only return the knowledge item ids of all the current embeddings, for detecting deletions.
+        """
+        limit = max(limit, 0)
+        timestamp = timezone.now() - timedelta(seconds=EMBEDDINGS_SYNC_OVERLAP_S)
+        embeddings = Embedding.objects.filter(rag_config=self, embedding__isnull=False)
+
+        if ids_only:
+            return {
+                "timestamp": timestamp.isoformat(),
+                "k_item_ids": list(embeddings.values_list("knowledge_item_id", flat=True)),
+            }
+
+        stats = embeddings.aggregate(
+            count=models.Count("id"),
+            last_update=models.Max("updated_date"),
+            ids_sum=models.Sum("knowledge_item_id"),
+            ids_sum_squares=models.Sum(models.F("knowledge_item_id") * models.F("knowledge_item_id")),
+        )
+        count = stats["count"]
+        # the replicas compare it with their ids to detect deletions, also when a deletion and an insert keep the count
+        ids_checksum = [count, int(stats["ids_sum"] or 0), int(stats["ids_sum_squares"] or 0)]
+        # identifies the current set of embeddings, so replicas can reuse an on disk copy of the same version
+        version = f"{count}_{stats['last_update'].timestamp() if stats['last_update'] else 0:.6f}"
+        if since is not None:
+            embeddings = embeddings.filter(updated_date__gt=since)
+
+        rows = list(
+            embeddings.filter(id__gt=after_id)
+            .order_by("id")
+            .values_list("id", "knowledge_item_id", "knowledge_item__content", "embedding")[:limit]
+        )
+        matrix = np.asarray([row[3] for row in rows], dtype=np.float32)
+
+        return {
+            "timestamp": timestamp.isoformat(),
+            "count": count,
+            "ids_checksum": ids_checksum,
+            "version": version,
+            "last_id": rows[-1][0] if rows else after_id,
+            "k_item_ids": [row[1] for row in rows],
+            "contents": [row[2] for row in rows],
+            "dim": matrix.shape[1] if rows else 0,
+            "embeddings": base64.b64encode(matrix.tobytes()).decode("ascii"),
+        }
+
 
 class RetrieverConfig(ChangesMixin):
     """
@@ -161,6 +418,24 @@ class RetrieverConfig(ChangesMixin):
         The batch size to use for the retriever.
     device: str
         The device to use for the retriever.
+    vector_index: str
+        The approximate nearest neighbour index to use for the E5 retriever embeddings.
+    hnsw_m: int
+        Max number of connections per layer of the HNSW graph.
+    hnsw_ef_construction: int
+        Size of the candidate list when building the HNSW graph.
+    hnsw_ef_search: int
+        Size of the candidate list when querying the HNSW graph, higher means better recall but slower queries.
+    ivfflat_lists: int
+        Number of IVFFlat lists, if 0 it is computed from the number of embeddings.
+    ivfflat_probes: int
+        Number of IVFFlat lists to visit when querying, higher means better recall but slower queries.
+    in_process_search: bool
+        Whether the E5 retriever replicas keep the embeddings in memory and score the queries locally instead of querying the backend.
+    quantization: str
+        The quantization of the in process search embeddings, the candidates are rescored with the full precision embeddings.
+    inference_backend: str
+        The inference backend of the E5 retriever and reranker models on CPU, the ONNX models are exported on first load and cached on disk.
     """
 
     name = models.CharField(max_length=255, unique=True)
@@ -168,6 +443,15 @@ class RetrieverConfig(ChangesMixin):
     retriever_type = models.CharField(max_length=10, choices=RetrieverTypeChoices.choices, default=RetrieverTypeChoices.COLBERT)
     batch_size = models.IntegerField(default=1) # batch size 1 for better default cpu generation
     device = models.CharField(max_length=10, choices=DeviceChoices.choices, default=DeviceChoices.CPU)
+    vector_index = models.CharField(max_length=10, choices=VectorIndexChoices.choices, default=VectorIndexChoices.HNSW)
+    hnsw_m = models.IntegerField(default=16)
+    hnsw_ef_construction = models.IntegerField(default=64)
+    hnsw_ef_search = models.IntegerField(default=40)
+    ivfflat_lists = models.IntegerField(default=0)
+    ivfflat_probes = models.IntegerField(default=10)
+    in_process_search = models.BooleanField(default=False)
+    quantization = models.CharField(max_length=10, choices=QuantizationChoices.choices, default=QuantizationChoices.NONE)
+    inference_backend = models.CharField(max_length=10, choices=InferenceBackendChoices.choices, default=InferenceBackendChoices.TORCH)
 
     def __str__(self):
         return self.name
@@ -178,6 +462,37 @@ class RetrieverConfig(ChangesMixin):
     def get_device(self):
         return DeviceChoices(self.device)
 
+    def get_vector_index(self):
+        return VectorIndexChoices(self.vector_index)
+
+    def get_quantization(self):
+        quantization = QuantizationChoices(self.quantization)
+        return None if quantization == QuantizationChoices.NONE else quantization.value
+
+    def get_inference_backend(self):
+        return InferenceBackendChoices(self.inference_backend)
+
+    def get_vector_index_build_params(self):
+        return self.get_vector_index(), self.hnsw_m, self.hnsw_ef_construction, self.ivfflat_lists
+
+    def get_ivfflat_lists(self, n_rows):
+        if self.ivfflat_lists > 0:
+            return self.ivfflat_lists
+        # pgvector recommendation: rows / 1000 up to 1M rows and sqrt(rows) after that
+        if n_rows <= 1_000_000:
+            return max(n_rows // 1000, 10)
+        return int(n_rows ** 0.5)
+
+    def set_vector_search_params(self, cursor, top_k):
+        """
+        Sets the query time parameters of the ANN index for the current transaction.
+        """
+        if self.get_vector_index() == VectorIndexChoices.HNSW:
+            # HNSW cannot return more results than its candidate list
+            cursor.execute("SET LOCAL hnsw.ef_search = %s", [max(self.hnsw_ef_search, top_k)])
+        elif self.get_vector_index() == VectorIndexChoices.IVFFLAT:
+            cursor.execute("SET LOCAL ivfflat.probes = %s", [self.ivfflat_probes])
+
     # When saving we want to check if the model_name has changed and in that case regenerate all the embeddings for the
     # knowledge bases that uses this retriever.
     def save(self, *args, **kwargs):
@@ -192,9 +507,17 @@ class RetrieverConfig(ChangesMixin):
                 for rag_config in rag_configs:
                     rag_config.index_status = IndexStatusChoices.NO_INDEX
                     rag_config.save()
+            elif self.get_vector_index_build_params() != old_retriever.get_vector_index_build_params():
+                # The ANN index is rebuilt on the next reindex
+                rag_configs = RAGConfig.objects.filter(retriever_config=self, index_status=IndexStatusChoices.UP_TO_DATE)
+                for rag_config in rag_configs:
+                    rag_config.index_status = IndexStatusChoices.OUTDATED
+                    rag_config.save()
 
-            if self.get_device() != old_retriever.get_device():
-                # if the device has changed we need to redeploy all the RAGs that use this retriever
+            if self.get_device() != old_retriever.get_device() or self.in_process_search != old_retriever.in_process_search \
+                    or self.get_quantization() != old_retriever.get_quantization() \
+                    or self.get_inference_backend() != old_retriever.get_inference_backend():
+                # if the device or the search options have changed we need to redeploy all the RAGs that use this retriever
                 rags_to_redeploy = RAGConfig.objects.filter(retriever_config=self)
 
 
@@ -202,7 +525,7 @@ class RetrieverConfig(ChangesMixin):
 
         if rags_to_redeploy:
             def on_commit_callback():
-                logger.info('Retriever device changed, launching rag redeploys')
+                logger.info('Retriever deployment options changed, launching rag redeploys')
                 for rag in rags_to_redeploy:
                     if rag.enabled:
                         task_name = f"launch_rag_deployment_{rag.name}"
@@ -333,6 +656,8 @@ class GenerationConfig(ChangesMixin):
         The seed for the sampling, by default 42
     max_new_tokens : int, optional
         The maximum number of new tokens to generate, by default 256
+    cache_responses : bool, optional
+        Whether to cache and replay the responses, only applied when the temperature is 0, by default False
     model : Model
         The model this generation configuration belongs to.
     """
@@ -343,6 +668,7 @@ class GenerationConfig(ChangesMixin):
     repetition_penalty = models.FloatField(default=1.0)
     seed = models.IntegerField(default=42)
     max_new_tokens = models.IntegerField(default=512)
+    cache_responses = models.BooleanField(default=False)
 
     def __str__(self):
         return self.name
@@ -49,6 +49,7 @@ class RayTaskState(models.Model):
     task_log_info = models.JSONField(blank=True, null=True)
     error_message = models.CharField(max_length=255, blank=True, null=True)
     is_debugger_paused = models.BooleanField(blank=True, null=True)
+    progress = models.FloatField(blank=True, null=True)  # from 0 to 1, for the tasks that report it
 
     @classmethod
     def get_all_ray_and_parse_tasks_serialized(cls):
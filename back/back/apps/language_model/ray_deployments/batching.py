@@ -0,0 +1,70 @@
+import os
+import asyncio
+from urllib.parse import urljoin
+
+
+# How often the replicas check the batch params of the RAG config, they are tuned from the admin API under load
+BATCH_PARAMS_REFRESH_INTERVAL_S = 10
+# The adaptive batching dispatches right away when the replica is idle and grows the batches under load up to the
+# batch params of the RAG config, when disabled it waits for full batches like serve.batch
+ADAPTIVE_BATCHING = os.environ.get('RETRIEVER_ADAPTIVE_BATCHING', 'true').lower() == 'true'
+# Target p99 latency of the retriever calls for the adaptive batching
+BATCHING_P99_TARGET_S = float(os.environ.get('RETRIEVER_P99_TARGET_S', 0.5))
+
+
+class BatchingMixin:
+    """
+    Batching of the retriever deployments: the calls are grouped by an AdaptiveBatcher for the `batch_handler` of the
+    deployment, within the batch params of the RAG config, which a background task of the replica keeps in sync.
+    The deployment must set `self.http` (a PooledSession) and `self.token` before calling `init_batching`.
+    """
+
+    def init_batching(self, rag_config_id=None, batch_params=None):
+        """
+        Creates the batcher and, if there is a RAG config, starts polling its batch params.
+        It must be called from __init__, which Ray Serve runs in the event loop of the replica.
+        """
+        from chat_rag.inf_retrieval.adaptive_batcher import AdaptiveBatcher
+
+        self.batcher = AdaptiveBatcher(self.batch_handler, p99_target_s=BATCHING_P99_TARGET_S, adaptive=ADAPTIVE_BATCHING)
+        self.batch_params = None
+        if batch_params is not None:
+            self.update_batch_params(**batch_params)
+        self.batch_params_task = None
+        if rag_config_id is not None:
+            self.batch_params_endpoint = urljoin(os.environ.get('BACKEND_HOST', ''), f"/back/api/language-model/rag-configs/{rag_config_id}/batch-params/")
+            self.batch_params_task = asyncio.get_running_loop().create_task(self.poll_batch_params())
+
+    def update_batch_params(self, max_batch_size, batch_wait_timeout_s):
+        self.batcher.update_params(max_batch_size, batch_wait_timeout_s)
+        self.batch_params = {'max_batch_size': max_batch_size, 'batch_wait_timeout_s': batch_wait_timeout_s}
+
+    async def refresh_batch_params(self):
+        try:
+            headers = {'Authorization': f'Token {self.token}'}
+            async with self.http.get().get(self.batch_params_endpoint, headers=headers) as response:
+                batch_params = await response.json()
+            if batch_params != self.batch_params:
+                self.update_batch_params(**batch_params)
+                print(f"Batch params updated to {batch_params}")
+        except Exception as e:
+            # keep batching with the params we have
+            print(f"Error refreshing the batch params: {e}")
+
+    async def poll_batch_params(self):
+        """
+        Background task of the replica that keeps the batch params in sync with the RAG config,
+        so the requests never wait for the backend.
+        """
+        while True:
+            await asyncio.sleep(BATCH_PARAMS_REFRESH_INTERVAL_S)
+            await self.refresh_batch_params()
+
+    def batching_stats(self):
+        return self.batcher.stats()
+
+    async def __del__(self):
+        # called by Ray Serve on the shutdown of the replica
+        if self.batch_params_task is not None:
+            self.batch_params_task.cancel()
+        await self.http.close()
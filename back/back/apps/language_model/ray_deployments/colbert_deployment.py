@@ -1,12 +1,96 @@
-from typing import List
+from typing import Dict, List
 import os
+import json
+import time
+import asyncio
+from contextlib import ExitStack
+from urllib.parse import urljoin
 import ray
 from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 from ray import serve
 from django.conf import settings
 
 
-from back.apps.language_model.tasks import read_s3_index
+from back.apps.language_model.tasks import read_s3_index, read_index_segment, use_cached_index
+from .batching import BatchingMixin
+
+# How often the replicas check for new delta segments of the index
+INDEX_SEGMENTS_REFRESH_INTERVAL_S = 30
+# Max time the replicas wait for the backend when loading the segments on startup
+INDEX_SEGMENTS_STARTUP_TIMEOUT_S = 10
+# Local directory where the replicas download the delta segments
+INDEX_SEGMENTS_DIR = os.environ.get('COLBERT_INDEX_SEGMENTS_DIR', '/tmp/chatfaq/colbert_segments')
+
+
+# Max number of extra base passages requested to make up for the ones of deleted or updated k items, the reindex
+# compacts the segments into a new base index before the hidden passages grow much larger than this
+MAX_HIDDEN_BASE_PASSAGES_OVERFETCH = int(os.environ.get('COLBERT_MAX_HIDDEN_OVERFETCH', 256))
+
+
+class InMemoryEncodings:
+    """
+    Adapter over the in memory encodings of the ragatouille ColBERT model, the ones `encode` fills and
+    `search_encoded_docs` searches, where the delta segments are loaded. They are private attributes of ragatouille,
+    so this is the only code that touches them and it checks on startup that the installed version still has them.
+    """
+
+    # attributes read by ColBERT.search_encoded_docs
+    ATTRIBUTES = ("in_memory_collection", "in_memory_embed_docs", "doc_masks", "in_memory_metadata")
+
+    def __init__(self, retriever):
+        self.retriever = retriever
+        self.model = retriever.model
+        self.check()
+
+    def check(self):
+        import inspect
+
+        missing = [name for name in ("inference_ckpt", "search_encoded_docs") if not hasattr(self.model, name)]
+        if not missing:
+            source = inspect.getsource(type(self.model).search_encoded_docs)
+            missing = [name for name in self.ATTRIBUTES if name not in source]
+        if missing:
+            raise RuntimeError(
+                f"The installed ragatouille version does not support loading the index segments, missing: {missing}. "
+                f"Install the version pinned by chat_rag."
+            )
+
+    @property
+    def device(self):
+        return next(self.model.inference_ckpt.parameters()).device
+
+    @property
+    def query_maxlen(self) -> int:
+        return self.model.inference_ckpt.query_tokenizer.query_maxlen
+
+    def load(self, embed_docs, doc_masks, n_passages: int):
+        """
+        Replaces the in memory encodings, the passages are not kept by ragatouille but by the caller.
+        """
+        self.model.in_memory_embed_docs = embed_docs
+        self.model.doc_masks = doc_masks
+        self.model.in_memory_collection = ['' for _ in range(n_passages)]
+        self.model.in_memory_metadata = None
+        # the documents are already encoded, so their max length must not be recomputed
+        self.model.inference_ckpt_len_set = True
+
+    def search(self, queries: List[str], k: int):
+        queries_results = self.retriever.search_encoded_docs(queries, k=k)
+        return [queries_results] if len(queries) == 1 else queries_results
+
+
+def index_owners(base_k_item_ids, segments) -> Dict[int, int]:
+    """
+    Returns the segment that holds the current version of every indexed k item, 0 for the base index and
+    1..n for the delta segments. Each segment deletes its deleted (and modified) k items from the previous ones.
+    """
+    owners = {k_item_id: 0 for k_item_id in base_k_item_ids}
+    for ndx, segment in enumerate(segments, start=1):
+        for k_item_id in segment["deleted_k_item_ids"]:
+            owners.pop(k_item_id, None)
+        for k_item_id in segment["k_item_ids"]:
+            owners[k_item_id] = ndx
+    return owners
 
 
 @serve.deployment(
@@ -18,12 +102,15 @@ from back.apps.language_model.tasks import read_s3_index
         },
     },
 )
-class ColBERTDeployment:
+class ColBERTDeployment(BatchingMixin):
     """
     ColBERTDeployment class for serving the a ColBERT retriever in a Ray Serve deployment in a Ray cluster.
+    The base PLAID index is immutable, the small updates of the index are delta segments of in memory encodings
+    that the replicas load without a restart. The results of the base and the segments are merged, skipping the
+    k items whose current version is in a later segment.
     """
 
-    def __init__(self, index_path, storages_mode):
+    def __init__(self, index_path, storages_mode, rag_config_id=None, segments_path=None, batch_params=None):
         from chat_rag.inf_retrieval.reference_checker import clean_relevant_references
         from ragatouille import RAGPretrainedModel
 
@@ -32,42 +119,164 @@ class ColBERTDeployment:
 
         print(f"Initializing ColBERTDeployment with index_path={index_path} and storages_mode={storages_mode}")
 
-        if 's3://' in index_path:
-            # Schedule the reading of the index on the same node as the deployment
-            node_id = ray.get_runtime_context().get_node_id()
-            print(f"Node ID: {node_id}")
-            node_scheduling_strategy = NodeAffinitySchedulingStrategy(
-                node_id=node_id, soft=False
+        with ExitStack() as cached_index:
+            if 's3://' in index_path:
+                # Schedule the reading of the index on the same node as the deployment
+                node_id = ray.get_runtime_context().get_node_id()
+                print(f"Node ID: {node_id}")
+                node_scheduling_strategy = NodeAffinitySchedulingStrategy(
+                    node_id=node_id, soft=False
+                )
+                index_path_ref = read_s3_index.options(scheduling_strategy=node_scheduling_strategy).remote(index_path, storages_mode)
+                ray.get(index_path_ref)
+                # the index stays locked in the node cache until it is loaded
+                index_path = cached_index.enter_context(use_cached_index(index_path))
+                print(f"Downloaded index from S3 to {index_path}")
+            else:
+                index_root, index_name = os.path.split(index_path)
+                index_path = os.path.join(index_root, 'colbert', 'indexes', index_name)
+                print(f'Reading index locally from {index_path}')
+
+            print('#'*50)
+            print(index_path)
+            print('#'*50)
+
+            self.retriever = RAGPretrainedModel.from_index(index_path)
+            self.encodings = InMemoryEncodings(self.retriever)
+
+            # Test query for loading the searcher for the first time
+            self.retriever.search("test query", k=1)
+
+        self.storages_mode = storages_mode
+        self.segments_path = segments_path
+        self.base_name = os.path.basename(index_path)
+        self.pid_docid_map = {int(pid): int(docid) for pid, docid in self.retriever.model.pid_docid_map.items()}
+        self.base_k_item_ids = set(self.pid_docid_map.values())
+        self.segments, self.segment_passages = [], []
+        self.owners = {k_item_id: 0 for k_item_id in self.base_k_item_ids}
+        self.n_hidden_base_passages = 0
+
+        from chat_rag.http_pool import PooledSession
+
+        # keep-alive connections to the backend shared by the polls of the replica
+        self.http = PooledSession()
+        self.token = os.environ.get('BACKEND_TOKEN')
+        self.segments_endpoint = None
+        self.segments_checked_at = time.monotonic()
+        if rag_config_id is not None and segments_path is not None:
+            self.segments_endpoint = urljoin(os.environ.get('BACKEND_HOST', ''), f"/back/api/language-model/rag-configs/{rag_config_id}/index-segments/")
+            import requests
+            headers = {'Authorization': f'Token {self.token}'}
+            try:
+                response = requests.get(self.segments_endpoint, headers=headers, timeout=INDEX_SEGMENTS_STARTUP_TIMEOUT_S)
+                response.raise_for_status()
+                self.apply_index_segments(response.json())
+            except Exception as e:
+                # start from the base index, the first poll of the segments retries
+                print(f"Error loading the index segments, starting without them: {e}")
+                self.segments_checked_at = time.monotonic() - INDEX_SEGMENTS_REFRESH_INTERVAL_S
+
+        self.init_batching(rag_config_id, batch_params)
+
+        print(f"ColBERTDeployment initialized with index_path={index_path} and {len(self.segments)} delta segments")
+
+    def apply_index_segments(self, data):
+        """
+        Loads the delta segments of the index if they changed, the already downloaded ones are reused.
+        """
+        if os.path.basename(data['s3_index_path'] or '') != self.base_name:
+            # the index was compacted into a new base, the deployment is relaunched with it
+            return
+        if data['index_segments'] == self.segments:
+            return
+        self.load_segments(data['index_segments'])
+
+    def load_segments(self, segments):
+        import torch
+        import torch.nn.functional as F
+
+        device = self.encodings.device
+
+        embed_docs, doc_masks, segment_passages = [], [], []
+        for ndx, segment in enumerate(segments, start=1):
+            if not segment['k_item_ids']:  # only deletions
+                continue
+            local_path = read_index_segment(
+                os.path.join(self.segments_path, segment['name']),
+                self.storages_mode,
+                os.path.join(INDEX_SEGMENTS_DIR, self.base_name, segment['name']),
+            )
+            encodings = torch.load(os.path.join(local_path, 'encodings.pt'), map_location=device)
+            with open(os.path.join(local_path, 'passages.json')) as f:
+                passages = json.load(f)
+            embed_docs.append(encodings['embed_docs'])
+            doc_masks.append(encodings['doc_masks'])
+            segment_passages.extend(
+                (k_item_id, passage, ndx) for k_item_id, passage in zip(passages['k_item_ids'], passages['passages'])
             )
-            index_path_ref = read_s3_index.options(scheduling_strategy=node_scheduling_strategy).remote(index_path, storages_mode)
-            index_path = ray.get(index_path_ref)
-            print(f"Downloaded index from S3 to {index_path}")
-        else:
-            index_root, index_name = os.path.split(index_path)
-            index_path = os.path.join(index_root, 'colbert', 'indexes', index_name)
-            print(f'Reading index locally from {index_path}')
 
-        print('#'*50)
-        print(index_path)
-        print('#'*50)
+        if embed_docs:
+            # the segments are padded to different lengths
+            max_length = max(embeddings.shape[1] for embeddings in embed_docs)
 
-        import time
-        time.sleep(2)
+            def pad(tensor):
+                return F.pad(tensor, [0, 0] * (tensor.dim() - 2) + [0, max_length - tensor.shape[1]])
 
-        self.retriever = RAGPretrainedModel.from_index(index_path)
+            self.encodings.load(
+                torch.cat([pad(embeddings) for embeddings in embed_docs]),
+                torch.cat([pad(masks) for masks in doc_masks]),
+                len(segment_passages),  # the passages are kept in segment_passages
+            )
+
+        owners = index_owners(self.base_k_item_ids, segments)
+        self.n_hidden_base_passages = sum(1 for docid in self.pid_docid_map.values() if owners.get(docid) != 0)
+        self.segment_passages, self.owners, self.segments = segment_passages, owners, segments
+        print(f"Loaded {len(segments)} delta segments with {len(segment_passages)} passages")
+
+    async def maybe_refresh_segments(self):
+        if self.segments_endpoint is None or time.monotonic() - self.segments_checked_at < INDEX_SEGMENTS_REFRESH_INTERVAL_S:
+            return
+
+        self.segments_checked_at = time.monotonic()
+        try:
+            headers = {'Authorization': f'Token {self.token}'}
+            async with self.http.get().get(self.segments_endpoint, headers=headers) as response:
+                data = await response.json()
+            await asyncio.to_thread(self.apply_index_segments, data)
+        except Exception as e:
+            # keep serving with the segments we have
+            print(f"Error refreshing the index segments: {e}")
+
+    def search_segments(self, queries: List[str], k: int):
+        """
+        Searches the in memory encodings of the delta segments, only the current versions of the k items are returned.
+        """
+        if not self.segment_passages:
+            return [[] for _ in queries]
 
-        # Test query for loading the searcher for the first time
-        self.retriever.search("test query", k=1)
-        print(f"ColBERTDeployment initialized with index_path={index_path}")
+        queries_results = self.encodings.search(queries, k=min(k, len(self.segment_passages)))
+        query_maxlen = self.encodings.query_maxlen
+
+        results = []
+        for query_results in queries_results:
+            segment_results = []
+            for result in query_results:
+                k_item_id, passage, ndx = self.segment_passages[result["result_index"]]
+                if self.owners.get(k_item_id) == ndx:
+                    segment_results.append({"k_item_id": k_item_id, "score": result["score"] / query_maxlen, "content": passage})
+            results.append(segment_results)
+        return results
 
-    @serve.batch(max_batch_size=5, batch_wait_timeout_s=0.2)
     async def batch_handler(self, queries: List[str], top_ks: List[int]):
         """
-        Batch handler for the retriever model. This method is called by Ray Serve when a batch of requests is received.
-        It creates the query embeddings, sends them to a pgvector backend endpoint for retrieval asynchronously and returns the results.
+        Batch handler for the retriever model. This method is called by the batcher of the replica when a batch of requests is ready.
+        It searches the base index and the delta segments and returns the merged results.
         """
+        await self.maybe_refresh_segments()
 
-        queries_results = self.retriever.search(queries, k=max(top_ks))
+        # the base passages of deleted or updated k items are skipped, so more are requested, up to a bound
+        overfetch = min(self.n_hidden_base_passages, MAX_HIDDEN_BASE_PASSAGES_OVERFETCH)
+        queries_results = self.retriever.search(queries, k=max(top_ks) + overfetch)
 
         # For normalizing the scores
         query_maxlen = self.retriever.model.model_index.searcher.config.query_maxlen
@@ -75,10 +284,16 @@ class ColBERTDeployment:
         # If only one query was passed, the result is not a list
         queries_results = [queries_results] if len(queries) == 1 else queries_results
 
+        segments_results = self.search_segments(queries, max(top_ks))
+
         results = []
-        for query_results, top_k in zip(queries_results, top_ks):
-            for result in query_results:
-                result["score"] = result["score"] / query_maxlen
+        for query_results, segment_results, top_k in zip(queries_results, segments_results, top_ks):
+            query_results = [
+                {"k_item_id": int(result["document_id"]), "score": result["score"] / query_maxlen, "content": result["content"]}
+                for result in query_results
+                if self.owners.get(int(result["document_id"])) == 0
+            ]
+            query_results = sorted(query_results + segment_results, key=lambda result: result["score"], reverse=True)
 
             # Filter out results not relevant to the query
             query_results = self.clean_relevant_references(query_results)
@@ -86,7 +301,7 @@ class ColBERTDeployment:
             # only keep k_item_id, content and similarity
             query_results = [
                 {
-                    "k_item_id": int(result["document_id"]),
+                    "k_item_id": result["k_item_id"],
                     "similarity": result["score"],
                     "content": result["content"],
                 }
@@ -97,12 +312,8 @@ class ColBERTDeployment:
 
         return results
 
-    def update_batch_params(self, max_batch_size, batch_wait_timeout_s):
-        self.batch_handler.set_max_batch_size(max_batch_size)
-        self.batch_handler.set_batch_wait_timeout_s(batch_wait_timeout_s)
-
     async def __call__(self, query: str, top_k: int):
-        return await self.batch_handler(query, top_k)
+        return await self.batcher.submit(query, top_k)
 
 
 def construct_index_path(index_path: str):
@@ -117,15 +328,26 @@ def construct_index_path(index_path: str):
         return f"s3://{bucket_name}/{index_path}"
 
 
-def launch_colbert(retriever_deploy_name, index_path):
+def construct_segments_path(index_path: str):
+    """
+    Construct the path of the delta segments of an index, next to the index files.
+    """
+    return construct_index_path(f"{index_path}_segments")
+
+
+def launch_colbert(retriever_deploy_name, index_path, rag_config_id=None, batch_params=None, autoscaling_config=None):
     print(f"Launching ColBERT deployment with name: {retriever_deploy_name} and index_path: {index_path}")
 
     storages_mode = settings.STORAGES_MODE
 
+    segments_path = construct_segments_path(index_path)
     index_path = construct_index_path(index_path)
     print(f"Index path: {index_path}")
+    options = {'name': retriever_deploy_name}
+    if autoscaling_config is not None:
+        options['autoscaling_config'] = autoscaling_config
     retriever_handle = ColBERTDeployment.options(
-        name=retriever_deploy_name,
-    ).bind(index_path, storages_mode)
+        **options,
+    ).bind(index_path, storages_mode, rag_config_id, segments_path, batch_params)
     print(f"Launched ColBERT deployment with name: {retriever_deploy_name}")
     return retriever_handle
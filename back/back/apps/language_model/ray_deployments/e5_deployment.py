@@ -1,10 +1,24 @@
 import os
+import time
+import base64
 import asyncio
-from typing import List
-from aiohttp import ClientSession
+from typing import List, Optional
 from ray import serve
 from urllib.parse import urljoin
 
+from .batching import BatchingMixin
+
+
+VECTOR_STORE_REFRESH_INTERVAL_S = 30
+# Node local directory where the in process search embeddings are persisted, so the replicas of a node memory-map
+# the same files and share their pages instead of each one holding a copy
+VECTOR_STORE_DIR = os.environ.get('E5_VECTOR_STORE_DIR', '/tmp/chatfaq/e5_vector_stores')
+# Smoothing constant of the reciprocal rank fusion of the dense and BM25 results of hybrid retrievers
+HYBRID_RRF_K = int(os.environ.get('HYBRID_RRF_K', 60))
+# Regex of the query tokens of hybrid retrievers that are matched exactly and kept on top, unset uses the default
+# code-like pattern of the BM25 retriever and an empty value disables the exact matches
+HYBRID_IDENTIFIER_PATTERN = os.environ.get('HYBRID_IDENTIFIER_PATTERN')
+
 
 @serve.deployment(
     name="retriever_deployment",
@@ -15,80 +29,265 @@ from urllib.parse import urljoin
             }
         }
 )
-class E5Deployment:
+class E5Deployment(BatchingMixin):
     """
     Ray Serve Deployment class for serving the embedding and reranker retriever models in a Ray cluster.
     """
 
-    def __init__(self, model_name, use_cpu, rag_config_id, lang='en'):
+    def __init__(self, model_name, use_cpu, rag_config_id, lang='en', in_process_search=False, quantization=None, backend='torch', hybrid=False, batch_params=None):
         from chat_rag.inf_retrieval.embedding_models import E5Model
         from chat_rag.inf_retrieval.cross_encoder import ReRanker
 
         hf_key = os.environ.get('HUGGINGFACE_API_KEY')
         self.token = os.environ.get('BACKEND_TOKEN')
         self.retrieve_endpoint = urljoin(os.environ.get('BACKEND_HOST'), f"/back/api/language-model/rag-configs/{rag_config_id}/retrieve/")
+        self.embeddings_endpoint = urljoin(os.environ.get('BACKEND_HOST'), f"/back/api/language-model/rag-configs/{rag_config_id}/embeddings/")
+        from chat_rag.http_pool import PooledSession
+
+        # keep-alive connections to the backend shared by the batches and the polls of the replica
+        self.http = PooledSession()
+        self.init_batching(rag_config_id, batch_params)
+
+        self.model = E5Model(model_name=model_name, use_cpu=use_cpu, huggingface_key=hf_key, backend=backend)
+        self.reranker = ReRanker(lang=lang, device='cpu' if use_cpu else 'cuda', backend=backend)
+
+        self.vector_store = None
+        self.hybrid_retriever = None
+        self.quantization = quantization
+        self.vector_store_dir = os.path.join(VECTOR_STORE_DIR, f"rag_{rag_config_id}")
+        # the sparse index of the hybrid search is built over the contents of the in process vector store
+        if in_process_search or hybrid:
+            self.load_vector_store()
+        if hybrid:
+            from chat_rag.inf_retrieval.retrievers import HybridRetriever
+            hybrid_kwargs = {}
+            if HYBRID_IDENTIFIER_PATTERN is not None:
+                hybrid_kwargs['identifier_pattern'] = HYBRID_IDENTIFIER_PATTERN or None
+            self.hybrid_retriever = HybridRetriever(self.vector_store, rrf_k=HYBRID_RRF_K, **hybrid_kwargs)
+
+        print(f"RetrieverDeployment initialized with model_name={model_name}, use_cpu={use_cpu}, in_process_search={in_process_search}, quantization={quantization}, backend={backend}, hybrid={hybrid}")
+
+    def load_vector_store(self):
+        """
+        Loads all the embeddings of the RAG config to score the queries locally.
+        The embeddings are persisted in a node local directory per version and memory-mapped from there,
+        the first replica of a node that finds no copy of the current version fetches and writes it.
+        """
+        import json
+        import shutil
+        import requests
+        from chat_rag.inf_retrieval.retrievers import SemanticRetriever
+
+        headers = {'Authorization': f'Token {self.token}'}
+        version = requests.get(self.embeddings_endpoint, params={'limit': 0}, headers=headers).json()['version']
+        path = os.path.join(self.vector_store_dir, version)
+
+        if not os.path.exists(path):
+            self.vector_store = SemanticRetriever()
+            self.vector_store_timestamp = None
+            self.sync_vector_store()
+
+            if self.vector_store.len_data:
+                # the fetched pages were appended as delta rows
+                self.vector_store.compact()
+                # quantize once at the end instead of after every fetched page
+                self.vector_store.quantization = self.quantization
+                if self.quantization is not None:
+                    self.vector_store._quantize()
+
+                tmp_path = f"{path}.tmp{os.getpid()}"
+                self.vector_store.save(tmp_path)
+                with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                    json.dump({'timestamp': self.vector_store_timestamp}, f)
+                try:
+                    os.replace(tmp_path, path)
+                except OSError:  # another replica of this node wrote it first
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+
+        if os.path.exists(path):
+            self.vector_store = SemanticRetriever.load(path, quantization=self.quantization)
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.vector_store_timestamp = json.load(f)['timestamp']
+            self.sync_vector_store()  # changes between the snapshot and now
+
+            # remove the older versions, the replicas still using them keep their open mappings
+            for name in os.listdir(self.vector_store_dir):
+                if name != version and ".tmp" not in name:
+                    shutil.rmtree(os.path.join(self.vector_store_dir, name), ignore_errors=True)
+
+        print(f"Vector store loaded with {self.vector_store.len_data or 0} embeddings, version {version}")
+
+    def sync_vector_store(self):
+        """
+        Fetches the embeddings created or updated since the last sync and removes the deleted ones.
+        Returns whether the vector store changed.
+        """
+        import numpy as np
+        import requests
+        import torch
+
+        headers = {'Authorization': f'Token {self.token}'}
+        params = {'after_id': 0}
+        if self.vector_store_timestamp is not None:
+            params['since'] = self.vector_store_timestamp
+
+        timestamp, ids_checksum, changed = None, None, False
+        while True:
+            page = requests.get(self.embeddings_endpoint, params=params, headers=headers).json()
+            # the timestamp of the first page is the one to use, later changes are fetched on the next sync
+            timestamp = timestamp or page['timestamp']
+            ids_checksum = page['ids_checksum']
+            if not page['k_item_ids']:
+                break
+
+            embeddings = np.frombuffer(base64.b64decode(page['embeddings']), dtype=np.float32)
+            self.vector_store.upsert(
+                'k_item_id',
+                {'k_item_id': page['k_item_ids'], 'content': page['contents']},
+                embeddings.reshape(len(page['k_item_ids']), page['dim']),
+            )
+            changed = True
+            params['after_id'] = page['last_id']
+
+        # only when some embeddings were deleted all the current ids are fetched to find which ones
+        local_ids = self.local_k_item_ids()
+        if [len(local_ids), sum(local_ids), sum(k_item_id * k_item_id for k_item_id in local_ids)] != ids_checksum:
+            current_ids = requests.get(self.embeddings_endpoint, params={'ids_only': 'true'}, headers=headers).json()['k_item_ids']
+            current_ids = set(current_ids)
+            self.vector_store.delete('k_item_id', [k_item_id for k_item_id in local_ids if k_item_id not in current_ids])
+            changed = True
+
+        if self.vector_store.embeddings is not None and self.vector_store.quantization is None:
+            # half precision only pays off on GPU, quantized stores keep the full precision embeddings memory-mapped on CPU for rescoring
+            dtype = torch.float16 if self.model.device == 'cuda' else torch.float32
+            self.vector_store.to(self.model.device, dtype)
+
+        self.vector_store_timestamp = timestamp
+        self.vector_store_synced_at = time.monotonic()
+        return changed
+
+    def local_k_item_ids(self):
+        if self.vector_store.data is None:
+            return []
+        deleted = self.vector_store.deleted
+        return [k_item_id for ndx, k_item_id in enumerate(self.vector_store.data['k_item_id']) if ndx not in deleted]
+
+    async def maybe_sync_vector_store(self):
+        if time.monotonic() - self.vector_store_synced_at > VECTOR_STORE_REFRESH_INTERVAL_S:
+            try:
+                changed = await asyncio.to_thread(self.sync_vector_store)
+                if changed and self.hybrid_retriever is not None:
+                    await asyncio.to_thread(self.hybrid_retriever.refresh_sparse_index)
+            except Exception as e:
+                # keep serving with the embeddings we have
+                print(f"Error refreshing the vector store: {e}")
+
+    async def search_in_process(self, queries, embeddings, top_ks):
+        await self.maybe_sync_vector_store()
 
-        self.model = E5Model(model_name=model_name, use_cpu=use_cpu, huggingface_key=hf_key)
-        self.reranker = ReRanker(lang=lang, device='cpu' if use_cpu else 'cuda')
+        if not self.vector_store.len_data:
+            return [[] for _ in top_ks]
 
-        print(f"RetrieverDeployment initialized with model_name={model_name}, use_cpu={use_cpu}")
+        if self.hybrid_retriever is not None:
+            results_list = self.hybrid_retriever.retrieve_from_embeddings(
+                queries, embeddings, top_k=-1 if -1 in top_ks else max(top_ks)
+            )
+            # same threshold as the dense search, the exact matches of the identifiers are kept whatever their similarity
+            return [
+                [result for result in results if result['exact_match'] or result['similarity'] > 0.0]
+                for results in results_list
+            ]
 
-    @serve.batch(max_batch_size=5, batch_wait_timeout_s=0.2)
-    async def batch_handler(self, queries: List[str], top_ks: List[int]):
+        results_list = self.vector_store.retrieve_from_embeddings(
+            embeddings, top_k=-1 if -1 in top_ks else max(top_ks)
+        )
+        # same threshold as the backend retrieval endpoint
+        return [[result for result in results if result['similarity'] > 0.0] for results in results_list]
+
+    async def batch_handler(self, queries: List[str], top_ks: List[int], query_embeddings: List[Optional[List[float]]]):
         """
-        Batch handler for the retriever model. This method is called by Ray Serve when a batch of requests is received.
-        It creates the query embeddings, sends them to a pgvector backend endpoint for retrieval asynchronously and returns the results.
+        Batch handler for the retriever model. This method is called by the batcher of the replica when a batch of requests is ready.
+        It creates the query embeddings that were not given, scores them against the in memory embeddings if in process search is enabled,
+        otherwise sends them to a pgvector backend endpoint for retrieval asynchronously, and returns the reranked results.
         """
 
-        embeddings = self.model.build_embeddings(queries, prefix='query: ')
+        embeddings = self.build_query_embeddings(queries, query_embeddings)
 
-        async with ClientSession() as session:
-            tasks = []
-            headers = {'Authorization': f'Token {self.token}'}
+        if self.vector_store is not None:
+            results_list = await self.search_in_process(queries, embeddings, top_ks)
+            results_list = [
+                results if top_k == -1 else results[:top_k]
+                for results, top_k in zip(results_list, top_ks)
+            ]
+            return self.rerank(queries, results_list)
 
-            for i, query_embedding in enumerate(embeddings):
-                query_embedding = query_embedding.tolist()
-                data = {
-                    'query_embeddings': [query_embedding],
-                    'top_k': top_ks[i]
-                }
-                task = self.post_request(session, data, headers)
-                tasks.append(task)
+        # A single request for the whole batch, the backend resolves all the queries in one database query
+        headers = {'Authorization': f'Token {self.token}'}
+        data = {
+            'query_embeddings': embeddings.tolist(),
+            'top_k': -1 if -1 in top_ks else max(top_ks),
+            'grouped': True,
+        }
+        results_list = await self.post_request(self.http.get(), data, headers)
 
-            results_list = await asyncio.gather(*tasks)
+        results_list = [
+            results if top_k == -1 else results[:top_k]
+            for results, top_k in zip(results_list, top_ks)
+        ]
 
         results_reranked = self.rerank(queries, results_list)
         return results_reranked
 
-    def rerank(self, queries, results_list):
-        results_reranked = []
-        for query, results in zip(queries, results_list):
-            if not results:
-                results_reranked.append([])
-                continue
+    def build_query_embeddings(self, queries, query_embeddings):
+        """
+        Returns the embeddings of the queries, only the ones not embedded yet by the semantic tier of the retrieval
+        cache of the RAG deployment go through the model.
+        """
+        import torch
 
-            reranked_results = self.reranker(query, results)
-            results_reranked.append(reranked_results)
+        missing = [ndx for ndx, embedding in enumerate(query_embeddings) if embedding is None]
+        if len(missing) == len(queries):
+            return self.model.build_embeddings(queries, prefix='query: ')
+        given = [ndx for ndx, embedding in enumerate(query_embeddings) if embedding is not None]
+        given_embeddings = torch.tensor([query_embeddings[ndx] for ndx in given], dtype=torch.float32)
+        if not missing:
+            return given_embeddings
+        built = self.model.build_embeddings([queries[ndx] for ndx in missing], prefix='query: ')
+        embeddings = torch.empty((len(queries), built.shape[1]), dtype=built.dtype, device=built.device)
+        embeddings[missing] = built
+        embeddings[given] = given_embeddings.to(built.dtype).to(built.device)
+        return embeddings
 
-        return results_reranked
+    def rerank(self, queries, results_list):
+        # exact keyword hits of the hybrid search (e.g. product codes) stay on top without going through the cross-encoder
+        exact_list = [[result for result in results if result.get('exact_match')] for results in results_list]
+        results_list = [[result for result in results if not result.get('exact_match')] for results in results_list]
+        # a single cross-encoder forward pass for all the queries of the batch
+        results_list = self.reranker.batch_rerank(queries, results_list)
+        return [exact + results for exact, results in zip(exact_list, results_list)]
 
     async def post_request(self, session, json, headers):
         async with session.post(self.retrieve_endpoint, json=json, headers=headers) as response:
             return await response.json()
 
-    def update_batch_params(self, max_batch_size, batch_wait_timeout_s):
-        self.batch_handler.set_max_batch_size(max_batch_size)
-        self.batch_handler.set_batch_wait_timeout_s(batch_wait_timeout_s)
+    async def embed(self, query: str):
+        """
+        Returns the query embedding, used by the semantic tier of the retrieval cache of the RAG deployments.
+        """
+        return self.model.build_embeddings([query], prefix='query: ', disable_progress_bar=True)[0].tolist()
 
-    async def __call__(self, query: str, top_k: int):
-        return await self.batch_handler(query, top_k)
+    async def __call__(self, query: str, top_k: int, query_embedding: Optional[List[float]] = None):
+        return await self.batcher.submit(query, top_k, query_embedding)
 
 
-def launch_e5(retriever_deploy_name, model_name, use_cpu, rag_config_id, lang='en'):
+def launch_e5(retriever_deploy_name, model_name, use_cpu, rag_config_id, lang='en', in_process_search=False, quantization=None, backend='torch', hybrid=False, batch_params=None, autoscaling_config=None):
     print(f"Launching E5 deployment with name: {retriever_deploy_name}")
+    options = {'name': retriever_deploy_name}
+    if autoscaling_config is not None:
+        options['autoscaling_config'] = autoscaling_config
     retriever_handle = E5Deployment.options(
-            name=retriever_deploy_name,
-            ).bind(model_name, use_cpu, rag_config_id, lang)
+            **options,
+            ).bind(model_name, use_cpu, rag_config_id, lang, in_process_search, quantization, backend, hybrid, batch_params)
 
     print("E5 deployment started")
     # serve.run(retriever_handle, host="0.0.0.0", port=8000, route_prefix="/retrieve", name='retriever_deployment')
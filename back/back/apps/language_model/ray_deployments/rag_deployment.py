@@ -1,4 +1,8 @@
+import os
 import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urljoin
 
 import ray
 from ray import serve
@@ -18,6 +22,29 @@ from logging import getLogger
 
 logger = getLogger(__name__)
 
+# Retrieval cache of the RAG orchestrator, disabled by default, set a size (e.g. 1024) to enable it
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('RETRIEVAL_CACHE_SIZE', 0))
+RETRIEVAL_CACHE_TTL_S = float(os.environ.get('RETRIEVAL_CACHE_TTL_S', 3600))
+# Minimum cosine similarity to reuse the results of a similar message, unset disables the semantic tier (E5 retrievers only)
+RETRIEVAL_CACHE_SIMILARITY_THRESHOLD = os.environ.get('RETRIEVAL_CACHE_SIMILARITY_THRESHOLD')
+# Response cache of the RAG orchestrator, only used by the generation configs with cache_responses enabled
+# and temperature 0, a size of 0 disables it
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL_S = float(os.environ.get('RESPONSE_CACHE_TTL_S', 24 * 3600))
+# How often the index version of the RAG config is checked to invalidate the retrieval and response caches
+CACHE_VERSION_REFRESH_INTERVAL_S = 10
+# Blue/green redeploys: the new version of a RAG is launched and warmed up next to the running one, which keeps serving
+# until the switch. The cluster needs room for both versions during the redeploy, otherwise the old one is deleted first
+RAG_BLUE_GREEN_DEPLOYS = os.environ.get('RAG_BLUE_GREEN_DEPLOYS', 'false').lower() == 'true'
+# Probe queries sent through a new version before it takes over the traffic
+RAG_WARMUP_QUERIES = ["warm up query"] * 3
+# Time for the requests that resolved the previous version right before the switch to reach it
+RAG_SWITCH_GRACE_PERIOD_S = 10
+# How long the replicas of a deleted version wait for their in-flight streams to finish
+RAG_DRAIN_TIMEOUT_S = float(os.environ.get('RAG_DRAIN_TIMEOUT_S', 300))
+# How long a new version has to start and answer the probe queries, a launch that cannot be scheduled fails after it
+RAG_LAUNCH_TIMEOUT_S = float(os.environ.get('RAG_LAUNCH_TIMEOUT_S', 600))
+
 
 @serve.deployment(
     name="rag_orchestrator",
@@ -26,7 +53,8 @@ logger = getLogger(__name__)
             "resources": {
                 "rags": 1,
             }
-        }
+        },
+    graceful_shutdown_timeout_s=RAG_DRAIN_TIMEOUT_S,
 )
 class RAGDeployment:
 
@@ -36,46 +64,139 @@ class RAGDeployment:
             self.handle = handle
             print("RetrieverHandleClient created")
 
-        async def retrieve(self, message: str, top_k: int):
+        async def retrieve(self, message: str, top_k: int, embedding=None):
             print(f"Retrieving for message: {message}")
-            result = await self.handle.remote(message, top_k)
+            if embedding is not None:  # already embedded by the semantic tier of the retrieval cache
+                result = await self.handle.remote(message, top_k, embedding)
+            else:
+                result = await self.handle.remote(message, top_k)
             print(f"Results retrieved: {result}")
             return result
 
-    def __init__(self, retriever_handle: DeploymentHandle, llm_name: str, llm_type: str):
+        async def embed(self, message: str):
+            return await self.handle.embed.remote(message)
 
-        from chat_rag import AsyncRAG
-        from chat_rag.llms import (
-            AsyncClaudeChatModel,
-            AsyncMistralChatModel,
-            AsyncOpenAIChatModel,
-            AsyncVLLMModel,
-        )
+    def __init__(self, retriever_handle: DeploymentHandle, llm_name: str, llm_type: str, rag_config_id: int = None, semantic_cache: bool = False):
 
-        LLM_CLASSES = {
-            "claude": AsyncClaudeChatModel,
-            "mistral": AsyncMistralChatModel,
-            "openai": AsyncOpenAIChatModel,
-            "vllm": AsyncVLLMModel,
-            "together": AsyncOpenAIChatModel,
-        }
+        from chat_rag import AsyncRAG
+        from chat_rag.inf_retrieval.retrieval_cache import RetrievalCache
+        from chat_rag.response_cache import ResponseCache
 
         retriever = self.RetrieverHandleClient(retriever_handle)
+        self.retriever = retriever
+        # the LLM client is built on the first generation, the retrieval only requests never need it
+        self.llm_name = llm_name
+        self.llm_type = llm_type
+
+        retrieval_cache = None
+        if RETRIEVAL_CACHE_SIZE > 0 and rag_config_id is not None:
+            similarity_threshold = None
+            if semantic_cache and RETRIEVAL_CACHE_SIMILARITY_THRESHOLD:
+                similarity_threshold = float(RETRIEVAL_CACHE_SIMILARITY_THRESHOLD)
+            retrieval_cache = RetrievalCache(
+                max_size=RETRIEVAL_CACHE_SIZE, ttl_s=RETRIEVAL_CACHE_TTL_S, similarity_threshold=similarity_threshold
+            )
+        response_cache = None
+        if RESPONSE_CACHE_SIZE > 0 and rag_config_id is not None:
+            response_cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl_s=RESPONSE_CACHE_TTL_S)
+        from chat_rag.http_pool import PooledSession
+
+        # keep-alive connections to the backend for the polls of the index version
+        self.http = PooledSession()
+        self.token = os.environ.get('BACKEND_TOKEN')
+        self.index_version_endpoint = urljoin(os.environ.get('BACKEND_HOST', ''), f"/back/api/language-model/rag-configs/{rag_config_id}/index-version/")
+        self.index_version_checked_at = None
+
+        self.rag = AsyncRAG(
+            retriever=retriever, llm_model=None, retrieval_cache=retrieval_cache, response_cache=response_cache
+        )
+        print(f"RAGDeployment created, retrieval cache: {retrieval_cache is not None}, response cache: {response_cache is not None}")
+
+    async def refresh_caches_version(self):
+        """
+        Clears the retrieval and response caches if the index version of the RAG config changed since the last check.
+        """
+        caches = [cache for cache in (self.rag.retrieval_cache, self.rag.response_cache) if cache is not None]
+        if not caches:
+            return
+        if self.index_version_checked_at is not None \
+                and time.monotonic() - self.index_version_checked_at < CACHE_VERSION_REFRESH_INTERVAL_S:
+            return
+
+        self.index_version_checked_at = time.monotonic()
+        try:
+            headers = {'Authorization': f'Token {self.token}'}
+            async with self.http.get().get(self.index_version_endpoint, headers=headers) as response:
+                index_version = (await response.json())['index_version']
+            for cache in caches:
+                cache.set_version(index_version)
+        except Exception as e:
+            # without the version we cannot know if the cached results are still valid
+            print(f"Error checking the index version, clearing the caches: {e}")
+            for cache in caches:
+                cache.set_version(None)
+                cache.entries.clear()
+
+    async def warm_up(self, queries):
+        """
+        Sends probe queries through the retriever so its replicas load their models and indexes before serving traffic,
+        and builds the LLM client so a misconfigured LLM fails the deploy instead of the first generation.
+        The tokenizer of the self-hosted models is loaded here too, the remote providers count the tokens locally.
+        """
+        self.get_llm_model().load_tokenizer()
+        for query in queries:
+            await self.retriever.retrieve(query, 1)
+        return len(queries)
+
+    async def __del__(self):
+        # called by Ray Serve on the shutdown of the replica, after the graceful shutdown of the in flight requests
+        await self.http.close()
+        close_llm = getattr(self.rag.model, "close", None)
+        if close_llm is not None:
+            await close_llm()
+
+    def retrieval_cache_stats(self):
+        if self.rag.retrieval_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.rag.retrieval_cache.stats()}
+
+    def response_cache_stats(self):
+        if self.rag.response_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.rag.response_cache.stats()}
+
+    def get_llm_model(self):
+        if self.rag.model is None:
+            from chat_rag.llms import (
+                AsyncClaudeChatModel,
+                AsyncMistralChatModel,
+                AsyncOpenAIChatModel,
+                AsyncVLLMModel,
+            )
+
+            LLM_CLASSES = {
+                "claude": AsyncClaudeChatModel,
+                "mistral": AsyncMistralChatModel,
+                "openai": AsyncOpenAIChatModel,
+                "vllm": AsyncVLLMModel,
+                "together": AsyncOpenAIChatModel,
+            }
 
-        # For Together model, we need to set the base_url
-        base_url = None
-        if llm_type == "together":
-            base_url="https://api.together.xyz/v1"
+            # For Together model, we need to set the base_url
+            base_url = None
+            if self.llm_type == "together":
+                base_url="https://api.together.xyz/v1"
 
-        llm_model = LLM_CLASSES[llm_type](llm_name, base_url=base_url)
-        self.rag = AsyncRAG(retriever=retriever, llm_model=llm_model)
-        print("RAGDeployment created")
+            self.rag.model = LLM_CLASSES[self.llm_type](self.llm_name, base_url=base_url)
+        return self.rag.model
 
     async def gen_response(self, messages, prev_contents, prompt_structure_dict, generation_config_dict, only_context=False):
         print(f"Generating response for messages: {messages}")
+        await self.refresh_caches_version()
+        if not only_context:
+            self.get_llm_model()
         context_sent = False
-        # async for response_dict in self.rag.stream(messages, prev_contents, prompt_structure_dict, generation_config_dict, only_context=only_context):
-        async for response_dict in self.rag.stream(messages, prev_contents, prompt_structure_dict, generation_config_dict):
+        async for response_dict in self.rag.stream(messages, prev_contents, prompt_structure_dict, generation_config_dict, only_context=only_context):
             # Send the context only once
             if not context_sent:
                 yield_dict = response_dict
@@ -85,36 +206,60 @@ class RAGDeployment:
             response_str = json.dumps(yield_dict)
             yield response_str
 
+    async def generate(self, messages, prev_contents, prompt_structure_dict, generation_config_dict):
+        """
+        Non streaming version of gen_response, returns the whole response with its context.
+        """
+        await self.refresh_caches_version()
+        self.get_llm_model()
+        return await self.rag.generate(messages, prev_contents, prompt_structure_dict, generation_config_dict)
+
+    async def retrieve(self, messages, prompt_structure_dict):
+        """
+        Returns the context of the last message without going through the LLM.
+        """
+        await self.refresh_caches_version()
+        _, returned_contexts = await self.rag.retrieve(messages[-1]['content'], [], prompt_structure_dict)
+        return {"context": returned_contexts}
+
     def __call__(self, messages, prev_contents, prompt_structure_dict, generation_config_dict, only_context):
         return self.gen_response(messages, prev_contents, prompt_structure_dict, generation_config_dict, only_context)
 
 
-def launch_rag(rag_deploy_name, retriever_handle, llm_name, llm_type, num_replicas=1):
+def launch_rag(rag_deploy_name, retriever_handle, llm_name, llm_type, num_replicas=1, rag_config_id=None, semantic_cache=False, autoscaling_config=None) -> Future:
+    """
+    Starts the deployment of a RAG application and returns the future of its serve.run call.
+    serve.run waits for the replicas without a timeout, so it runs in a worker thread and the caller waits for them
+    with wait_rag_running instead.
+    """
 
     print(f'Got retriever handle: {retriever_handle}')
     print(f'Launching RAG deployment with name: {rag_deploy_name}')
+    # the autoscaling config replaces the fixed number of replicas
+    options = {'num_replicas': num_replicas} if autoscaling_config is None else {'autoscaling_config': autoscaling_config}
     rag_handle = RAGDeployment.options(
-        num_replicas=num_replicas,
-    ).bind(retriever_handle, llm_name, llm_type)
+        **options,
+    ).bind(retriever_handle, llm_name, llm_type, rag_config_id, semantic_cache)
 
     print(f'Launched RAG deployment with name: {rag_deploy_name}')
     route_prefix = f'/rag/{rag_deploy_name}'
-    serve.run(rag_handle, route_prefix=route_prefix, name=rag_deploy_name).options(stream=True)
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'launch_{rag_deploy_name}')
+    launch = executor.submit(serve.run, rag_handle, route_prefix=route_prefix, name=rag_deploy_name)
+    executor.shutdown(wait=False)
     print(f'Launched all deployments')
+    return launch
 
 
 @ray.remote(num_cpus=0.2, resources={"tasks": 1})
-def delete_rag_deployment(rag_deploy_name):
+def delete_rag_deployment(rag_name):
     """
-    Delete the RAG deployment Ray Serve.
+    Delete every version of the RAG deployment Ray Serve, including the ones still draining or being launched.
     """
-    if serve.status().applications:
-        serve.delete(rag_deploy_name)
-        try:
-            app_handle = serve.get_app_handle(rag_deploy_name)
-            # if it doesn't return error it means the deployment is still running
-            print(f"{rag_deploy_name} could not be deleted, so it doesn't exist or it is still running.")
-        except:
+    from back.apps.language_model.models import RAGConfig
+
+    for rag_deploy_name in list(serve.status().applications):
+        if RAGConfig.is_deploy_name(rag_name, rag_deploy_name):
+            serve.delete(rag_deploy_name)
             print(f'{rag_deploy_name} was deleted successfully')
 
     # If all deployments are deleted, shutdown the serve instance
@@ -122,23 +267,58 @@ def delete_rag_deployment(rag_deploy_name):
         serve.shutdown()
 
 
+def wait_rag_running(rag_deploy_name, timeout_s, launch: Future = None):
+    """
+    Waits until all the replicas of a RAG application are running, raises if they fail or do not start in time.
+    The launch is the future returned by launch_rag, its error is raised if the deployment could not be submitted.
+    """
+    deadline = time.monotonic() + timeout_s
+    while True:
+        if launch is not None and launch.done() and launch.exception() is not None:
+            raise launch.exception()
+        app = serve.status().applications.get(rag_deploy_name)
+        if app is not None and app.status == 'RUNNING':
+            return
+        if app is not None and app.status == 'DEPLOY_FAILED':
+            raise RuntimeError(f'{rag_deploy_name} failed to deploy: {app.message}')
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{rag_deploy_name} did not start in {timeout_s}s')
+        time.sleep(1)
+
+
+def warm_up_rag(rag_deploy_name, timeout_s):
+    """
+    Waits until the orchestrator and retriever of a RAG application answer the probe queries.
+    """
+    handle = serve.get_app_handle(rag_deploy_name)
+    handle.warm_up.remote(RAG_WARMUP_QUERIES).result(timeout_s=timeout_s)
+    print(f'{rag_deploy_name} warmed up with {len(RAG_WARMUP_QUERIES)} probe queries')
+
+
 @ray.remote(num_cpus=0.5, resources={"tasks": 1})
 def launch_rag_deployment(rag_config_id):
     """
     Launch the RAG deployment using Ray Serve.
+    Every launch creates a new version of the RAG application, the version that query_ray resolves is switched once
+    the new one is warmed up and the previous versions are deleted after their in-flight streams drain.
+    With RAG_BLUE_GREEN_DEPLOYS disabled the running version is deleted before launching the new one.
     """
     from django.conf import settings
     from back.apps.language_model.models import RAGConfig
 
     rag_config = RAGConfig.objects.get(pk=rag_config_id)
-    rag_deploy_name = rag_config.get_deploy_name()
+    new_version = rag_config.deploy_version + 1
+    rag_deploy_name = rag_config.get_deploy_name(new_version)
     num_replicas = rag_config.num_replicas
+    autoscaling_config = rag_config.get_autoscaling_config()
+    batch_params = rag_config.get_batch_params()
 
-    # delete the deployment if it already exists
-    task_name = f'delete_rag_deployment_{rag_deploy_name}'
-    print(f"Submitting the {task_name} task to the Ray cluster...")
-    # Need to wait for the task to finish before launching the new deployment
-    ray.get(delete_rag_deployment.options(name=task_name).remote(rag_deploy_name))
+    if not RAG_BLUE_GREEN_DEPLOYS:
+        # delete the deployment if it already exists, with any other version left by a failed launch
+        task_name = f'delete_rag_deployment_{rag_config.name}'
+        print(f"Submitting the {task_name} task to the Ray cluster...")
+        # Need to wait for the task to finish before launching the new deployment
+        ray.get(delete_rag_deployment.options(name=task_name).remote(rag_config.name))
 
     if not serve.status().applications:
         serve.start(detached=True, proxy_location=ProxyLocation(ProxyLocation.Disabled))
@@ -146,18 +326,47 @@ def launch_rag_deployment(rag_config_id):
     retriever_type = rag_config.retriever_config.get_retriever_type()
     retriever_deploy_name = f'retriever_{rag_config.retriever_config.name}'
 
-    if retriever_type == RetrieverTypeChoices.E5:
+    if retriever_type in (RetrieverTypeChoices.E5, RetrieverTypeChoices.HYBRID):
         model_name = rag_config.retriever_config.model_name
         use_cpu = rag_config.retriever_config.get_device() == DeviceChoices.CPU
         lang = rag_config.knowledge_base.get_lang().value
-        retriever_handle = launch_e5(retriever_deploy_name, model_name, use_cpu, rag_config_id, lang)
+        in_process_search = rag_config.retriever_config.in_process_search
+        quantization = rag_config.retriever_config.get_quantization()
+        backend = rag_config.retriever_config.get_inference_backend().value
+        hybrid = retriever_type == RetrieverTypeChoices.HYBRID
+        retriever_handle = launch_e5(retriever_deploy_name, model_name, use_cpu, rag_config_id, lang, in_process_search, quantization, backend, hybrid, batch_params, autoscaling_config)
 
     elif retriever_type == RetrieverTypeChoices.COLBERT:
-        retriever_handle = launch_colbert(retriever_deploy_name, rag_config.s3_index_path)
+        retriever_handle = launch_colbert(retriever_deploy_name, rag_config.s3_index_path, rag_config_id, batch_params, autoscaling_config)
 
     else:
         raise ValueError(f"Retriever type: {retriever_type.value} not supported.")
 
     llm_name = rag_config.llm_config.llm_name
     llm_type = rag_config.llm_config.get_llm_type().value
-    launch_rag(rag_deploy_name, retriever_handle, llm_name, llm_type, num_replicas)
+    semantic_cache = retriever_type != RetrieverTypeChoices.COLBERT  # the ColBERT deployment has no query embeddings
+    try:
+        launch_started = time.monotonic()
+        launch = launch_rag(rag_deploy_name, retriever_handle, llm_name, llm_type, num_replicas, rag_config_id, semantic_cache, autoscaling_config)
+        wait_rag_running(rag_deploy_name, RAG_LAUNCH_TIMEOUT_S, launch)
+        warm_up_rag(rag_deploy_name, max(RAG_LAUNCH_TIMEOUT_S - (time.monotonic() - launch_started), 1))
+    except Exception:
+        # the running version, if any, keeps serving
+        print(f'{rag_deploy_name} failed to start, deleting it')
+        serve.delete(rag_deploy_name)
+        raise
+
+    # switch the traffic, without save() so the change does not trigger another redeploy
+    RAGConfig.objects.filter(pk=rag_config_id).update(deploy_version=new_version)
+    print(f'{rag_deploy_name} is now serving {rag_config.name}')
+
+    previous_deploy_names = [
+        app_name for app_name in serve.status().applications
+        if RAGConfig.is_deploy_name(rag_config.name, app_name) and app_name != rag_deploy_name
+    ]
+    if previous_deploy_names:
+        time.sleep(RAG_SWITCH_GRACE_PERIOD_S)
+        for app_name in previous_deploy_names:
+            # blocks until the replicas finish their in-flight streams or RAG_DRAIN_TIMEOUT_S passes
+            serve.delete(app_name)
+            print(f'{app_name} was drained and deleted')
@@ -1,6 +1,9 @@
+from importlib.util import find_spec
+
 from rest_framework import serializers
 
 from back.apps.language_model.models import KnowledgeBase
+from back.apps.language_model.models.enums import InferenceBackendChoices
 from back.apps.language_model.models.rag_pipeline import RAGConfig, LLMConfig, GenerationConfig, PromptConfig, RetrieverConfig
 
 
@@ -47,6 +50,13 @@ class RetrieverConfigSerializer(serializers.ModelSerializer):
         model = RetrieverConfig
         fields = "__all__"
 
+    def validate_inference_backend(self, value):
+        # the retriever replicas run on the same image, without onnxruntime they could not load the model
+        if value in (InferenceBackendChoices.ONNX, InferenceBackendChoices.ONNX_INT8) \
+                and (find_spec("onnxruntime") is None or find_spec("onnx") is None):
+            raise serializers.ValidationError("The ONNX backends need onnxruntime, install chat-rag with the onnx extra.")
+        return value
+
 
 class GenerationConfigSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,4 +8,4 @@ class RayTaskStateSerializer(serializers.ModelSerializer):
         model = RayTaskState
         fields = '__all__'
         read_only_fields = ('task_id', 'state', 'type', 'func_or_class_name', 'creation_time_ms', 'start_time_ms',
-                            'end_time_ms', 'task_log_info', 'error_message', 'is_debugger_paused')
+                            'end_time_ms', 'task_log_info', 'error_message', 'is_debugger_paused', 'progress')
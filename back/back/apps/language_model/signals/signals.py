@@ -15,12 +15,15 @@ logger = getLogger(__name__)
 def on_rag_config_change(instance, *args, **kwargs):
     s3_index_path = instance.s3_index_path
 
+    # The embeddings are deleted in cascade but the partial ANN indexes are not
+    instance.drop_vector_index(concurrently=False)
+
     if s3_index_path:
         task_name = f"delete_index_files_{instance.name}"
         logger.info(f"Submitting the {task_name} task to the Ray cluster...")
         delete_index_files.options(name=task_name).remote(s3_index_path)
 
-    rag_deploy_name = instance.get_deploy_name()
+    # every version, not only the one serving the traffic, a previous one may still be draining or a new one launching
     task_name = f"delete_rag_deployment_{instance.name}"
     logger.info(f"Submitting the {task_name} task to the Ray cluster...")
-    delete_rag_deployment.options(name=task_name).remote(rag_deploy_name)
+    delete_rag_deployment.options(name=task_name).remote(instance.name)
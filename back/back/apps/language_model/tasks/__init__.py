@@ -1,4 +1,5 @@
 from .parsing_tasks import parse_pdf_task, parse_url_task
 from .intent_tasks import generate_intents_task, generate_suggested_intents_task, generate_titles_task
-from .util_tasks import read_s3_index, get_filesystem, test_task
+from .util_tasks import read_s3_index, get_filesystem, test_task, write_index_segment, read_index_segment, delete_index_segments, \
+    index_checksums, write_index_checksums, use_cached_index
 from .indexing_tasks import index_task, delete_index_files
\ No newline at end of file
@@ -4,7 +4,7 @@ import os
 import ray
 from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 
-from back.apps.language_model.tasks import read_s3_index, get_filesystem
+from back.apps.language_model.tasks import read_s3_index, get_filesystem, write_index_segment, index_checksums, write_index_checksums
 
 @ray.remote(num_cpus=1, resources={"tasks": 1})
 class ColBERTActor:
@@ -50,7 +50,8 @@ class ColBERTActor:
             node_scheduling_strategy = NodeAffinitySchedulingStrategy(
                 node_id=node_id, soft=False
             )
-            local_index_path_ref = read_s3_index.options(scheduling_strategy=node_scheduling_strategy).remote(self.index_path, self.storages_mode)
+            # a private copy, the index is modified in place
+            local_index_path_ref = read_s3_index.options(scheduling_strategy=node_scheduling_strategy).remote(self.index_path, self.storages_mode, writable=True)
             self.local_index_path = ray.get(local_index_path_ref)
         else:
             self.local_index_path = self.index_path
@@ -104,6 +105,39 @@ class ColBERTActor:
         )
         print("Done!")
 
+    def encode_segment(self, contents, contents_pk, segment_path, bsize=32):
+        """
+        Encode a small collection of documents as an index segment, without a PLAID index, and write it to segment_path.
+        The segment holds the passage encodings and masks and the passages with the k item id they belong to.
+        """
+        import json
+        import shutil
+        import tempfile
+        import torch
+        from ragatouille.data.preprocessors import llama_index_sentence_splitter
+
+        chunks = llama_index_sentence_splitter(contents, contents_pk, chunk_size=512)
+        passages = [chunk["content"] for chunk in chunks]
+
+        print(f"Encoding a segment of {len(contents)} items and {len(passages)} passages")
+        self.retriever.encode(passages, bsize=bsize, max_document_length=512)
+
+        local_path = tempfile.mkdtemp()
+        try:
+            model = self.retriever.model
+            torch.save(
+                {"embed_docs": model.in_memory_embed_docs.cpu(), "doc_masks": model.doc_masks.cpu()},
+                os.path.join(local_path, "encodings.pt"),
+            )
+            with open(os.path.join(local_path, "passages.json"), "w") as f:
+                json.dump({"passages": passages, "k_item_ids": [int(chunk["document_id"]) for chunk in chunks]}, f)
+
+            write_index_segment(local_path, segment_path, self.storages_mode)
+        finally:
+            self.retriever.clear_encoded_docs(force=True)
+            shutil.rmtree(local_path, ignore_errors=True)
+        print(f"Segment written to {segment_path}")
+
     def save_index(self, new_index_path: Optional[str] = None):
         """
         Save the index to the cloud storage.
@@ -162,6 +196,8 @@ class ColBERTActor:
                     fs = fs.unwrap()
                 # Then we can write the index to the cloud storage
                 index.write_parquet(remote_index_path, filesystem=fs, filename_provider=PidDocIdFilenameProvider())
+                # the downloads verify the index files with them
+                write_index_checksums(index_checksums(self.retriever.model.index_path), remote_index_path, self.storages_mode)
                 print('Index written to object storage')
 
             return True
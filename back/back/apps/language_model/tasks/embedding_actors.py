@@ -0,0 +1,167 @@
+import os
+import time
+import asyncio
+from typing import List
+
+import ray
+
+# Seconds a replica can go unused before it is evicted
+EMBEDDING_POOL_IDLE_TIMEOUT_S = int(os.environ.get("EMBEDDING_POOL_IDLE_TIMEOUT_S", 300))
+# Maximum number of model replicas per (model_name, device) pool
+EMBEDDING_POOL_MAX_REPLICAS = int(os.environ.get("EMBEDDING_POOL_MAX_REPLICAS", 2))
+# Ongoing requests per replica above which the pool starts a new replica
+EMBEDDING_POOL_TARGET_ONGOING_REQUESTS = 1
+EMBEDDING_POOL_EVICTION_INTERVAL_S = 30
+
+
+@ray.remote(num_cpus=1, resources={"tasks": 1})
+class EmbeddingModelActor:
+    """
+    Holds an embedding model loaded in memory so it is not reloaded for every task.
+    """
+    def __init__(self, model_name: str, device: str = 'cpu'):
+        from chat_rag.inf_retrieval.embedding_models import E5Model
+
+        self.model = E5Model(
+            model_name=model_name,
+            use_cpu=device == 'cpu',
+            huggingface_key=os.environ.get("HUGGINGFACE_API_KEY", None),
+        )
+        print(f"EmbeddingModelActor loaded {model_name} on {self.model.device}")
+
+    def ready(self):
+        return True
+
+    def encode(self, queries: List[str], batch_size: int = -1):
+        return self.model.encode(queries, batch_size=batch_size, disable_progress_bar=True).float().cpu().numpy()
+
+    def build_embeddings(self, contents: List[str], batch_size: int = 1, prefix: str = "passage: ", max_tokens_per_batch: int = None):
+        embeddings = self.model.build_embeddings(
+            contents=contents,
+            batch_size=batch_size,
+            prefix=prefix,
+            disable_progress_bar=True,
+            max_tokens_per_batch=max_tokens_per_batch,
+        )
+        # float32 arrays go through the object store as a single buffer
+        return embeddings.float().cpu().numpy()
+
+
+@ray.remote(num_cpus=0)
+class EmbeddingModelPool:
+    """
+    Long-lived pool of EmbeddingModelActor replicas of one (model_name, device) pair.
+    Requests go to the least busy replica. A new replica is started when all of them are over the target number
+    of ongoing requests, up to max_replicas, and the replicas unused for idle_timeout_s seconds are evicted.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        device: str = 'cpu',
+        max_replicas: int = EMBEDDING_POOL_MAX_REPLICAS,
+        idle_timeout_s: int = EMBEDDING_POOL_IDLE_TIMEOUT_S,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.max_replicas = max(max_replicas, 1)
+        self.idle_timeout_s = idle_timeout_s
+        self.replicas = []
+        self.eviction_task = None
+
+    def __repr__(self) -> str:
+        return f"EmbeddingModelPool(model_name={self.model_name}, device={self.device}, replicas={len(self.replicas)})"
+
+    def start_replica(self):
+        handle = EmbeddingModelActor.options(num_gpus=1 if self.device == 'cuda' else 0).remote(self.model_name, self.device)
+        replica = {
+            "handle": handle,
+            "ongoing": 0,
+            "last_used": time.monotonic(),
+            # the replica only gets requests once its model is loaded, it may wait for resources
+            "ready": asyncio.ensure_future(handle.ready.remote()),
+        }
+        self.replicas.append(replica)
+        print(f"{self} started a replica")
+        return replica
+
+    async def get_replica(self):
+        if self.eviction_task is None:
+            self.eviction_task = asyncio.ensure_future(self.evict_idle_replicas())
+
+        for replica in list(self.replicas):
+            if replica["ready"].done() and replica["ready"].exception() is not None:
+                print(f"{self} removed a replica that failed to start: {replica['ready'].exception()}")
+                self.replicas.remove(replica)
+        if not self.replicas:
+            self.start_replica()
+
+        ready = [replica for replica in self.replicas if replica["ready"].done()]
+        busy = all(replica["ongoing"] >= EMBEDDING_POOL_TARGET_ONGOING_REQUESTS for replica in ready)
+        starting = len(ready) < len(self.replicas)
+        if busy and not starting and len(self.replicas) < self.max_replicas:
+            self.start_replica()
+
+        if ready:
+            return min(ready, key=lambda replica: replica["ongoing"])
+
+        # no replica loaded yet, wait for the first one
+        await asyncio.wait([replica["ready"] for replica in self.replicas], return_when=asyncio.FIRST_COMPLETED)
+        return await self.get_replica()
+
+    async def call(self, method: str, *args, **kwargs):
+        replica = await self.get_replica()
+        replica["ongoing"] += 1
+        try:
+            return await getattr(replica["handle"], method).remote(*args, **kwargs)
+        finally:
+            replica["ongoing"] -= 1
+            replica["last_used"] = time.monotonic()
+
+    async def encode(self, queries: List[str], batch_size: int = -1):
+        return await self.call("encode", queries, batch_size=batch_size)
+
+    async def build_embeddings(self, contents: List[str], batch_size: int = 1, prefix: str = "passage: ", max_tokens_per_batch: int = None):
+        return await self.call(
+            "build_embeddings", contents, batch_size=batch_size, prefix=prefix, max_tokens_per_batch=max_tokens_per_batch
+        )
+
+    async def evict_idle_replicas(self):
+        while True:
+            await asyncio.sleep(EMBEDDING_POOL_EVICTION_INTERVAL_S)
+            now = time.monotonic()
+            for replica in list(self.replicas):
+                if replica["ongoing"] == 0 and now - replica["last_used"] > self.idle_timeout_s:
+                    self.replicas.remove(replica)
+                    ray.kill(replica["handle"])
+                    print(f"{self} evicted an idle replica")
+
+
+def get_embedding_model_pool(model_name: str, device: str = 'cpu'):
+    """
+    Returns the named, detached EmbeddingModelPool of the (model_name, device) pair, creating it if needed.
+    """
+    name = f"embedding_model_pool_{model_name}_{device}".replace("/", "_")
+    return EmbeddingModelPool.options(name=name, lifetime="detached", get_if_exists=True).remote(model_name, device)
+
+
+class PooledEmbeddingModel:
+    """
+    Drop-in replacement for an embedding model (E5Model) that runs on the embedding model pool.
+    """
+    def __init__(self, model_name: str, use_cpu: bool = False):
+        self.pool = get_embedding_model_pool(model_name, 'cpu' if use_cpu else 'cuda')
+
+    def encode(self, queries: List[str], batch_size: int = -1, disable_progress_bar: bool = False):
+        return ray.get(self.pool.encode.remote(queries, batch_size=batch_size))
+
+    def build_embeddings(
+        self,
+        contents: List[str] = None,
+        batch_size: int = 1,
+        prefix: str = "passage: ",
+        disable_progress_bar: bool = False,
+        max_tokens_per_batch: int = None,
+    ):
+        return ray.get(self.pool.build_embeddings.remote(
+            contents, batch_size=batch_size, prefix=prefix, max_tokens_per_batch=max_tokens_per_batch
+        ))
@@ -2,9 +2,11 @@ import gc
 import json
 import os
 from logging import getLogger
+from uuid import uuid4
 
 import pandas as pd
 import ray
+from ray import serve
 from django.db.models import F
 
 from back.apps.language_model.models.enums import (
@@ -14,29 +16,26 @@ from back.apps.language_model.models.enums import (
 
 from back.apps.language_model.ray_deployments import launch_rag_deployment
 from .colbert_actor import ColBERTActor
+from .util_tasks import INDEX_CHECKSUMS_SUFFIX
+from .embedding_actors import get_embedding_model_pool
 
 logger = getLogger(__name__)
 
-
-@ray.remote(num_cpus=1, resources={"tasks": 1})
-def generate_embeddings_task(data):
-
-    from chat_rag.inf_retrieval.embedding_models import E5Model
-
-    embedding_model = E5Model(
-        model_name=data["model_name"],
-        use_cpu=data["device"] == "cpu",
-        huggingface_key=os.environ.get("HUGGINGFACE_API_KEY", None),
-    )
-
-    embeddings = embedding_model.build_embeddings(
-        contents=data["contents"], batch_size=data["batch_size"]
-    )
-
-    # from tensor to list
-    embeddings = [embedding.tolist() for embedding in embeddings]
-
-    return embeddings
+# Number of k items encoded by each embeddings task
+EMBEDDINGS_CHUNK_SIZE = 1024
+# Number of embeddings tasks submitted at the same time
+EMBEDDINGS_MAX_IN_FLIGHT = 4
+# Number of rows per INSERT when writing the embeddings
+EMBEDDINGS_BULK_CREATE_BATCH_SIZE = 256
+# Prefix of the E5 models for the indexed passages
+EMBEDDINGS_PREFIX = "passage: "
+# The token budget of a batch is batch_size full length inputs, the same peak memory as before,
+# but the batches of short contents hold more of them
+EMBEDDINGS_MAX_INPUT_TOKENS = 512
+# The ColBERT index changes are written as delta segments until they hold more k items than this fraction
+# of the base index or there are more segments than this, then they are compacted into a new base index
+COLBERT_COMPACTION_RATIO = float(os.environ.get('COLBERT_COMPACTION_RATIO', 0.1))
+COLBERT_MAX_INDEX_SEGMENTS = int(os.environ.get('COLBERT_MAX_INDEX_SEGMENTS', 10))
 
 
 def get_modified_k_items_ids(rag_config):
@@ -63,55 +62,127 @@ def get_modified_k_items_ids(rag_config):
     return modified_k_item_ids
 
 
-def generate_embeddings(k_items, rag_config):
+def generate_embeddings(k_items, rag_config, chunk_size=EMBEDDINGS_CHUNK_SIZE, max_in_flight=EMBEDDINGS_MAX_IN_FLIGHT):
     """
     Generate the embeddings for a knowledge base.
+    The k items are read in chunks and encoded by the embedding model pool, up to max_in_flight chunks at a time,
+    so the embeddings of a finished chunk are written to the database while the next ones are still being encoded.
+    The contents already encoded with the same model, for instance after re-parsing a data source, are taken from
+    the EmbeddingCache instead of being encoded again, and the cache entries unused for a while are pruned at the end.
+    The progress is reported on a RayTaskState.
     Parameters
     ----------
-    ki_ids : list
-        A list of primary keys of the KnowledgeItem objects.
-    ragconfig_id : int
-        The primary key of the RAGConfig object.
+    k_items : QuerySet
+        The KnowledgeItem objects to generate the embeddings for.
+    rag_config : RAGConfig
+        The RAGConfig object.
+    chunk_size : int
+        Number of k items encoded by each task.
+    max_in_flight : int
+        Maximum number of chunks submitted to the Ray cluster at the same time.
     """
-    from back.apps.language_model.models import Embedding
+    from back.apps.language_model.models import Embedding, EmbeddingCache, RayTaskState
 
     model_name = rag_config.retriever_config.model_name
     batch_size = rag_config.retriever_config.batch_size
     device = rag_config.retriever_config.get_device().value
+    total = k_items.count()
     logger.info(
-        f"Generating embeddings for {k_items.count()} knowledge items. Knowledge base: {rag_config.knowledge_base.name}"
+        f"Generating embeddings for {total} knowledge items. Knowledge base: {rag_config.knowledge_base.name}"
     )
     logger.info(f"Retriever model: {model_name}")
     logger.info(f"Batch size: {batch_size}")
     logger.info(f"Device: {device}")
+    logger.info(f"Chunk size: {chunk_size}, max chunks in flight: {max_in_flight}")
 
-    contents = [item.content for item in k_items]
-    data = {
-        "model_name": model_name,
-        "device": device,
-        "contents": contents,
-        "batch_size": batch_size,
-    }
-
-    # Submit the task to the Ray cluster
-    num_gpus = 1 if device == "cuda" else 0
     task_name = f"generate_embeddings_{rag_config.name}"
-    embeddings_ref = generate_embeddings_task.options(resources={"tasks": 1}, num_gpus=num_gpus, name=task_name).remote(data)
-    embeddings = ray.get(embeddings_ref)
+    task_state = RayTaskState.objects.create(
+        task_id=str(uuid4()),
+        name=task_name,
+        type="EMBEDDINGS_TASK",
+        func_or_class_name="EmbeddingModelPool.build_embeddings",
+        state=RayTaskState.STATE_CHOICES_DICT["RUNNING"],
+        progress=0.0,
+    )
 
-    new_embeddings = [
-        Embedding(
-            knowledge_item=item,
-            rag_config=rag_config,
-            embedding=embedding,
+    pool = get_embedding_model_pool(model_name, device)
+    pending = {}  # object ref -> k item ids and content hashes of the chunk
+    last_pk, n_done, n_cached = 0, 0, 0
+
+    def save_embeddings(k_item_ids, embeddings):
+        nonlocal n_done
+        Embedding.objects.bulk_create(
+            [
+                Embedding(
+                    knowledge_item_id=k_item_id,
+                    rag_config=rag_config,
+                    embedding=embedding,
+                )
+                for k_item_id, embedding in zip(k_item_ids, embeddings)
+            ],
+            batch_size=EMBEDDINGS_BULK_CREATE_BATCH_SIZE,
         )
-        for item, embedding in zip(k_items, embeddings)
-    ]
-    Embedding.objects.bulk_create(new_embeddings)
+        n_done += len(k_item_ids)
+        task_state.progress = n_done / total if total else 1.0
+        task_state.save(update_fields=["progress"])
+        logger.info(f"Embeddings generated for {n_done}/{total} knowledge items ({n_cached} from the cache)")
+
+    try:
+        while True:
+            # keep the pool busy with the next chunks, keyset pagination so the chunks are read lazily
+            while len(pending) < max_in_flight:
+                rows = list(
+                    k_items.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "content")[:chunk_size]
+                )
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+
+                # only the contents never encoded with this model are sent to the pool
+                content_hashes = [EmbeddingCache.hash_content(row[1], EMBEDDINGS_PREFIX) for row in rows]
+                cached = EmbeddingCache.get_embeddings(model_name, content_hashes)
+                hits = [(row[0], cached[content_hash]) for row, content_hash in zip(rows, content_hashes) if content_hash in cached]
+                misses = [(row, content_hash) for row, content_hash in zip(rows, content_hashes) if content_hash not in cached]
+                if hits:
+                    n_cached += len(hits)
+                    save_embeddings([hit[0] for hit in hits], [hit[1] for hit in hits])
+                if misses:
+                    embeddings_ref = pool.build_embeddings.remote(
+                        [row[1] for row, _ in misses],
+                        batch_size=-1,
+                        prefix=EMBEDDINGS_PREFIX,
+                        max_tokens_per_batch=batch_size * EMBEDDINGS_MAX_INPUT_TOKENS,
+                    )
+                    pending[embeddings_ref] = ([row[0] for row, _ in misses], [content_hash for _, content_hash in misses])
+
+            if not pending:
+                break
+
+            ready, _ = ray.wait(list(pending), num_returns=1)
+            k_item_ids, content_hashes = pending.pop(ready[0])
+            embeddings = ray.get(ready[0])
+
+            EmbeddingCache.store(model_name, content_hashes, embeddings)
+            save_embeddings(k_item_ids, embeddings)
+    except Exception as e:
+        for embeddings_ref in pending:
+            ray.cancel(embeddings_ref)
+        task_state.state = RayTaskState.STATE_CHOICES_DICT["FAILED"]
+        task_state.error_message = str(e)[:255]
+        task_state.save(update_fields=["state", "error_message"])
+        raise
+
+    task_state.state = RayTaskState.STATE_CHOICES_DICT["FINISHED"]
+    task_state.progress = 1.0
+    task_state.save(update_fields=["state", "progress"])
     logger.info(
         f"Embeddings generated for knowledge base: {rag_config.knowledge_base.name}"
     )
 
+    n_pruned = EmbeddingCache.prune()
+    if n_pruned:
+        logger.info(f"Pruned {n_pruned} unused entries from the embedding cache")
+
 
 def index_e5(rag_config):
     """
@@ -139,6 +210,9 @@ def index_e5(rag_config):
 
     generate_embeddings(k_items=k_items, rag_config=rag_config)
 
+    # create or update the ANN index over the embeddings
+    rag_config.build_vector_index()
+
 
 def get_indexed_k_items_ids(s3_index_path):
 
@@ -203,116 +277,232 @@ def get_indexed_k_items_ids(s3_index_path):
     return indexed_k_item_ids
 
 
-def modify_index(rag_config):
+def get_k_items_changes(rag_config, owners):
     """
-    Modify the index for a knowledge base. It removes, modifies and adds the k items to an existing index.
+    Get the k items to remove from and to add to the index of a RAG config. Modified k items are in both.
+    The embeddings of the k items to remove are deleted, the embeddings track which k items are indexed.
     Parameters
     ----------
-    rag_config_id : int
-        The primary key of the RAGConfig object.
+    rag_config : RAGConfig
+        The RAGConfig object.
+    owners : dict
+        The indexed k item ids and the segment that holds each of them.
+    Returns
+    -------
+    k_item_ids_to_remove : set
+        The ids of the k items to remove.
+    k_items_to_add : QuerySet
+        The k items to add.
     """
-    from django.conf import settings
-    from back.apps.language_model.ray_deployments.colbert_deployment import construct_index_path
     from back.apps.language_model.models import Embedding, KnowledgeItem
 
-    s3_index_path = rag_config.s3_index_path
-    index_path = construct_index_path(rag_config.s3_index_path)
-    bsize = rag_config.retriever_config.batch_size
-    device = rag_config.retriever_config.get_device().value
-    num_gpus = 1 if device == "cuda" else 0
-    storages_mode = settings.STORAGES_MODE
-    actor_name = f"modify_colbert_index_{rag_config.name}"
+    current_k_item_ids = KnowledgeItem.objects.filter(
+        knowledge_base=rag_config.knowledge_base
+    ).values_list("pk", flat=True)
 
-    logger.info(f"Index path: {index_path}")
-    logger.info(f"Bsize: {bsize}, Device: {device}, Num GPUs: {num_gpus}, Storages Mode: {storages_mode}")
+    logger.info(f"Number of current k items: {len(current_k_item_ids)}")
 
-    colbert = ColBERTActor.options(num_gpus=num_gpus, name=actor_name).remote(index_path, device=device, storages_mode=storages_mode)
+    # Current indexed k items - k items in the database = k items to remove
+    k_item_ids_to_remove = set(owners) - set(current_k_item_ids)
 
-    try:
-        save_index = False
+    logger.info(f"Number of k items to remove: {len(k_item_ids_to_remove)}")
+
+    # modified k items need to be removed from the index also
+    modified_k_item_ids = get_modified_k_items_ids(rag_config)
+
+    logger.info(f"Number of modified k items: {len(modified_k_item_ids)}")
+
+    # add the modified k items to the k items to remove
+    k_item_ids_to_remove = k_item_ids_to_remove.union(modified_k_item_ids)
 
-        # k items to remove
-        current_k_item_ids = KnowledgeItem.objects.filter(
-            knowledge_base=rag_config.knowledge_base
-        ).values_list("pk", flat=True)
+    logger.info(f"Number of k items to remove after adding modified k items: {len(k_item_ids_to_remove)}")
 
-        indexed_k_item_ids = get_indexed_k_items_ids(s3_index_path)
+    # remove the embeddings with the given ids
+    Embedding.objects.filter(rag_config=rag_config, knowledge_item__pk__in=k_item_ids_to_remove).delete()
 
-        logger.info(f"Number of current k items: {len(current_k_item_ids)}")
+    # get the k items that have no associated embeddings
+    k_items_to_add = KnowledgeItem.objects.filter(
+        knowledge_base=rag_config.knowledge_base
+    ).exclude(embedding__rag_config=rag_config)
 
-        # Current indexed k items - k items in the database = k items to remove
-        k_item_ids_to_remove = set(indexed_k_item_ids) - set(current_k_item_ids)
+    logger.info(f"Number of k items to add: {len(k_items_to_add)}")
 
-        logger.info(f"Number of k items to remove: {len(k_item_ids_to_remove)}")
+    return k_item_ids_to_remove, k_items_to_add
 
-        # modified k items need to be removed from the index also
-        modified_k_item_ids = get_modified_k_items_ids(rag_config)
 
-        logger.info(f"Number of modified k items: {len(modified_k_item_ids)}")
+def create_empty_embeddings(rag_config, k_items):
+    """
+    Create an empty embedding for each knowledge item for the given rag config for tracking which items are indexed.
+    """
+    from back.apps.language_model.models import Embedding
 
-        # add the modified k items to the k items to remove
-        k_item_ids_to_remove = k_item_ids_to_remove.union(modified_k_item_ids)
+    embeddings = [
+        Embedding(
+            knowledge_item=item,
+            rag_config=rag_config,
+        )
+        for item in k_items
+    ]
+    Embedding.objects.bulk_create(embeddings)
 
-        logger.info(f"Number of k items to remove after adding modified k items: {len(k_item_ids_to_remove)}")
 
-        # ids to string
-        k_item_ids_to_remove = [str(id) for id in k_item_ids_to_remove]
+def add_index_segment(rag_config, k_item_ids_to_remove, k_items_to_add):
+    """
+    Writes the changes of the index as a new delta segment instead of rewriting the whole index.
+    Only the new k items are encoded and uploaded, the removed ones are recorded in the segment manifest.
+    """
+    from django.conf import settings
+    from back.apps.language_model.ray_deployments.colbert_deployment import construct_index_path, construct_segments_path
 
-        if k_item_ids_to_remove:
-            logger.info("Removing from the index...")
-            delete_task_ref = colbert.delete_from_index.remote(k_item_ids_to_remove)
-            logger.info("Deleted from the index.")
+    segment_name = uuid4().hex[:8]
+    segment = {
+        "name": segment_name,
+        "k_item_ids": [item.pk for item in k_items_to_add],
+        "deleted_k_item_ids": sorted(k_item_ids_to_remove),
+    }
 
-            save_index = True
+    if k_items_to_add:
+        device = rag_config.retriever_config.get_device().value
+        num_gpus = 1 if device == "cuda" else 0
+        actor_name = f"encode_colbert_segment_{rag_config.name}"
+        colbert = ColBERTActor.options(num_gpus=num_gpus, name=actor_name).remote(
+            construct_index_path(rag_config.s3_index_path),
+            device=device,
+            colbert_name=rag_config.retriever_config.model_name,
+            storages_mode=settings.STORAGES_MODE,
+        )
+        try:
+            ray.get(colbert.encode_segment.remote(
+                [item.content for item in k_items_to_add],
+                [str(item.pk) for item in k_items_to_add],
+                os.path.join(construct_segments_path(rag_config.s3_index_path), segment_name),
+                rag_config.retriever_config.batch_size,
+            ))
+        finally:
+            colbert.exit.remote()
 
-            # remove the embeddings with the given ids
-            Embedding.objects.filter(knowledge_item__pk__in=k_item_ids_to_remove).delete()
+        create_empty_embeddings(rag_config, k_items_to_add)
 
-        # get the k items that have no associated embeddings
-        k_items = KnowledgeItem.objects.filter(
-            knowledge_base=rag_config.knowledge_base
-        ).exclude(embedding__rag_config=rag_config)
+    # the deployments poll the segments of the rag config and load the new one
+    rag_config.index_segments = rag_config.index_segments + [segment]
+    rag_config.save()
 
-        logger.info(f"Number of k items to add: {len(k_items)}")
+    logger.info(f"Index segment {segment_name} added with {len(segment['k_item_ids'])} k items and {len(segment['deleted_k_item_ids'])} deletions")
 
-        contents_to_add = [item.content for item in k_items]
-        contents_pk_to_add = [str(item.pk) for item in k_items]
 
-        if k_items:
-            add_task_ref = colbert.add_to_index.remote(contents_to_add, contents_pk_to_add, bsize)
+def compact_index(rag_config, owners, k_item_ids_to_remove, k_items_to_add):
+    """
+    Merges the delta segments and the new changes into a new base index, deleting and adding the k items
+    to the existing PLAID index and saving it to a new path.
+    """
+    from django.conf import settings
+    from back.apps.language_model.ray_deployments.colbert_deployment import construct_index_path
+    from back.apps.language_model.models import KnowledgeItem
 
-            # create an empty embedding for each knowledge item for the given rag config for tracking which items are indexed
-            embeddings = [
-                Embedding(
-                    knowledge_item=item,
-                    rag_config=rag_config,
-                )
-                for item in k_items
-            ]
-            Embedding.objects.bulk_create(embeddings)
+    s3_index_path = rag_config.s3_index_path
+    index_path = construct_index_path(s3_index_path)
+    bsize = rag_config.retriever_config.batch_size
+    device = rag_config.retriever_config.get_device().value
+    num_gpus = 1 if device == "cuda" else 0
+    storages_mode = settings.STORAGES_MODE
+    actor_name = f"modify_colbert_index_{rag_config.name}"
 
-        # wait for the tasks to finish to catch any exceptions
-        ray.get([delete_task_ref, add_task_ref])
+    logger.info(f"Index path: {index_path}")
+    logger.info(f"Bsize: {bsize}, Device: {device}, Num GPUs: {num_gpus}, Storages Mode: {storages_mode}")
 
-        if save_index:
+    # the base passages of the k items removed or moved to a segment are deleted, the k items of the segments are re-added
+    base_k_item_ids_to_remove = [
+        str(k_item_id) for k_item_id in get_indexed_k_items_ids(s3_index_path)
+        if owners.get(k_item_id) != 0 or k_item_id in k_item_ids_to_remove
+    ]
+    segment_k_item_ids = [
+        k_item_id for k_item_id, owner in owners.items() if owner > 0 and k_item_id not in k_item_ids_to_remove
+    ]
+    k_items = list(KnowledgeItem.objects.filter(pk__in=segment_k_item_ids)) + list(k_items_to_add)
 
-            new_s3_index_path = rag_config.generate_s3_index_path()
-            logger.info(f"New index path: {new_s3_index_path}")
+    colbert = ColBERTActor.options(num_gpus=num_gpus, name=actor_name).remote(index_path, device=device, storages_mode=storages_mode)
 
-            # Now we save the index only once after all modifications
-            index_saved = ray.get(colbert.save_index.remote(
-                construct_index_path(new_s3_index_path)
+    try:
+        task_refs = []
+        if base_k_item_ids_to_remove:
+            logger.info(f"Removing {len(base_k_item_ids_to_remove)} k items from the index...")
+            task_refs.append(colbert.delete_from_index.remote(base_k_item_ids_to_remove))
+        if k_items:
+            logger.info(f"Adding {len(k_items)} k items to the index...")
+            task_refs.append(colbert.add_to_index.remote(
+                [item.content for item in k_items], [str(item.pk) for item in k_items], bsize
             ))
-            rag_config.s3_index_path = new_s3_index_path
-            rag_config.save()
+        # wait for the tasks to finish to catch any exceptions
+        ray.get(task_refs)
 
-            # delete the old index files
-            task_name = f"delete_index_files_{rag_config.name}"
-            print(f"Submitting the {task_name} task to the Ray cluster...")
-            delete_index_files.options(name=task_name).remote(s3_index_path)
+        new_s3_index_path = rag_config.generate_s3_index_path()
+        logger.info(f"New index path: {new_s3_index_path}")
 
+        # Now we save the index only once after all modifications
+        index_saved = ray.get(colbert.save_index.remote(
+            construct_index_path(new_s3_index_path)
+        ))
         if not index_saved:
             raise Exception("Failed to save index.")
+    finally:
+        colbert.exit.remote()
+
+    create_empty_embeddings(rag_config, k_items_to_add)
+
+    rag_config.s3_index_path = new_s3_index_path
+    rag_config.index_segments = []
+    rag_config.save()
+
+    # delete the old index and segments files
+    task_name = f"delete_index_files_{rag_config.name}"
+    print(f"Submitting the {task_name} task to the Ray cluster...")
+    delete_index_files.options(name=task_name).remote(s3_index_path)
+
+
+def modify_index(rag_config):
+    """
+    Modify the index for a knowledge base. It removes, modifies and adds the k items to an existing index.
+    Small changes are written as a delta segment that the deployments load without a restart, the segments are
+    compacted into a new base index when they hold too many k items compared to it or there are too many of them.
+    Parameters
+    ----------
+    rag_config_id : int
+        The primary key of the RAGConfig object.
+    Returns
+    -------
+    bool
+        Whether the changes were added as a segment, so the running deployments pick them up without a relaunch.
+    """
+    from back.apps.language_model.models import Embedding
+    from back.apps.language_model.ray_deployments.colbert_deployment import index_owners
+
+    try:
+        base_k_item_ids = get_indexed_k_items_ids(rag_config.s3_index_path)
+        owners = index_owners(base_k_item_ids, rag_config.index_segments)
+
+        k_item_ids_to_remove, k_items_to_add = get_k_items_changes(rag_config, owners)
+        if not k_item_ids_to_remove and not k_items_to_add:
+            logger.info("The index is up to date.")
+            return False
+
+        n_segment_k_items = sum(1 for owner in owners.values() if owner > 0) + len(k_items_to_add)
+        # the deployments search past the base passages of the deleted and updated k items, so they also count
+        n_hidden_base_k_items = sum(
+            1 for k_item_id in base_k_item_ids if owners.get(k_item_id) != 0 or k_item_id in k_item_ids_to_remove
+        )
+        compact = (
+            len(rag_config.index_segments) + 1 > COLBERT_MAX_INDEX_SEGMENTS
+            or n_segment_k_items > COLBERT_COMPACTION_RATIO * len(base_k_item_ids)
+            or n_hidden_base_k_items > COLBERT_COMPACTION_RATIO * len(base_k_item_ids)
+        )
+
+        if compact:
+            logger.info(f"Compacting {len(rag_config.index_segments)} segments into a new base index...")
+            compact_index(rag_config, owners, k_item_ids_to_remove, k_items_to_add)
+            return False
+
+        add_index_segment(rag_config, k_item_ids_to_remove, k_items_to_add)
+        return True
 
     except Exception as e:
         logger.error(f"Error modifying index: {e}")
@@ -320,6 +510,7 @@ def modify_index(rag_config):
         Embedding.objects.filter(rag_config=rag_config).delete()
         # indexing starting from scratch
         creates_index(rag_config=rag_config)
+        return False
 
 
 def creates_index(rag_config):
@@ -381,6 +572,7 @@ def creates_index(rag_config):
 
         # save s3 index path
         rag_config.s3_index_path = s3_index_path
+        rag_config.index_segments = []
         rag_config.save()
 
     else:
@@ -394,6 +586,10 @@ def index_colbert(rag_config):
     ----------
     rag_config_id : int
         The primary key of the RAGConfig object.
+    Returns
+    -------
+    bool
+        Whether the changes were added as a segment, so the running deployments pick them up without a relaunch.
     """
 
     from back.apps.language_model.models import Embedding
@@ -401,10 +597,10 @@ def index_colbert(rag_config):
     if Embedding.objects.filter(
         rag_config=rag_config
     ).exists():  # if there are embeddings for the given rag config
-        modify_index(rag_config)
+        return modify_index(rag_config)
 
-    else:
-        creates_index(rag_config=rag_config)
+    creates_index(rag_config=rag_config)
+    return False
 
 
 @ray.remote(num_cpus=0.2, resources={"tasks": 1})
@@ -418,9 +614,12 @@ def delete_index_files(s3_index_path):
     """
     from django.conf import settings
     from back.config.storage_backends import select_private_storage
+    from back.apps.language_model.ray_deployments.colbert_deployment import construct_segments_path
+    from back.apps.language_model.tasks import delete_index_segments
     import shutil
 
     if s3_index_path:
+        delete_index_segments(construct_segments_path(s3_index_path), settings.STORAGES_MODE)
 
         if settings.LOCAL_STORAGE:
             index_root, index_name = os.path.split(s3_index_path)
@@ -439,6 +638,7 @@ def delete_index_files(s3_index_path):
                 file_path = os.path.join(s3_index_path, file)
                 # Delete the file from S3
                 private_storage.delete(file_path)
+            private_storage.delete(f"{s3_index_path}{INDEX_CHECKSUMS_SUFFIX}")
 
             logger.info(f"Index files deleted from S3: {s3_index_path}")
 
@@ -470,16 +670,25 @@ def index_task(rag_config_id, launch_rag_deploy: bool = False):
         print(f"Submitting the {task_name} task to the Ray cluster...")
         delete_index_files.options(name=task_name).remote(rag_config.s3_index_path)
 
-    if retriever_type == RetrieverTypeChoices.E5:
+    segment_added = False
+    if retriever_type in (RetrieverTypeChoices.E5, RetrieverTypeChoices.HYBRID):
+        # the hybrid retriever builds its BM25 index from the same contents when deployed
         index_e5(rag_config)
     elif retriever_type == RetrieverTypeChoices.COLBERT:
-        index_colbert(rag_config)
+        # leftover ANN indexes from a previous E5 retriever
+        rag_config.drop_vector_index()
+        segment_added = index_colbert(rag_config)
 
     rag_config.index_status = IndexStatusChoices.UP_TO_DATE
     rag_config.save()
 
     logger.info(f"Index built for knowledge base: {rag_config.knowledge_base.name}")
 
+    # the running ColBERT deployments load new index segments by themselves
+    if segment_added and rag_config.get_deploy_name() in serve.status().applications:
+        logger.info(f"Index segment added, the running deployment {rag_config.get_deploy_name()} loads it without a relaunch")
+        launch_rag_deploy = False
+
     # launch rag
     if launch_rag_deploy:
         task_name = f"launch_rag_deployment_{rag_config.name}"
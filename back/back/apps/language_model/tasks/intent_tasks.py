@@ -76,9 +76,9 @@ def get_similarity_scores(titles, rag_config_id, e5_model_args, batch_size):
     def retrieve(queries, rag_config_id, e5_model_args, batch_size, top_k=1):
         import requests
         import os
-        from chat_rag.inf_retrieval.embedding_models import E5Model
+        from back.apps.language_model.tasks.embedding_actors import PooledEmbeddingModel
 
-        e5_model = E5Model(**e5_model_args, huggingface_key=os.environ.get("HUGGINGFACE_API_KEY", None))
+        e5_model = PooledEmbeddingModel(**e5_model_args)
 
         embeddings = e5_model.build_embeddings(queries, prefix='query: ', batch_size=batch_size)
 
@@ -104,10 +104,10 @@ def get_similarity_scores(titles, rag_config_id, e5_model_args, batch_size):
 @ray.remote(num_cpus=1, resources={"tasks": 1})
 def clusterize_queries(queries, e5_model_args, batch_size):
 
-    from chat_rag.inf_retrieval.embedding_models import E5Model
     from chat_rag.intent_detection import clusterize_text
+    from back.apps.language_model.tasks.embedding_actors import PooledEmbeddingModel
 
-    e5_model = E5Model(**e5_model_args, huggingface_key=os.environ.get("HUGGINGFACE_API_KEY", None))
+    e5_model = PooledEmbeddingModel(**e5_model_args)
 
     print("Clusterizing queries...")
     labels = clusterize_text(
@@ -155,8 +155,8 @@ def generate_suggested_intents_task(knowledge_base_pk, _generate_titles=False):
         return
     lang = rag_conf.knowledge_base.get_lang().value
 
-    # if the retriever type is not e5, then return
-    if rag_conf.retriever_config.get_retriever_type() != RetrieverTypeChoices.E5:
+    # if the retriever type does not use e5 embeddings, then return
+    if rag_conf.retriever_config.get_retriever_type() not in (RetrieverTypeChoices.E5, RetrieverTypeChoices.HYBRID):
         print(f"Intent generation is not supported for retriever type: {rag_conf.retriever_config.get_retriever_type().value} right now")
         return
 
@@ -286,8 +286,8 @@ def generate_intents_task(knowledge_base_pk, _generate_titles=False):
         print(f"No RAG config found for knowledge base: {knowledge_base_pk}")
         return
 
-    # if the retriever type is not e5, then return
-    if rag_conf.retriever_config.get_retriever_type() != RetrieverTypeChoices.E5:
+    # if the retriever type does not use e5 embeddings, then return
+    if rag_conf.retriever_config.get_retriever_type() not in (RetrieverTypeChoices.E5, RetrieverTypeChoices.HYBRID):
         print(f"Intent generation is not supported for retriever type: {rag_conf.retriever_config.get_retriever_type().value} right now")
         return
 
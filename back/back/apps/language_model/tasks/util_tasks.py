@@ -1,4 +1,7 @@
 import os
+import time
+import hashlib
+from contextlib import contextmanager
 
 import ray
 
@@ -6,6 +9,18 @@ from logging import getLogger
 
 logger = getLogger(__name__)
 
+# Node local cache of the indexes downloaded from object storage, every index path is immutable so it is the cache key
+INDEX_CACHE_DIR = os.environ.get('COLBERT_INDEX_CACHE_DIR', os.path.join('back', 'indexes', 'cache'))
+# Number of cached indexes kept per node, the most recently used ones
+INDEX_CACHE_KEEP = int(os.environ.get('COLBERT_INDEX_CACHE_KEEP', 2))
+# Cached indexes used within this time are never removed, a replica may be about to load them
+INDEX_CACHE_MIN_IDLE_S = int(os.environ.get('COLBERT_INDEX_CACHE_MIN_IDLE_S', 600))
+# Size of the ranged reads of the index download and how many run at the same time
+INDEX_DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+INDEX_DOWNLOAD_CONCURRENCY = int(os.environ.get('COLBERT_INDEX_DOWNLOAD_CONCURRENCY', 16))
+# The checksums of the index files are written next to the index folder, not inside it, as it only holds parquet files
+INDEX_CHECKSUMS_SUFFIX = '_checksums.json'
+
 @ray.remote(num_cpus=0.001)
 def get_filesystem(storages_mode):
     """
@@ -34,68 +49,329 @@ def get_filesystem(storages_mode):
     return None
 
 
+def get_pyarrow_filesystem(path, storages_mode):
+    """
+    Returns the pyarrow filesystem of an object storage path and the path inside it.
+    """
+    from pyarrow import fs
+
+    filesystem = ray.get(get_filesystem.remote(storages_mode))
+    if filesystem is not None:
+        return filesystem.unwrap(), path.split('s3://')[1]
+    return fs.FileSystem.from_uri(path)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def index_checksums(local_index_path):
+    """
+    Returns the sha256 of every file of a local index.
+    """
+    return {
+        name: file_sha256(os.path.join(local_index_path, name))
+        for name in os.listdir(local_index_path)
+        if os.path.isfile(os.path.join(local_index_path, name))
+    }
+
+
+def write_index_checksums(checksums, index_path, storages_mode):
+    """
+    Writes the checksums of the files of an index, after the index itself, so the downloads can verify them.
+    """
+    import json
+
+    if 's3://' not in index_path:
+        return
+    filesystem, remote_path = get_pyarrow_filesystem(index_path + INDEX_CHECKSUMS_SUFFIX, storages_mode)
+    with filesystem.open_output_stream(remote_path) as f:
+        f.write(json.dumps(checksums).encode("utf-8"))
+
+
+def read_index_checksums(filesystem, remote_index_path):
+    """
+    Returns the checksums of the files of an index or None for the indexes saved without them.
+    """
+    import json
+
+    try:
+        with filesystem.open_input_stream(remote_index_path + INDEX_CHECKSUMS_SUFFIX) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def download_files(filesystem, files, download_dir):
+    """
+    Downloads the files with parallel ranged reads. Every file is written to a `.part` file and its finished chunks
+    are listed in a `.chunks` file, so an interrupted download resumes from the chunks it already has.
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    downloads, chunks = [], []
+    try:
+        for file in files:
+            local_path = os.path.join(download_dir, os.path.basename(file.path))
+            if os.path.exists(local_path):
+                continue
+            part_path, chunks_path = f"{local_path}.part", f"{local_path}.chunks"
+
+            done = set()
+            if os.path.exists(part_path) and os.path.exists(chunks_path):
+                with open(chunks_path) as f:
+                    done = {int(line) for line in f if line.strip()}
+
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+            os.ftruncate(fd, file.size)
+            # a single remote file per file, its ranged reads are thread safe
+            remote_file = filesystem.open_input_file(file.path)
+            downloads.append((fd, open(chunks_path, "a" if done else "w"), local_path, remote_file))
+            chunks.extend(
+                (file, offset, len(downloads) - 1)
+                for offset in range(0, file.size, INDEX_DOWNLOAD_CHUNK_SIZE)
+                if offset not in done
+            )
+
+        lock = threading.Lock()
+
+        def download_chunk(chunk):
+            file, offset, ndx = chunk
+            fd, chunks_file, _, remote_file = downloads[ndx]
+            data = remote_file.read_at(min(INDEX_DOWNLOAD_CHUNK_SIZE, file.size - offset), offset)
+            os.pwrite(fd, data, offset)
+            with lock:
+                chunks_file.write(f"{offset}\n")
+                chunks_file.flush()
+
+        print(f"Downloading {len(chunks)} chunks of {len(downloads)} files")
+        with ThreadPoolExecutor(max_workers=INDEX_DOWNLOAD_CONCURRENCY) as executor:
+            list(executor.map(download_chunk, chunks))
+
+        for fd, chunks_file, local_path, _ in downloads:
+            os.fsync(fd)
+            os.replace(f"{local_path}.part", local_path)
+            os.remove(chunks_file.name)
+    finally:
+        for fd, chunks_file, _, remote_file in downloads:
+            os.close(fd)
+            chunks_file.close()
+            remote_file.close()
+
+
+def extract_index(download_dir, index_dir, checksums=None):
+    """
+    Writes the index files stored in the rows of the downloaded parquet files and verifies their checksums.
+    """
+    import shutil
+    import pyarrow.parquet as pq
+
+    tmp_dir = f"{index_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    for name in sorted(os.listdir(download_dir)):
+        parquet_file = pq.ParquetFile(os.path.join(download_dir, name))
+        # a row per index file, one at a time as they can be large
+        for batch in parquet_file.iter_batches(batch_size=1, columns=["bytes", "path"]):
+            for content, file_path in zip(batch.column("bytes").to_pylist(), batch.column("path").to_pylist()):
+                with open(os.path.join(tmp_dir, os.path.basename(file_path)), "wb") as f:
+                    f.write(content)
+
+    if checksums is not None:
+        for name, checksum in checksums.items():
+            file_path = os.path.join(tmp_dir, name)
+            if not os.path.exists(file_path) or file_sha256(file_path) != checksum:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise ValueError(f"Checksum verification failed for the index file {name}")
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+
+def index_cache_entry(index_path):
+    """
+    Returns the node cache folder of an object storage index and the path of the index inside it.
+    """
+    index_name = os.path.basename(index_path)
+    entry_dir = os.path.join(INDEX_CACHE_DIR, f"{index_name}_{hashlib.sha256(index_path.encode()).hexdigest()[:12]}")
+    # the folder structure that RAGatouille expects for an index
+    return entry_dir, os.path.join(entry_dir, "colbert", "indexes", index_name)
+
+
+@contextmanager
+def use_cached_index(index_path):
+    """
+    Holds a shared lock on the node cache entry of an object storage index while a replica loads it, so the GC of
+    the cache does not remove it, and marks it as used.
+    """
+    import fcntl
+
+    entry_dir, cached_index_path = index_cache_entry(index_path)
+    complete_path = os.path.join(entry_dir, ".complete")
+    with open(os.path.join(entry_dir, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        if not os.path.exists(complete_path):
+            raise FileNotFoundError(f"The index {index_path} is not in the node cache")
+        os.utime(complete_path)
+        try:
+            yield cached_index_path
+        finally:
+            os.utime(complete_path)
+
+
+def gc_index_cache(current_entry):
+    """
+    Removes the least recently used indexes of the node cache, keeping the INDEX_CACHE_KEEP most recent ones.
+    The indexes used within INDEX_CACHE_MIN_IDLE_S or locked by a replica that is loading them are kept.
+    The replicas that loaded a removed index keep working, they hold it in memory.
+    """
+    import fcntl
+    import shutil
+
+    entries = []
+    for name in os.listdir(INDEX_CACHE_DIR):
+        complete_path = os.path.join(INDEX_CACHE_DIR, name, '.complete')
+        if os.path.exists(complete_path):
+            entries.append((os.path.getmtime(complete_path), os.path.join(INDEX_CACHE_DIR, name)))
+
+    entries.sort(reverse=True)
+    for used_at, entry_dir in entries[INDEX_CACHE_KEEP:]:
+        if entry_dir == current_entry or time.time() - used_at < INDEX_CACHE_MIN_IDLE_S:
+            continue
+        with open(os.path.join(entry_dir, '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # being downloaded or loaded by a replica
+                continue
+            complete_path = os.path.join(entry_dir, '.complete')
+            if not os.path.exists(complete_path) or time.time() - os.path.getmtime(complete_path) < INDEX_CACHE_MIN_IDLE_S:
+                continue  # removed or used since it was listed
+            print(f"Removing the cached index {entry_dir}")
+            os.remove(complete_path)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+
 @ray.remote(num_cpus=1)
-def read_s3_index(index_path, storages_mode):
+def read_s3_index(index_path, storages_mode, writable=False):
     """
     If the index_path is an S3 path, read the index from object storage and write it to the local storage.
+    Every index version has its own path, so the indexes are cached per node keyed by their path and only
+    downloaded once, with parallel ranged reads that resume after an interruption and verified with their checksums.
+    Parameters
+    ----------
+    index_path : str
+        The object storage path of the index.
+    storages_mode : str
+        The storages mode, for the filesystem to use.
+    writable : bool
+        Return a private copy of the index for modifying it, instead of the cached one shared by the node.
     """
-    fs_ref = get_filesystem.remote(storages_mode)
+    import fcntl
+    import shutil
+    from pyarrow.fs import FileSelector
+
+    index_name = os.path.basename(index_path)
+    entry_dir, cached_index_path = index_cache_entry(index_path)
+    complete_path = os.path.join(entry_dir, ".complete")
+    os.makedirs(entry_dir, exist_ok=True)
 
-    from tqdm import tqdm
+    with open(os.path.join(entry_dir, ".lock"), "w") as lock_file:
+        # the replicas of a node that start at the same time wait for the first one to download it
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
 
-    def write_file(row, base_path):
-        # Extract bytes and path from the row
-        content, file_path = row["bytes"], row["path"]
+        if os.path.exists(complete_path):
+            print(f"Index {index_path} found in the node cache at {cached_index_path}")
+            os.utime(complete_path)  # most recently used
+        else:
+            print(f"Reading index from {index_path}")
+            start = time.perf_counter()
+            filesystem, remote_path = get_pyarrow_filesystem(index_path, storages_mode)
+            files = [file for file in filesystem.get_file_info(FileSelector(remote_path)) if file.is_file]
 
-        file_name = os.path.basename(file_path)
+            # print total index size in GB
+            print(f"Downloading index with size: {sum(file.size for file in files) / 1e9:.3f} GB")
 
-        # Combine the base path with the original file path
-        full_path = os.path.join(base_path, file_name)
+            download_dir = os.path.join(entry_dir, "download")
+            os.makedirs(download_dir, exist_ok=True)
+            download_files(filesystem, files, download_dir)
 
-        print(f"Writing file to {full_path}")
+            try:
+                extract_index(download_dir, cached_index_path, read_index_checksums(filesystem, remote_path))
+            finally:
+                # a corrupted download is fetched again from scratch
+                shutil.rmtree(download_dir, ignore_errors=True)
 
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(complete_path, "w").close()
+            print(f"Index downloaded to {cached_index_path} in {time.perf_counter() - start:.1f}s")
 
-        # Write the file
-        with open(full_path, "wb") as file:
-            file.write(content)
+        if writable:
+            local_index_path = os.path.join("back", "indexes", "colbert", "indexes", index_name)
+            shutil.rmtree(local_index_path, ignore_errors=True)
+            shutil.copytree(cached_index_path, local_index_path)
 
-    print(f"Reading index from {index_path}")
+    gc_index_cache(entry_dir)
 
-    from pyarrow.fs import FileSelector
+    return local_index_path if writable else cached_index_path
 
-    fs = ray.get(fs_ref)
 
-    if fs is not None:
-        # unwrap the filesystem object
-        fs = fs.unwrap()
+def write_index_segment(local_path, segment_path, storages_mode):
+    """
+    Copies the files of a ColBERT index segment to its object storage or local path.
+    The segments are small, so the files are copied as they are instead of going through ray data.
+    """
+    import shutil
 
-    files = fs.get_file_info(FileSelector(index_path.split('s3://')[1]))
+    if 's3://' not in segment_path:
+        shutil.copytree(local_path, segment_path, dirs_exist_ok=True)
+        return
 
-    file_paths = [file.path for file in files]
+    filesystem, remote_path = get_pyarrow_filesystem(segment_path, storages_mode)
+    for name in os.listdir(local_path):
+        with open(os.path.join(local_path, name), "rb") as local_file, \
+                filesystem.open_output_stream(f"{remote_path}/{name}") as remote_file:
+            shutil.copyfileobj(local_file, remote_file)
 
-    # print total index size in MB
-    print(f"Downloading index with size: {sum(file.size for file in files) / 1e9:.3f} GB")
 
-    # TODO: Maybe pass the Memory resource requirement with the index size so if you have not enough memory it will not download the index
-    # If the index is too large, issue an error asking the user to increase the memory resources
-    index = ray.data.read_parquet_bulk(file_paths, filesystem=fs)
-    print(f"Downloaded {index.count()} files from S3")
+def read_index_segment(segment_path, storages_mode, local_path):
+    """
+    Downloads the files of a ColBERT index segment to local_path if it is in object storage and returns its local path.
+    """
+    import shutil
+    from pyarrow.fs import FileSelector
 
-    index_name = os.path.basename(index_path)
-    index_path = os.path.join("back", "indexes", "colbert", "indexes", index_name)
-
-    # if the directory exists, delete it
-    if os.path.exists(index_path):
-        print(f"Deleting existing index at {index_path}")
-        import shutil
-        shutil.rmtree(index_path)
-
-    print(f"Writing index to {index_path}")
-    for row in tqdm(index.iter_rows()):
-        write_file(row, index_path)
-    return index_path
+    if 's3://' not in segment_path:
+        return segment_path
+
+    filesystem, remote_path = get_pyarrow_filesystem(segment_path, storages_mode)
+    os.makedirs(local_path, exist_ok=True)
+    for file in filesystem.get_file_info(FileSelector(remote_path)):
+        with filesystem.open_input_stream(file.path) as remote_file, \
+                open(os.path.join(local_path, os.path.basename(file.path)), "wb") as local_file:
+            shutil.copyfileobj(remote_file, local_file)
+    return local_path
+
+
+def delete_index_segments(segments_path, storages_mode):
+    """
+    Deletes all the ColBERT index segments under segments_path.
+    """
+    import shutil
+
+    if 's3://' not in segments_path:
+        shutil.rmtree(segments_path, ignore_errors=True)
+        return
+
+    filesystem, remote_path = get_pyarrow_filesystem(segments_path, storages_mode)
+    try:
+        filesystem.delete_dir(remote_path)
+    except FileNotFoundError:
+        pass
 
 
 @ray.remote(num_cpus=1, resources={"tasks": 1})
@@ -1,5 +1,6 @@
 from rest_framework import viewsets, filters
 from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
 from rest_framework.decorators import action
 
 from back.apps.language_model.models.rag_pipeline import LLMConfig, RAGConfig, GenerationConfig, PromptConfig, RetrieverConfig
@@ -42,23 +43,125 @@ class RAGConfigAPIViewSet(viewsets.ModelViewSet):
     def retrieve_knowledge_items(self, request, *args, **kwargs):
         """
         Retrieves Knowledge Items based on multiple query embeddings for a specific RAGConfig.
+        All the query embeddings are resolved in a single database query.
+        If `grouped` is true it returns one ranked list per query embedding, otherwise all the results in a flat list.
         """
-        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        rag_config = RAGConfig.objects.select_related("retriever_config").filter(pk=kwargs.get("pk")).first()
         query_embeddings_data = request.data.get('query_embeddings')  # Expecting a list of embeddings
         threshold = request.data.get('threshold', 0.0)
         top_k = request.data.get('top_k')
+        grouped = request.data.get('grouped', False)
 
         if None in (query_embeddings_data, threshold, top_k) or not isinstance(query_embeddings_data, list):
             return Response({"error": "Invalid or missing required parameters."}, status=status.HTTP_400_BAD_REQUEST)
 
-        all_items = []
-        for query_embedding in query_embeddings_data:
-            items = rag_config.retrieve_kitems(query_embedding, threshold, top_k)
-            all_items.extend(items)
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        items_per_query = rag_config.retrieve_kitems_batch(query_embeddings_data, threshold, top_k)
 
+        if grouped:
+            return JsonResponse(items_per_query, safe=False)
+
+        all_items = [item for items in items_per_query for item in items]
         # Return serialized data
         return JsonResponse(all_items, safe=False)
 
+    @action(detail=True, url_name='embeddings', url_path='embeddings', methods=['GET'])
+    def list_embeddings(self, request, *args, **kwargs):
+        """
+        Exports the embeddings of a RAGConfig in pages, used by the retriever replicas that search in process.
+        """
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        since = request.query_params.get('since')
+        since = parse_datetime(since) if since else None
+        data = rag_config.export_embeddings(
+            since=since,
+            after_id=int(request.query_params.get('after_id', 0)),
+            limit=int(request.query_params.get('limit', 10000)),
+            ids_only=request.query_params.get('ids_only') == 'true',
+        )
+        return JsonResponse(data)
+
+    @action(detail=True, url_name='index-version', url_path='index-version', methods=['GET'])
+    def index_version(self, request, *args, **kwargs):
+        """
+        Returns the index version of a RAGConfig, the RAG deployments poll it to invalidate their retrieval and response caches.
+        """
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({"index_version": rag_config.index_version})
+
+    @action(detail=True, url_name='index-segments', url_path='index-segments', methods=['GET'])
+    def index_segments(self, request, *args, **kwargs):
+        """
+        Returns the index path and the delta segments of a RAGConfig, the ColBERT deployments poll it to load new segments.
+        """
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({"s3_index_path": rag_config.s3_index_path, "index_segments": rag_config.index_segments})
+
+    @action(detail=True, url_name='batch-params', url_path='batch-params', methods=['GET', 'POST'], parser_classes=[JSONParser])
+    def batch_params(self, request, *args, **kwargs):
+        """
+        Returns or updates the batch params of the retriever deployment of a RAGConfig.
+        The retriever replicas poll them and apply the changes through update_batch_params without a redeploy.
+        """
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        if request.method == 'POST':
+            try:
+                max_batch_size = int(request.data.get('max_batch_size', rag_config.retriever_max_batch_size))
+                batch_wait_timeout_s = float(request.data.get('batch_wait_timeout_s', rag_config.retriever_batch_wait_timeout_s))
+            except (TypeError, ValueError):
+                return Response({"error": "Invalid batch params."}, status=status.HTTP_400_BAD_REQUEST)
+            if max_batch_size < 1 or batch_wait_timeout_s < 0:
+                return Response({"error": "Invalid batch params."}, status=status.HTTP_400_BAD_REQUEST)
+            rag_config.retriever_max_batch_size = max_batch_size
+            rag_config.retriever_batch_wait_timeout_s = batch_wait_timeout_s
+            rag_config.save(update_fields=['retriever_max_batch_size', 'retriever_batch_wait_timeout_s'])
+
+        return JsonResponse(rag_config.get_batch_params())
+
+    @action(detail=True, url_name='retrieval-cache-stats', url_path='retrieval-cache-stats', methods=['GET'])
+    def retrieval_cache_stats(self, request, *args, **kwargs):
+        """
+        Returns the hit/miss counters of the retrieval cache of the RAG deployment replica that serves the call.
+        """
+        from ray import serve
+
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            handle = serve.get_app_handle(rag_config.get_deploy_name())
+        except Exception:
+            return Response({"error": "RAG config not deployed."}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse(handle.retrieval_cache_stats.remote().result())
+
+    @action(detail=True, url_name='response-cache-stats', url_path='response-cache-stats', methods=['GET'])
+    def response_cache_stats(self, request, *args, **kwargs):
+        """
+        Returns the hit/miss counters of the response cache of the RAG deployment replica that serves the call.
+        """
+        from ray import serve
+
+        rag_config = RAGConfig.objects.filter(pk=kwargs.get("pk")).first()
+        if not rag_config:
+            return Response({"error": "RAG config not found."}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            handle = serve.get_app_handle(rag_config.get_deploy_name())
+        except Exception:
+            return Response({"error": "RAG config not deployed."}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse(handle.response_cache_stats.remote().result())
+
 
 class LLMConfigAPIViewSet(viewsets.ModelViewSet):
     queryset = LLMConfig.objects.all()
@@ -0,0 +1,113 @@
+"""
+Load benchmark of the retriever batching policies: the fixed one of serve.batch (batches of up to 5 after waiting
+up to 200ms) against the AdaptiveBatcher. Open loop Poisson arrivals at several rates are sent to a simulated
+retriever whose batch latency grows linearly with the batch size, or to a real E5 model with --model.
+
+    python benchmarks/adaptive_batching.py --rates 2 20 100 300 --duration 10
+
+Under load the adaptive policy must wait on its window for the batches to fill, the script exits with an error
+if it never did at the highest rate.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+import numpy as np
+
+from chat_rag.inf_retrieval.adaptive_batcher import AdaptiveBatcher
+
+
+def make_handler(args):
+    if args.model:
+        from chat_rag.inf_retrieval.embedding_models import E5Model
+
+        model = E5Model(model_name=args.model, use_cpu=args.use_cpu)
+
+        async def handler(queries):
+            embeddings = model.build_embeddings(queries, prefix="query: ", disable_progress_bar=True)
+            return list(embeddings)
+
+        return handler
+
+    async def handler(queries):
+        # blocking like the model forward pass of a replica
+        time.sleep((args.fixed_cost_ms + args.per_item_ms * len(queries)) / 1000)
+        return queries
+
+    return handler
+
+
+async def run_load(batcher, rate, duration):
+    latencies = []
+
+    async def call(query):
+        start = time.perf_counter()
+        await batcher.submit(query)
+        latencies.append(time.perf_counter() - start)
+
+    # open loop: the arrival times are fixed in advance, the calls due while the event loop was busy are sent at once
+    arrivals, t = [], 0.0
+    while t < duration:
+        arrivals.append(t)
+        t += random.expovariate(rate)
+
+    tasks = []
+    start = time.perf_counter()
+    for arrival in arrivals:
+        delay = start + arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(call(f"query: what is the warranty of product XJ-{len(tasks)}?")))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    return np.array(latencies) * 1000, len(latencies) / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", type=float, nargs="+", default=[2, 20, 100, 300], help="requests per second")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--fixed-cost-ms", type=float, default=10)
+    parser.add_argument("--per-item-ms", type=float, default=2)
+    parser.add_argument("--p99-target-ms", type=float, default=500)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=50)
+    parser.add_argument("--model", type=str, default=None, help="e.g. intfloat/e5-small-v2, simulated if unset")
+    parser.add_argument("--use-cpu", action="store_true")
+    args = parser.parse_args()
+
+    handler = make_handler(args)
+    policies = {
+        "fixed": lambda: AdaptiveBatcher(handler, max_batch_size=5, max_wait_s=0.2, adaptive=False),
+        "adaptive": lambda: AdaptiveBatcher(
+            handler,
+            max_batch_size=args.max_batch_size,
+            max_wait_s=args.max_wait_ms / 1000,
+            p99_target_s=args.p99_target_ms / 1000,
+        ),
+    }
+
+    random.seed(42)
+    print(f"{'rate':>8} {'policy':>9} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8} {'batch':>6} {'wait ms':>8} {'waited':>7}")
+    stats = {}
+    for rate in args.rates:
+        for name, make_batcher in policies.items():
+            batcher = make_batcher()
+            latencies, throughput = await run_load(batcher, rate, args.duration)
+            stats[rate, name] = batcher.stats()
+            print(
+                f"{rate:>8.0f} {name:>9} {np.percentile(latencies, 50):>9.1f} {np.percentile(latencies, 99):>9.1f} "
+                f"{throughput:>8.1f} {stats[rate, name]['mean_batch_size']:>6.1f} "
+                f"{stats[rate, name]['wait_s'] * 1000:>8.1f} {stats[rate, name]['waited_batches']:>7}"
+            )
+            batcher.dispatcher.cancel()
+
+    # the wait window of the adaptive policy has to be applied under load
+    if not stats[max(args.rates), "adaptive"]["waited_batches"]:
+        sys.exit(f"The adaptive policy never waited on its wait window at {max(args.rates):.0f} requests per second")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
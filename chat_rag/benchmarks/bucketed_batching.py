@@ -0,0 +1,76 @@
+"""
+Benchmark of BaseModel.encode on contents of very uneven lengths.
+It compares the previous fixed size batches in the input order, padded to the longest input of each batch,
+with the length sorted batches, with and without a token budget.
+
+    python benchmarks/bucketed_batching.py --model intfloat/e5-small-v2 --contents 2000 --batch-size 32
+"""
+import argparse
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+
+from chat_rag.inf_retrieval.embedding_models import E5Model
+
+
+def unsorted_encode(model, queries, batch_size):
+    """
+    Previous implementation: fixed size batches in the input order concatenated with torch.cat.
+    """
+    all_embeddings = torch.tensor([])
+    with torch.inference_mode():
+        for i in range(0, len(queries), batch_size):
+            encoded_input = model.tokenizer(
+                queries[i : i + batch_size], padding=True, truncation=True, return_tensors="pt"
+            ).to(model.device)
+            model_output = model.model(**encoded_input, return_dict=True)
+            embeddings = model.average_pool(model_output.last_hidden_state, encoded_input["attention_mask"])
+            all_embeddings = torch.cat((all_embeddings, F.normalize(embeddings, p=2, dim=1).cpu()))
+    return all_embeddings
+
+
+def time_it(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="intfloat/e5-small-v2")
+    parser.add_argument("--contents", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--use-cpu", action="store_true")
+    args = parser.parse_args()
+
+    model = E5Model(model_name=args.model, use_cpu=args.use_cpu)
+
+    # mostly short chunks with some long ones, like the knowledge items parsed from FAQs and documents
+    random.seed(42)
+    words = ["retrieval", "embedding", "knowledge", "item", "answer", "question", "model", "batch"]
+    contents = [
+        "passage: " + " ".join(random.choices(words, k=random.choice([8, 16, 32, 32, 64, 400])))
+        for _ in range(args.contents)
+    ]
+
+    reference, unsorted_s = time_it(lambda: unsorted_encode(model, contents, args.batch_size))
+    sorted_embeddings, sorted_s = time_it(lambda: model.encode(contents, args.batch_size, disable_progress_bar=True))
+    budget_embeddings, budget_s = time_it(
+        lambda: model.encode(
+            contents, -1, disable_progress_bar=True, max_tokens_per_batch=args.batch_size * 512
+        )
+    )
+
+    assert torch.allclose(reference, sorted_embeddings, atol=1e-4)
+    assert torch.allclose(reference, budget_embeddings, atol=1e-4)
+
+    print(f"contents={len(contents)} batch_size={args.batch_size} device={model.device}")
+    print(f"unsorted batches     {len(contents) / unsorted_s:8.1f} contents/s")
+    print(f"length sorted        {len(contents) / sorted_s:8.1f} contents/s | speedup x{unsorted_s / sorted_s:.1f}")
+    print(f"token budget {args.batch_size * 512:>7} {len(contents) / budget_s:8.1f} contents/s | speedup x{unsorted_s / budget_s:.1f}")
+
+
+if __name__ == "__main__":
+    main()
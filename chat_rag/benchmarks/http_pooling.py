@@ -0,0 +1,89 @@
+"""
+Benchmark of the requests of the replicas to the backend and to the vLLM server: a new aiohttp session per request,
+as before, against the PooledSession that keeps the connections open. By default it starts a local server that
+answers after --server-ms, use --url to measure against a real endpoint (e.g. over TLS, where the handshake costs more).
+
+    python benchmarks/http_pooling.py --requests 500 --concurrency 8
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from chat_rag.http_pool import PooledSession
+
+
+async def start_server(server_ms, port):
+    async def handler(request):
+        await request.read()
+        await asyncio.sleep(server_ms / 1000)
+        return web.json_response({"index_version": 1})
+
+    app = web.Application()
+    app.router.add_post("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def run(send, n_requests, concurrency):
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(n_requests):
+        queue.put_nowait(None)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            await send()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return np.array(latencies) * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default=None)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--server-ms", type=float, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    runner = None
+    url = args.url
+    if url is None:
+        runner = await start_server(args.server_ms, args.port)
+        url = f"http://127.0.0.1:{args.port}/"
+    payload = {"query_embeddings": [[0.1] * 384], "top_k": 5, "grouped": True}
+
+    async def per_request_session():
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=payload) as response:
+                await response.json()
+
+    pool = PooledSession()
+
+    async def pooled_session():
+        async with pool.get().post(url, json=payload) as response:
+            await response.json()
+
+    print(f"{'session':>12} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, send in [("per request", per_request_session), ("pooled", pooled_session)]:
+        await run(send, args.concurrency, args.concurrency)  # warm up
+        latencies = await run(send, args.requests, args.concurrency)
+        print(f"{name:>12} {np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}")
+
+    await pool.close()
+    if runner is not None:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
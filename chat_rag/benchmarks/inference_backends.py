@@ -0,0 +1,85 @@
+"""
+Parity check and throughput of the CPU inference backends of E5Model and ReRanker.
+The embeddings and rerank scores of every backend are checked against the PyTorch ones,
+the ONNX models are exported to CHAT_RAG_MODELS_CACHE_DIR on the first run.
+
+    python benchmarks/inference_backends.py --model intfloat/e5-small-v2 --queries 512 --threads 4
+
+It is the parity check of the backends, it exits with an error if any of them is out of tolerance.
+"""
+import argparse
+import random
+import sys
+import time
+
+import torch
+
+from chat_rag.inf_retrieval.cross_encoder import ReRanker
+from chat_rag.inf_retrieval.embedding_models import E5Model
+from chat_rag.inf_retrieval.inference_backends import BACKENDS, ONNX_BACKENDS, onnx_available
+
+# minimum cosine similarity to the PyTorch embeddings and maximum rerank score difference
+EMBEDDINGS_TOLERANCE = 0.99
+RERANK_TOLERANCE = 0.05
+
+
+def make_queries(n_queries):
+    random.seed(42)
+    words = ["how", "do", "I", "reset", "my", "password", "account", "billing", "plan", "cancel", "the", "order"]
+    return [" ".join(random.choices(words, k=random.randint(4, 24))) for _ in range(n_queries)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="intfloat/e5-small-v2")
+    parser.add_argument("--lang", type=str, default="en", help="Language of the reranker model")
+    parser.add_argument("--queries", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    queries = make_queries(args.queries)
+    contexts = [{"content": query} for query in make_queries(args.batch_size)]
+
+    reference_embeddings, reference_scores = None, None
+    failures = []
+    print(f"queries={len(queries)} batch_size={args.batch_size} threads={args.threads}")
+    for backend in BACKENDS:
+        if backend in ONNX_BACKENDS and not onnx_available():
+            # they would fall back to torch and compare it with itself
+            print(f"{backend:>10} | skipped, install chat-rag with the onnx extra")
+            continue
+        model = E5Model(model_name=args.model, use_cpu=True, backend=backend)
+        reranker = ReRanker(lang=args.lang, device="cpu", backend=backend)
+
+        start = time.perf_counter()
+        embeddings = model.build_embeddings(queries, batch_size=args.batch_size, prefix="query: ", disable_progress_bar=True)
+        encode_s = time.perf_counter() - start
+
+        pairs = [(queries[0][:64], context["content"]) for context in contexts]
+        start = time.perf_counter()
+        scores = torch.as_tensor(reranker.model.predict(pairs, activation_fct=reranker.activation_fct))
+        rerank_s = time.perf_counter() - start
+
+        if reference_embeddings is None:
+            reference_embeddings, reference_scores = embeddings, scores
+        min_cosine = (embeddings * reference_embeddings).sum(dim=1).min().item()
+        max_score_diff = (scores - reference_scores).abs().max().item()
+        if min_cosine < EMBEDDINGS_TOLERANCE:
+            failures.append(f"{backend} embeddings differ from torch: {min_cosine:.4f}")
+        if max_score_diff > RERANK_TOLERANCE:
+            failures.append(f"{backend} rerank scores differ from torch: {max_score_diff:.4f}")
+
+        print(
+            f"{backend:>10} | encode {len(queries) / encode_s / args.threads:8.1f} queries/s/core | "
+            f"rerank {len(pairs) / rerank_s / args.threads:8.1f} pairs/s/core | "
+            f"min cosine {min_cosine:.5f} | max score diff {max_score_diff:.5f}"
+        )
+
+    if failures:
+        sys.exit("Parity check failed:\n" + "\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of RAGLLM.format_prompt on 20-turn conversations with long contexts that do not fit in the model context.
+It compares the previous fitting, which re-tokenizes the whole prompt after dropping every context or message,
+with the token count fitting, on the first request and on the next turns of the same conversation (cached counts).
+
+    python benchmarks/prompt_fitting.py --tokenizer mistralai/Mistral-7B-Instruct-v0.2 --max-length 4096 --turns 20
+"""
+import argparse
+import random
+import time
+
+from transformers import AutoTokenizer
+
+from chat_rag.exceptions import PromptTooLongException
+from chat_rag.llms.base_llm import RAGLLM
+
+
+PROMPT_STRUCTURE = {
+    "system_prefix": "You are a helpful assistant that answers the questions of the customers using the information below.",
+    "system_tag": "<s>[INST] ",
+    "system_end": " [/INST]",
+    "user_tag": "[INST] ",
+    "user_end": " [/INST]",
+    "assistant_tag": "",
+    "assistant_end": "</s>",
+}
+
+
+def legacy_format_prompt(llm, messages, contexts, n_contexts_to_use=3, lang="en", **prompt_structure):
+    """
+    Previous implementation: drops a context or a message at a time and re-tokenizes the whole prompt.
+    """
+    args = [prompt_structure[key] for key in PROMPT_STRUCTURE] + [lang]
+    n_messages_to_keep = len(messages)
+    n_contexts = n_contexts_to_use if len(contexts) > n_contexts_to_use else len(contexts)
+
+    prompt = llm.apply_chat_template(messages, contexts, *args)
+    num_tokens = len(llm.tokenizer.tokenize(prompt))
+    margin = int(llm.model_max_length * 0.1)
+    while num_tokens > (llm.model_max_length - margin):
+        if n_contexts == 1 and n_messages_to_keep > 1:
+            n_messages_to_keep -= 1
+        n_contexts = n_contexts - 1 if n_contexts > 1 else 1
+        if n_contexts == 1 and n_messages_to_keep == 1:
+            raise PromptTooLongException()
+        prompt = llm.apply_chat_template(messages[:n_messages_to_keep], contexts[:n_contexts], *args)
+        num_tokens = len(llm.tokenizer.tokenize(prompt))
+    return prompt, (n_contexts, n_messages_to_keep)
+
+
+def make_llm(tokenizer, max_length):
+    # only the prompt formatting is benchmarked, no model is loaded
+    llm = RAGLLM.__new__(RAGLLM)
+    llm.tokenizer = tokenizer
+    llm.model_max_length = max_length
+    llm.has_chat_template = False
+    return llm
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="mistralai/Mistral-7B-Instruct-v0.2")
+    parser.add_argument("--max-length", type=int, default=4096)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--contexts", type=int, default=10)
+    parser.add_argument("--context-words", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    random.seed(42)
+    words = ["warranty", "product", "return", "shipping", "invoice", "account", "password", "delivery", "refund", "order"]
+    contexts = [" ".join(random.choices(words, k=args.context_words)) for _ in range(args.contexts)]
+    messages = []
+    for turn in range(args.turns):
+        messages.append({"role": "user", "content": f"Question {turn}: " + " ".join(random.choices(words, k=30))})
+        messages.append({"role": "assistant", "content": " ".join(random.choices(words, k=120))})
+    messages.append({"role": "user", "content": "And what about the refund of my last order?"})
+
+    prompt_structure = {**PROMPT_STRUCTURE, "n_contexts_to_use": args.contexts}
+
+    legacy_llm = make_llm(tokenizer, args.max_length)
+    (_, legacy_kept), legacy_ms = time_it(lambda: legacy_format_prompt(legacy_llm, messages, contexts, **prompt_structure), args.repeat)
+
+    cold_llm = make_llm(tokenizer, args.max_length)
+    (_, kept), cold_ms = time_it(lambda: make_llm(tokenizer, args.max_length).format_prompt(messages, contexts, **prompt_structure), args.repeat)
+    # the next turns of the conversation reuse the counts of the contexts and of the previous messages
+    cold_llm.format_prompt(messages, contexts, **prompt_structure)
+    (_, kept), warm_ms = time_it(lambda: cold_llm.format_prompt(messages, contexts, **prompt_structure), args.repeat)
+
+    print(f"{len(messages)} messages and {len(contexts)} contexts in {args.max_length} tokens")
+    print(f"legacy:       {legacy_ms:8.1f} ms, kept (contexts, messages) = {legacy_kept} (oldest messages)")
+    print(f"fitted, cold: {cold_ms:8.1f} ms, kept (contexts, messages) = {kept} (latest messages)")
+    print(f"fitted, warm: {warm_ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
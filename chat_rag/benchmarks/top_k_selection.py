@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the top-k selection of SemanticRetriever.get_top_matches.
+It compares the previous full argsort + masking implementation with the topk based one.
+
+    python benchmarks/top_k_selection.py --rows 100000 1000000 --queries 5 --top-k 5
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from chat_rag.inf_retrieval.retrievers.semantic_retriever import SemanticRetriever
+
+
+def argsort_top_matches(scores, top_k=5, threshold=None):
+    """
+    Previous implementation: sorts every score of every row and then masks and truncates.
+    """
+    scores = scores.cpu().numpy()
+    sorted_indices = np.argsort(scores, axis=1)[:, ::-1]
+    sorted_scores = np.take_along_axis(scores, sorted_indices, axis=1)[:, :, None]
+    sorted_indexes = np.take_along_axis(
+        np.broadcast_to(np.arange(scores.shape[1]), scores.shape),
+        sorted_indices,
+        axis=1,
+    )[:, :, None]
+    mask = (
+        sorted_scores >= threshold
+        if threshold is not None
+        else np.ones_like(sorted_scores, dtype=bool)
+    )
+    sorted_scores = np.where(mask, sorted_scores, -np.inf).squeeze(-1)
+    sorted_indexes = np.where(mask, sorted_indexes, -1).squeeze(-1)
+    sorted_scores = sorted_scores[sorted_scores != -np.inf].reshape(scores.shape[0], -1)
+    sorted_indexes = sorted_indexes[sorted_indexes != -1].reshape(scores.shape[0], -1)
+    if top_k != -1:
+        sorted_scores = sorted_scores[:, :top_k]
+        sorted_indexes = sorted_indexes[:, :top_k]
+    return list(zip(sorted_scores, sorted_indexes))
+
+
+def time_it(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=5)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    for n_rows in args.rows:
+        # cosine similarities of normalized embeddings
+        scores = torch.rand(args.queries, n_rows) * 2 - 1
+
+        previous = argsort_top_matches(scores, top_k=args.top_k)
+        current = SemanticRetriever.select_top_matches(scores, top_k=args.top_k)
+        for row, ((prev_scores, _), (cur_scores, cur_indexes)) in enumerate(zip(previous, current)):
+            # ties may be ordered differently, so compare the scores and that the indexes point to them
+            assert np.array_equal(prev_scores, cur_scores)
+            assert np.array_equal(scores[row, cur_indexes].numpy(), cur_scores)
+
+        argsort_ms = time_it(lambda: argsort_top_matches(scores, top_k=args.top_k), args.repeats)
+        topk_ms = time_it(lambda: SemanticRetriever.select_top_matches(scores, top_k=args.top_k), args.repeats)
+
+        print(
+            f"rows={n_rows:>9,} queries={args.queries} top_k={args.top_k} | "
+            f"argsort {argsort_ms:8.2f} ms | topk {topk_ms:8.2f} ms | speedup x{argsort_ms / topk_ms:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 from logging import getLogger
-from typing import List, Dict
+from typing import List, Dict, Optional
 from chat_rag.llms import RAGLLM
+from chat_rag.inf_retrieval.retrieval_cache import RetrievalCache
+from chat_rag.response_cache import ResponseCache
 
 logger = getLogger(__name__)
 
@@ -9,8 +11,10 @@ class AsyncRAG:
     def __init__(
         self,
         retriever,
-        llm_model: RAGLLM,
+        llm_model: Optional[RAGLLM],
         lang: str = "en",
+        retrieval_cache: Optional[RetrievalCache] = None,
+        response_cache: Optional[ResponseCache] = None,
     ):
         """
         Parameters
@@ -18,14 +22,49 @@ class AsyncRAG:
         retriever :
             Retriever object for retrieving contexts.
         llm_model : RAGLLM
-            Language model for generating responses.
+            Language model for generating responses, it can be None if the RAG is only used to retrieve contexts.
         lang : str, optional
             Language of the language model, by default "en"
+        retrieval_cache : RetrievalCache, optional
+            Cache of the retrieved contexts, by default None. Its semantic tier needs a retriever with an `embed` method
+            whose `retrieve` accepts the embedding.
+        response_cache : ResponseCache, optional
+            Cache of the deterministic responses, by default None.
         """
 
         self.retriever = retriever
         self.model = llm_model
         self.lang = lang
+        self.retrieval_cache = retrieval_cache
+        self.response_cache = response_cache
+
+    async def retrieve_contexts(self, message: str, top_k: int):
+        """
+        Retrieve the contexts of the message going through the retrieval cache if there is one.
+        """
+        if self.retrieval_cache is None:
+            return await self.retriever.retrieve(message, top_k=top_k)
+
+        contexts = self.retrieval_cache.get(message, top_k)
+        if contexts is not None:
+            logger.info("Retrieval cache hit")
+            return contexts
+
+        embedding = None
+        if self.retrieval_cache.semantic:
+            embedding = await self.retriever.embed(message)
+            contexts = self.retrieval_cache.get_similar(embedding, top_k)
+            if contexts is not None:
+                logger.info("Retrieval cache semantic hit")
+                return contexts
+
+        if embedding is not None:
+            # the retriever reuses the embedding instead of embedding the message again
+            contexts = await self.retriever.retrieve(message, top_k=top_k, embedding=embedding)
+        else:
+            contexts = await self.retriever.retrieve(message, top_k=top_k)
+        self.retrieval_cache.put(message, top_k, contexts, embedding)
+        return contexts
 
     async def retrieve(self, message: str, prev_contents: List[str], prompt_structure_dict: dict):
         """
@@ -46,7 +85,7 @@ class AsyncRAG:
             List of all conversation contexts and list of the retrieved contexts for the current user message.
         """
         logger.info(f"Retrieving contexts for message: {message}")
-        contexts = await self.retriever.retrieve(
+        contexts = await self.retrieve_contexts(
             message,
             top_k=prompt_structure_dict["n_contexts_to_use"]
         )
@@ -62,6 +101,23 @@ class AsyncRAG:
         contents = [x for x in prev_contents + contents if not (x in seen or seen.add(x))]
         return contents, returned_contexts
 
+    def lookup_response(self, messages: List[Dict[str, str]], contents: List[str], prompt_structure_dict: dict, generation_config_dict: dict):
+        """
+        Looks up the response in the response cache if the generation is cacheable.
+
+        Returns
+        -------
+        Tuple[Optional[str], Optional[List[str]], dict]
+            The cache key to store the generated response under (None if it is not cacheable), the cached chunks
+            (None on a miss) and the generation config without the cache_responses flag, to pass to the LLM.
+        """
+        cache_key, chunks = None, None
+        if self.response_cache is not None and ResponseCache.is_cacheable(generation_config_dict):
+            cache_key = self.response_cache.make_key(messages, contents, prompt_structure_dict, generation_config_dict)
+            chunks = self.response_cache.get(cache_key)
+        generation_config_dict = {key: value for key, value in generation_config_dict.items() if key != "cache_responses"}
+        return cache_key, chunks, generation_config_dict
+
     async def stream(self, messages: List[Dict[str, str]], prev_contents: List[str], prompt_structure_dict: dict, generation_config_dict: dict, stop_words: List[str] = None, only_context: bool = False):
         # Retrieve
         contents, returned_contexts = await self.retrieve(messages[-1]['content'], prev_contents, prompt_structure_dict)
@@ -69,19 +125,43 @@ class AsyncRAG:
             yield {"res": "", "context": returned_contexts}
             return
 
+        cache_key, chunks, generation_config_dict = self.lookup_response(
+            messages, contents, prompt_structure_dict, generation_config_dict
+        )
+        if chunks is not None:
+            logger.info("Response cache hit, replaying the cached response")
+            for new_text in chunks:
+                yield {"res": new_text, "context": returned_contexts}
+            return
+
         # Generate
+        chunks = []
         async for new_text in self.model.stream(
             messages, contents, prompt_structure_dict=prompt_structure_dict,
             generation_config_dict=generation_config_dict, lang=self.lang, stop_words=stop_words
         ):
+            chunks.append(new_text)
             yield {"res": new_text, "context": returned_contexts}
 
+        # only complete responses are cached
+        if cache_key is not None:
+            self.response_cache.put(cache_key, chunks)
+
     async def generate(self, messages: List[Dict[str, str]], prev_contents: List[str], prompt_structure_dict: dict, generation_config_dict: dict, stop_words: List[str] = None):
         # Retrieve
         contents, returned_contexts = await self.retrieve(messages[-1]['content'], prev_contents, prompt_structure_dict)
 
+        cache_key, chunks, generation_config_dict = self.lookup_response(
+            messages, contents, prompt_structure_dict, generation_config_dict
+        )
+        if chunks is not None:
+            logger.info("Response cache hit")
+            return {"res": "".join(chunks), "context": returned_contexts}
+
         output_text = await self.model.generate(
             messages, contents, prompt_structure_dict=prompt_structure_dict,
             generation_config_dict=generation_config_dict, lang=self.lang, stop_words=stop_words
         )
+        if cache_key is not None:
+            self.response_cache.put(cache_key, [output_text])
         return {"res": output_text, "context": returned_contexts}
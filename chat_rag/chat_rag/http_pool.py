@@ -0,0 +1,77 @@
+import asyncio
+import os
+from typing import Optional
+
+import aiohttp
+
+# Limits of the connection pool of every client, 0 means no limit per host
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', 0))
+# How long an idle connection is kept open for the next request
+HTTP_KEEPALIVE_TIMEOUT_S = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT_S', 60))
+HTTP_CONNECT_TIMEOUT_S = float(os.environ.get('HTTP_CONNECT_TIMEOUT_S', 10))
+# Max time between two reads of a response, there is no total timeout so the LLM streams are not cut
+HTTP_READ_TIMEOUT_S = float(os.environ.get('HTTP_READ_TIMEOUT_S', 120))
+# How long the DNS resolutions are cached by the pool
+HTTP_DNS_CACHE_TTL_S = int(os.environ.get('HTTP_DNS_CACHE_TTL_S', 300))
+
+
+class PooledSession:
+    """
+    A long-lived aiohttp session shared by all the requests of a client, so they reuse the open keep-alive connections
+    instead of paying a DNS lookup and a TCP/TLS handshake each. The session is created on the first request, in the
+    event loop of the replica, and created again if it was closed or the loop changed.
+    """
+
+    def __init__(
+        self,
+        limit: int = HTTP_POOL_LIMIT,
+        limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout_s: float = HTTP_KEEPALIVE_TIMEOUT_S,
+        connect_timeout_s: float = HTTP_CONNECT_TIMEOUT_S,
+        read_timeout_s: Optional[float] = HTTP_READ_TIMEOUT_S,
+    ):
+        """
+        Parameters
+        ----------
+        limit : int, optional
+            Max number of open connections, by default HTTP_POOL_LIMIT
+        limit_per_host : int, optional
+            Max number of open connections to the same host, 0 for no limit, by default HTTP_POOL_LIMIT_PER_HOST
+        keepalive_timeout_s : float, optional
+            How long an idle connection is kept open, by default HTTP_KEEPALIVE_TIMEOUT_S
+        connect_timeout_s : float, optional
+            Max time to get a connection, by default HTTP_CONNECT_TIMEOUT_S
+        read_timeout_s : float, optional
+            Max time between two reads of a response, by default HTTP_READ_TIMEOUT_S
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout_s = keepalive_timeout_s
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout_s, sock_read=read_timeout_s)
+        self.session = None
+        self.loop = None
+
+    def get(self) -> aiohttp.ClientSession:
+        """
+        Returns the session, it must not be closed nor used as a context manager by the caller.
+        """
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout_s,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL_S,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.loop = loop
+        return self.session
+
+    async def close(self):
+        """
+        Closes the session and its open connections, called on the shutdown of the replica.
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
@@ -0,0 +1,200 @@
+import asyncio
+import time
+from collections import deque
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Dict, List
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class AdaptiveBatcher:
+    """
+    Groups concurrent calls into batches for a handler that takes one list per argument and returns one result per call,
+    like the handlers decorated with serve.batch.
+
+    With the adaptive policy a call that arrives when the batcher is idle, nothing queued nor in flight and no batch
+    finished for longer than a batch takes, is dispatched right away, so a single query never waits. Under load the
+    calls wait up to the wait window for the batch to fill: the batch size limit grows when the queue builds up and
+    the wait window grows up to the time a batch takes, as long as the p99 latency of the calls is under the target,
+    and both are halved when it is over.
+    The fixed policy waits up to max_wait_s for max_batch_size calls, like serve.batch.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[List[Any]]],
+        max_batch_size: int = 32,
+        max_wait_s: float = 0.05,
+        p99_target_s: float = 0.5,
+        adaptive: bool = True,
+        max_concurrent_batches: int = 1,
+        window: int = 256,
+    ):
+        """
+        Parameters
+        ----------
+        handler : Callable[..., Awaitable[List[Any]]]
+            Coroutine function called with a list per argument of the batched calls.
+        max_batch_size : int, optional
+            Upper bound of the batch size, by default 32
+        max_wait_s : float, optional
+            Upper bound of the time a call waits for the batch to fill, by default 0.05
+        p99_target_s : float, optional
+            Target p99 latency of the calls, by default 0.5
+        adaptive : bool, optional
+            Whether to use the adaptive policy, otherwise the fixed one, by default True
+        max_concurrent_batches : int, optional
+            Number of batches in flight at the same time, by default 1
+        window : int, optional
+            Number of recent calls used to compute the p99 latency, by default 256
+        """
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self.p99_target_s = p99_target_s
+        self.adaptive = adaptive
+        self.max_concurrent_batches = max_concurrent_batches
+        self.latencies = deque(maxlen=window)
+        self.size_limit = 1 if adaptive else max_batch_size
+        self.wait_s = 0.0 if adaptive else max_wait_s
+        self.batch_latency = None  # moving average of the time a batch takes
+        self.last_batch_done = None
+
+        self.queue = deque()  # (args, future, enqueued at, arrived idle)
+        self.in_flight = 0
+        self.changed = None
+        self.dispatcher = None
+        self.n_batches = 0
+        self.n_calls = 0
+        self.n_waited_batches = 0  # batches dispatched after waiting on the wait window
+
+    def update_params(self, max_batch_size: int, max_wait_s: float):
+        """
+        Sets the bounds of the batch size and the wait window, which are the fixed values with the fixed policy.
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        if self.adaptive:
+            self.size_limit = min(self.size_limit, max_batch_size)
+            self.wait_s = min(self.wait_s, max_wait_s)
+        else:
+            self.size_limit, self.wait_s = max_batch_size, max_wait_s
+
+    async def submit(self, *args):
+        """
+        Queues a call and returns its result once its batch is processed.
+        """
+        loop = asyncio.get_running_loop()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.changed = asyncio.Event()
+            self.dispatcher = loop.create_task(self._dispatch_loop())
+
+        future = loop.create_future()
+        now = time.monotonic()
+        idle = not self.queue and self.in_flight == 0 and (
+            self.last_batch_done is None or now - self.last_batch_done > self.batch_latency
+        )
+        self.queue.append((args, future, now, idle))
+        self.changed.set()
+        return await future
+
+    async def _wait_change(self, timeout=None):
+        self.changed.clear()
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch_loop(self):
+        while True:
+            while not self.queue or self.in_flight >= self.max_concurrent_batches:
+                await self._wait_change()
+
+            if self.adaptive:
+                await asyncio.sleep(0)  # let the calls that arrived while the event loop was busy queue up
+                self._grow()
+            if self.adaptive and self.queue[0][3]:
+                deadline = time.monotonic()  # arrived idle, nothing to wait for
+            else:
+                deadline = self.queue[0][2] + self.wait_s
+            if len(self.queue) < self.size_limit and deadline > time.monotonic():
+                self.n_waited_batches += 1
+            while len(self.queue) < self.size_limit and deadline > time.monotonic():
+                await self._wait_change(deadline - time.monotonic())
+
+            batch = []
+            while self.queue and len(batch) < self.size_limit:
+                call = self.queue.popleft()
+                if not call[1].done():  # skip the cancelled calls
+                    batch.append(call)
+            if batch:
+                self.in_flight += 1
+                asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        started = time.monotonic()
+        try:
+            results = await self.handler(*[list(values) for values in zip(*[args for args, _, _, _ in batch])])
+            if len(results) != len(batch):
+                raise ValueError(f"The handler returned {len(results)} results for a batch of {len(batch)} calls")
+            for (_, future, _, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            done = time.monotonic()
+            self.last_batch_done = done
+            self.in_flight -= 1
+            self.n_batches += 1
+            self.n_calls += len(batch)
+            self.latencies.extend(done - enqueued_at for _, _, enqueued_at, _ in batch)
+            batch_latency = done - started
+            self.batch_latency = batch_latency if self.batch_latency is None else 0.8 * self.batch_latency + 0.2 * batch_latency
+            if self.adaptive:
+                self._adapt(batch)
+            self.changed.set()
+
+    def p99(self):
+        return float(np.percentile(self.latencies, 99)) if self.latencies else 0.0
+
+    def _grow(self):
+        """
+        Grows the batch size limit when more calls are queued than fit in a batch and the p99 latency is under target.
+        """
+        if len(self.queue) > self.size_limit and self.p99() <= self.p99_target_s:
+            self.size_limit = min(self.max_batch_size, self.size_limit + max(1, self.size_limit // 2))
+
+    def _adapt(self, batch):
+        """
+        Adjusts the limits after a batch: both are halved if the p99 latency is over target. Otherwise, when the batch
+        was dispatched under load and did not fill up, the wait window grows up to the time a batch takes, within
+        the latency left under the target, and it shrinks when the batch was dispatched idle.
+        """
+        p99 = self.p99()
+        if p99 > self.p99_target_s:
+            self.size_limit = max(1, self.size_limit // 2)
+            self.wait_s /= 2
+            # observe the new limits from scratch instead of shrinking again on the same latencies
+            self.latencies.clear()
+        elif not batch[0][3]:
+            if len(batch) < self.size_limit:
+                self.wait_s = min(self.max_wait_s, self.batch_latency, (self.p99_target_s - p99) / 2)
+        else:
+            self.wait_s /= 2
+
+    def stats(self) -> Dict:
+        return {
+            "adaptive": self.adaptive,
+            "size_limit": self.size_limit,
+            "wait_s": self.wait_s,
+            "p99_s": self.p99(),
+            "queue_depth": len(self.queue),
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_calls / self.n_batches if self.n_batches else 0.0,
+            "waited_batches": self.n_waited_batches,
+        }
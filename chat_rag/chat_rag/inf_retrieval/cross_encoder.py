@@ -1,23 +1,32 @@
+import os
 from typing import Any, Dict, List
 
 import torch
 from sentence_transformers import CrossEncoder
 
+from chat_rag.inf_retrieval.inference_backends import load_backend
+
 models_dict = {
     'en': 'cross-encoder/ms-marco-MiniLM-L-6-v2', # 'cross-encoder/ms-marco-MiniLM-L-12-v2' for little bit better performance
     'multilingual': 'nreimers/mmarco-mMiniLMv2-L6-H384-v1', # 'nreimers/mmarco-mMiniLMv2-L12-H384-v1' for better performance but slower
 }
 
+# Max (query, context) pairs of a cross-encoder forward pass, bounds its memory when many contexts are reranked
+RERANKER_BATCH_SIZE = int(os.environ.get('RERANKER_BATCH_SIZE', 32))
+
 
 class ReRanker:
-    def __init__(self, lang: str = 'en', device: str = 'cuda', model_name: str = None) -> None:
+    def __init__(self, lang: str = 'en', device: str = 'cuda', model_name: str = None, backend: str = 'torch', batch_size: int = RERANKER_BATCH_SIZE) -> None:
         """
         Class to rerank the retrieved contexts using a cross-encoder.
         It also filters out low confidence contexts.
+        The backend can be 'torch', 'torch_int8', 'onnx' or 'onnx_int8', the optimized ones are only used on CPU.
         """
         lang = lang if lang in models_dict else 'multilingual' # default to multilingual model if language not supported
         model_name = model_name if model_name is not None else models_dict[lang]
         self.model = CrossEncoder(model_name, max_length=512, device=device)
+        self.model.model = load_backend(self.model.model, self.model.tokenizer, model_name, backend, device, output_name='logits')
+        self.batch_size = batch_size
         self.confidence_threshold = 0.5
         self.activation_fct = torch.sigmoid
         self.max_query_length = 64 # These cross-encoder are not trained on long queries, so we restrict them down to simple queries of max 64 characters 
@@ -37,20 +46,46 @@ class ReRanker:
         List[Dict[str, Any]]
             List of reranked contexts.
         """
-        if len(query) > self.max_query_length: # for queries longer than 64 characters, we do not rerank
-            return contexts
-        
-        pairs = [(query, context['content']) for context in contexts]
-        scores = self.model.predict(pairs, activation_fct=self.activation_fct)
-        print(f"CrossEncoder: {scores} scores")
-
-        # filter out low confidence scores and sort by score
-        scores = [(score, context) for score, context in zip(scores, contexts) if score > self.confidence_threshold]
-        print(f"CrossEncoder: {len(scores)} contexts left after filtering")
-
-        if len(scores) == 0:
-            return []
-        
-        scores.sort(key=lambda x: x[0], reverse=True)
-        return [context for _, context in scores]
+        return self.batch_rerank([query], [contexts])[0]
+
+    def batch_rerank(self, queries: List[str], contexts_list: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+        """
+        Rerank the retrieved contexts of several queries scoring all the (query, context) pairs in a single
+        cross-encoder call, in forward passes of up to batch_size pairs, the threshold and the sort are applied per query.
+        Parameters
+        ----------
+        queries: List[str]
+            The user messages.
+        contexts_list: List[List[Dict[str, Any]]]
+            List of retrieved contexts of each query.
+        Returns
+        -------
+        List[List[Dict[str, Any]]]
+            List of reranked contexts of each query.
+        """
+        pairs, groups = [], []  # groups: (index of the query, first pair, last pair)
+        for index, (query, contexts) in enumerate(zip(queries, contexts_list)):
+            # for queries longer than 64 characters, we do not rerank
+            if not contexts or len(query) > self.max_query_length:
+                continue
+            groups.append((index, len(pairs), len(pairs) + len(contexts)))
+            pairs.extend((query, context['content']) for context in contexts)
+
+        results = list(contexts_list)
+        if not pairs:
+            return results
+
+        scores = self.model.predict(pairs, activation_fct=self.activation_fct, batch_size=self.batch_size)
+        print(f"CrossEncoder: {len(pairs)} pairs of {len(groups)} queries scored")
+
+        for index, start, end in groups:
+            # filter out low confidence scores and sort by score
+            query_scores = [
+                (score, context) for score, context in zip(scores[start:end], contexts_list[index])
+                if score > self.confidence_threshold
+            ]
+            query_scores.sort(key=lambda x: x[0], reverse=True)
+            results[index] = [context for _, context in query_scores]
 
+        print(f"CrossEncoder: {[len(results[index]) for index, _, _ in groups]} contexts left after filtering")
+        return results
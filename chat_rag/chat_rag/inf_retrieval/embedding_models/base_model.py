@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from logging import getLogger
 
 from tqdm import tqdm
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from torch import Tensor
 from transformers import AutoTokenizer, AutoModel
 
+from chat_rag.inf_retrieval.inference_backends import load_backend
+
 logger = getLogger(__name__)
 
 
@@ -20,6 +22,7 @@ class BaseModel:
         model_name: str = "sentence-transformers/multi-qa-MiniLM-L6-cos-v1",
         use_cpu: bool = False,
         huggingface_key: str = None,
+        backend: str = "torch",
     ):
         """
         Parameters
@@ -30,6 +33,9 @@ class BaseModel:
             Whether to use CPU for encoding, by default False
         huggingface_key : str, optional
             Huggingface key to be used for private models, by default None
+        backend : str, optional
+            Inference backend, one of 'torch', 'torch_int8', 'onnx' or 'onnx_int8', by default 'torch'.
+            The optimized backends are only used on CPU, the ONNX models are exported on first load and cached on disk.
         """
 
         self.device = "cuda" if (not use_cpu and torch.cuda.is_available()) else "cpu"
@@ -46,6 +52,8 @@ class BaseModel:
             token=huggingface_key,
         ).to(self.device)
 
+        self.model = load_backend(self.model, self.tokenizer, model_name, backend, self.device)
+
     def average_pool(
         self, last_hidden_states: Tensor, attention_mask: Tensor
     ) -> Tensor:
@@ -72,9 +80,12 @@ class BaseModel:
         queries: List[str],
         batch_size: int = -1,
         disable_progress_bar: bool = False,
+        max_tokens_per_batch: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Returns the embeddings of the queries.
+        The queries are tokenized once and sorted by length, so each batch groups queries of similar length
+        and is only padded to its longest one, the embeddings are returned in the original order.
         Parameters
         ----------
         queries : List[str]
@@ -83,26 +94,28 @@ class BaseModel:
             Batch size, by default -1 (no batching).
         disable_progress_bar : bool, optional
             Whether to disable the progress bar, by default False.
+        max_tokens_per_batch : int, optional
+            Maximum number of tokens of a batch including the padding, by default None (no limit).
+            With it the batches of short queries hold more items than the ones of long queries.
         Returns
         -------
         torch.Tensor
             Embeddings of the queries.
         """
-        if batch_size == -1:
-            batch_size = len(queries)
+        if not queries:
+            return torch.tensor([])
+
+        encoded_queries = self.tokenizer(queries, truncation=True)
+        lengths = [len(input_ids) for input_ids in encoded_queries["input_ids"]]
+        batches = self.make_batches(lengths, batch_size, max_tokens_per_batch)
 
-        all_embeddings = torch.tensor([])
+        all_embeddings = None
 
         # Compute token embeddings
         with torch.inference_mode():
-            for i in tqdm(
-                range(0, len(queries), batch_size), disable=disable_progress_bar
-            ):
-                # Tokenize sentences
-                encoded_input = self.tokenizer(
-                    queries[i : i + batch_size],
-                    padding=True,
-                    truncation=True,
+            for batch in tqdm(batches, disable=disable_progress_bar):
+                encoded_input = self.tokenizer.pad(
+                    {key: [values[i] for i in batch] for key, values in encoded_queries.items()},
                     return_tensors="pt",
                 ).to(self.device)
                 inputs = {key: val for key, val in encoded_input.items()}
@@ -116,18 +129,50 @@ class BaseModel:
                 del model_output
 
                 embeddings = F.normalize(embeddings, p=2, dim=1).cpu()
-                all_embeddings = torch.cat((all_embeddings, embeddings))
+                if all_embeddings is None:
+                    all_embeddings = torch.empty((len(queries), embeddings.shape[1]), dtype=embeddings.dtype)
+                all_embeddings[batch] = embeddings
 
         torch.cuda.empty_cache()
 
         return all_embeddings
-    
+
+    @staticmethod
+    def make_batches(
+        lengths: List[int],
+        batch_size: int = -1,
+        max_tokens_per_batch: Optional[int] = None,
+    ) -> List[List[int]]:
+        """
+        Groups the indexes of the inputs sorted by decreasing length in batches of at most batch_size items
+        and at most max_tokens_per_batch tokens once padded, a longer input than the budget goes alone in its batch.
+        """
+        if batch_size == -1:
+            batch_size = len(lengths)
+
+        batches, batch = [], []
+        for index in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            # sorted by decreasing length, so the first input of the batch sets its padded length
+            padded_tokens = (len(batch) + 1) * lengths[batch[0]] if batch else 0
+            if batch and (
+                len(batch) >= batch_size
+                or (max_tokens_per_batch is not None and padded_tokens > max_tokens_per_batch)
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+
+        return batches
+
     def build_embeddings(
         self,
         contents: List[str] = None,
         batch_size: int = 1,
         prefix: str = "passage: ",
         disable_progress_bar: bool = False,
+        max_tokens_per_batch: Optional[int] = None,
     ):
         """
         Builds the embeddings for the context.
@@ -139,10 +184,12 @@ class BaseModel:
             Batch size to be used for encoding the context, by default 1
         prefix : str, optional
             Prefix or instruction to be added to the context, by default 'passage: ' for e5 models.
+        max_tokens_per_batch : int, optional
+            Maximum number of tokens of a batch including the padding, by default None (no limit).
         """
         logger.info("Building embeddings...")
 
         contents = [prefix + content for content in contents]  # add prefix to answers
-        embeddings = self.encode(contents, batch_size, disable_progress_bar)
+        embeddings = self.encode(contents, batch_size, disable_progress_bar, max_tokens_per_batch)
 
         return embeddings
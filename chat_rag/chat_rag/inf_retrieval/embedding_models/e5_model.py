@@ -4,6 +4,7 @@ import torch
 from transformers import AutoTokenizer, AutoModel
 
 from chat_rag.inf_retrieval.embedding_models.base_model import BaseModel
+from chat_rag.inf_retrieval.inference_backends import load_backend
 
 logger = getLogger(__name__)
 
@@ -18,6 +19,7 @@ class E5Model(BaseModel):
         model_name: str = "intfloat/e5-small-v2",
         use_cpu: bool = False,
         huggingface_key: str = None,
+        backend: str = "torch",
     ):
         """
         Parameters
@@ -28,6 +30,9 @@ class E5Model(BaseModel):
             Whether to use CPU for encoding, by default False
         huggingface_key : str, optional
             Huggingface key to be used for private models, by default None
+        backend : str, optional
+            Inference backend, one of 'torch', 'torch_int8', 'onnx' or 'onnx_int8', by default 'torch'.
+            The optimized backends are only used on CPU, the ONNX models are exported on first load and cached on disk.
         """
 
         self.device = "cuda" if (not use_cpu and torch.cuda.is_available()) else "cpu"
@@ -46,3 +51,5 @@ class E5Model(BaseModel):
             model_name,
             token=huggingface_key,
         ).to(self.device)
+
+        self.model = load_backend(self.model, self.tokenizer, model_name, backend, self.device)
@@ -0,0 +1,157 @@
+import os
+from importlib.util import find_spec
+from types import SimpleNamespace
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
+
+# 'torch': eager PyTorch, 'torch_int8': PyTorch with the linear layers dynamically quantized to int8,
+# 'onnx': ONNX Runtime, 'onnx_int8': ONNX Runtime with the weights dynamically quantized to int8
+BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+# they need onnxruntime, installed with the onnx extra of chat-rag
+ONNX_BACKENDS = ("onnx", "onnx_int8")
+
+MODELS_CACHE_DIR = os.environ.get(
+    "CHAT_RAG_MODELS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "chat_rag", "models")
+)
+
+
+def onnx_available() -> bool:
+    return find_spec("onnxruntime") is not None and find_spec("onnx") is not None
+
+
+class ONNXModel:
+    """
+    Wraps an ONNX Runtime session so it is called like the transformers model it was exported from.
+    """
+
+    def __init__(self, path: str, output_name: str):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.output_name = output_name
+
+    def __call__(self, return_dict: bool = True, **inputs):
+        feed = {name: value.cpu().numpy() for name, value in inputs.items() if name in self.input_names}
+        output = self.session.run([self.output_name], feed)[0]
+        return SimpleNamespace(**{self.output_name: torch.from_numpy(output)})
+
+    # called by the wrappers of the PyTorch model (e.g. CrossEncoder.predict)
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+
+class ExportWrapper(torch.nn.Module):
+    """
+    Takes the inputs positionally and returns a single tensor, so the exported graph does not depend
+    on how the model handles keyword arguments and output dicts.
+    """
+
+    def __init__(self, model, output_name: str):
+        super().__init__()
+        self.model = model
+        self.output_name = output_name
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:  # XLM-RoBERTa based models have no token type ids
+            inputs["token_type_ids"] = token_type_ids
+        return getattr(self.model(**inputs, return_dict=True), self.output_name)
+
+
+def export_onnx(model, tokenizer, path: str, output_name: str):
+    """
+    Exports a transformers model to ONNX with dynamic batch and sequence axes.
+    It is written to a temporary file first so a concurrent load never sees a partial file.
+    """
+    dummy = tokenizer(["a query", "a somewhat longer passage"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes[output_name] = {0: "batch"} if output_name == "logits" else {0: "batch", 1: "sequence"}
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    wrapper = ExportWrapper(model.cpu().eval(), output_name)
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            tuple(dummy[name] for name in input_names),
+            tmp_path,
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+        )
+    os.replace(tmp_path, path)
+
+
+def load_backend(
+    model,
+    tokenizer,
+    model_name: str,
+    backend: str = "torch",
+    device: str = "cpu",
+    output_name: str = "last_hidden_state",
+):
+    """
+    Returns the model to use for the given backend, exporting and caching it on disk on first load.
+    Parameters
+    ----------
+    model : PreTrainedModel
+        The loaded transformers model.
+    tokenizer : PreTrainedTokenizer
+        Its tokenizer, used to trace the ONNX export.
+    model_name : str
+        The name of the model, used for the cache path.
+    backend : str
+        One of BACKENDS.
+    device : str
+        The optimized backends are CPU only, on GPU the PyTorch model is returned.
+    output_name : str
+        The output of the model to use, 'last_hidden_state' for encoders and 'logits' for cross-encoders.
+    """
+    if backend is None or backend == "torch":
+        return model
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend {backend} not supported, use one of {BACKENDS}")
+
+    if device != "cpu":
+        logger.warning(f"Backend {backend} is only used on CPU, using torch on {device}")
+        return model
+
+    if backend in ONNX_BACKENDS and not onnx_available():
+        logger.error(f"Backend {backend} needs onnxruntime, install chat-rag with the onnx extra, using torch")
+        return model
+
+    if backend == "torch_int8":
+        # dynamic quantization only takes a few seconds, so it is done on every load instead of cached
+        return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+    # an encoder and a cross-encoder may share the name, the exports of every output are cached apart
+    cache_path = os.path.join(MODELS_CACHE_DIR, model_name.replace("/", "--"), output_name)
+    onnx_path = os.path.join(cache_path, "onnx.onnx")
+    if not os.path.exists(onnx_path):
+        logger.info(f"Exporting {model_name} to ONNX in {onnx_path}")
+        export_onnx(model, tokenizer, onnx_path, output_name)
+
+    if backend == "onnx_int8":
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        int8_path = os.path.join(cache_path, "onnx_int8.onnx")
+        if not os.path.exists(int8_path):
+            logger.info(f"Quantizing {onnx_path} to int8 in {int8_path}")
+            tmp_path = f"{int8_path}.tmp{os.getpid()}"
+            quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+        onnx_path = int8_path
+
+    return ONNXModel(onnx_path, output_name)
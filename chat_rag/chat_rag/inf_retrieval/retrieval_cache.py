@@ -0,0 +1,87 @@
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from chat_rag.versioned_cache import VersionedLRUCache
+
+
+class RetrievalCache(VersionedLRUCache):
+    """
+    LRU cache with TTL of the retrieved contexts of the user messages.
+    The first tier is keyed by the normalized message text. The optional second tier reuses the contexts of
+    a cached message whose embedding has a cosine similarity above similarity_threshold with the new one.
+    The cache is cleared when its version (the index version of the RAG config) changes.
+    """
+
+    name = "Retrieval cache"
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl_s: float = 3600,
+        similarity_threshold: Optional[float] = None,
+    ):
+        """
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximum number of cached messages, by default 1024
+        ttl_s : float, optional
+            Seconds a cached result is valid, by default 3600
+        similarity_threshold : float, optional
+            Minimum cosine similarity of the embeddings for the semantic tier, by default None (disabled).
+        """
+        super().__init__(max_size, ttl_s)
+        self.similarity_threshold = similarity_threshold
+        self.semantic_hits = 0
+
+    @property
+    def semantic(self) -> bool:
+        return self.similarity_threshold is not None
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        message = unicodedata.normalize("NFKC", message).casefold()
+        message = re.sub(r"[^\w\s]", " ", message)
+        return " ".join(message.split())
+
+    def get(self, message: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        entry = self.lookup((self.normalize(message), top_k))  # (contexts, embedding)
+        return entry[0] if entry is not None else None
+
+    def get_similar(self, embedding, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Returns the contexts of the most similar cached message with the same top_k if it is above the threshold.
+        """
+        keys, embeddings = [], []
+        for key, (_, cached_embedding) in self.live_items():
+            if key[1] == top_k and cached_embedding is not None:
+                keys.append(key)
+                embeddings.append(cached_embedding)
+        if not keys:
+            return None
+
+        # the embeddings are normalized, so the inner product is the cosine similarity
+        similarities = np.stack(embeddings) @ np.asarray(embedding, dtype=np.float32)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+
+        self.entries.move_to_end(keys[best])
+        self.semantic_hits += 1
+        return self.entries[keys[best]][1][0]
+
+    def put(self, message: str, top_k: int, contexts: List[Dict[str, Any]], embedding=None):
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        self.store((self.normalize(message), top_k), (contexts, embedding))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            **super().stats(),
+            "semantic_hits": self.semantic_hits,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
@@ -1,4 +1,6 @@
 from chat_rag.inf_retrieval.retrievers.semantic_retriever import SemanticRetriever
 from chat_rag.inf_retrieval.retrievers.rerank_retriever import ReRankRetriever
 from chat_rag.inf_retrieval.retrievers.retriever_client import RetrieverClient
-from chat_rag.inf_retrieval.retrievers.colbert_retriever import ColBERTRetriever
\ No newline at end of file
+from chat_rag.inf_retrieval.retrievers.colbert_retriever import ColBERTRetriever
+from chat_rag.inf_retrieval.retrievers.bm25_retriever import BM25Retriever
+from chat_rag.inf_retrieval.retrievers.hybrid_retriever import HybridRetriever
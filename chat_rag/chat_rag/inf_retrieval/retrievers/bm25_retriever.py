@@ -0,0 +1,120 @@
+import re
+import math
+import unicodedata
+from collections import defaultdict
+from logging import getLogger
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+# words, keeping identifiers like product codes (e.g. "XJ-500", "v2.1") as a single token
+TOKEN_PATTERN = re.compile(r"\w+(?:[-_./]\w+)*")
+# identifiers that must match exactly: code-like tokens mixing letters and digits, at least 4 characters long
+# (e.g. "xj-500", "sku123", "v2.1"), so years, dates, "v2" or hyphenated words are ranked as regular terms
+IDENTIFIER_PATTERN = r"(?=.*[^\W\d_])(?=.*\d)[\w\-./]{4,}"
+
+
+class BM25Retriever:
+    """
+    In memory BM25 inverted index over a list of contents.
+    The weight of every posting is precomputed, so scoring a query is a scatter-add over the postings of its terms.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, identifier_pattern: Optional[str] = IDENTIFIER_PATTERN):
+        """
+        Parameters
+        ----------
+        k1 : float, optional
+            Term frequency saturation, by default 1.2
+        b : float, optional
+            Length normalization, by default 0.75
+        identifier_pattern : str, optional
+            Regex that the whole (casefolded) token must match to be an identifier of the exact matches,
+            by default IDENTIFIER_PATTERN. None disables the exact matches.
+        """
+        self.k1 = k1
+        self.b = b
+        self.identifier_pattern = re.compile(identifier_pattern) if identifier_pattern is not None else None
+        self.postings = {}  # term -> (document indexes, weights)
+        self.n_docs = 0
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold())
+
+    def is_identifier(self, token: str) -> bool:
+        """
+        Code-like tokens, such as product codes, that should match exactly.
+        """
+        return self.identifier_pattern is not None and self.identifier_pattern.fullmatch(token) is not None
+
+    def index(self, contents: List[str]):
+        """
+        Builds the index, the document indexes are the positions of the contents.
+        """
+        term_freqs = defaultdict(lambda: defaultdict(int))
+        doc_lengths = np.zeros(len(contents), dtype=np.float32)
+        for ndx, content in enumerate(contents):
+            tokens = self.tokenize(content or "")
+            doc_lengths[ndx] = len(tokens)
+            for token in tokens:
+                term_freqs[token][ndx] += 1
+
+        self.n_docs = len(contents)
+        avg_length = float(doc_lengths.mean()) if self.n_docs else 0.0
+        norms = self.k1 * (1 - self.b + self.b * doc_lengths / max(avg_length, 1e-9))
+
+        self.postings = {}
+        for term, freqs in term_freqs.items():
+            docs = np.fromiter(freqs.keys(), dtype=np.int64, count=len(freqs))
+            tfs = np.fromiter(freqs.values(), dtype=np.float32, count=len(freqs))
+            idf = math.log(1 + (self.n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.postings[term] = (docs, (idf * tfs * (self.k1 + 1) / (tfs + norms[docs])).astype(np.float32))
+
+        logger.info(f"BM25 index built with {self.n_docs} documents and {len(self.postings)} terms")
+
+    def exact_matches(self, query: str) -> Set[int]:
+        """
+        Returns the documents that contain all the identifiers of the query, empty if it has none.
+        """
+        identifiers = {token for token in self.tokenize(query) if self.is_identifier(token)}
+        if not identifiers:
+            return set()
+        docs = None
+        for token in identifiers:
+            if token not in self.postings:
+                return set()
+            token_docs = set(self.postings[token][0].tolist())
+            docs = token_docs if docs is None else docs & token_docs
+        return docs
+
+    def get_top_matches(
+        self, queries: List[str], top_k: int = 5
+    ) -> List[Tuple[np.ndarray, np.ndarray, Set[int]]]:
+        """
+        Returns the scores and document indexes of the top_k matches of every query, sorted by score,
+        and the documents that are exact matches of its identifiers.
+
+        Parameters
+        ----------
+        queries : List[str]
+            Queries to be used for retrieval.
+        top_k : int, optional
+            Number of documents to be returned, by default 5. If -1, all the matching documents are returned.
+        """
+        results = []
+        for query in queries:
+            scores = np.zeros(self.n_docs, dtype=np.float32)
+            for term in set(self.tokenize(query)):
+                if term in self.postings:
+                    docs, weights = self.postings[term]
+                    scores[docs] += weights
+
+            matches = np.flatnonzero(scores)
+            if top_k != -1 and top_k < len(matches):
+                matches = matches[np.argpartition(-scores[matches], top_k - 1)[:top_k]]
+            matches = matches[np.argsort(-scores[matches], kind="stable")]
+            results.append((scores[matches], matches, self.exact_matches(query)))
+        return results
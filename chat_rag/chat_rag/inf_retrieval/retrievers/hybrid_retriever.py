@@ -0,0 +1,127 @@
+from typing import Dict, List, Optional
+from logging import getLogger
+
+import torch
+
+from chat_rag.inf_retrieval.retrievers.semantic_retriever import SemanticRetriever
+from chat_rag.inf_retrieval.retrievers.bm25_retriever import BM25Retriever, IDENTIFIER_PATTERN
+
+logger = getLogger(__name__)
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> Dict[int, float]:
+    """
+    Fuses several rankings of document indexes, every document scores 1 / (k + rank) in each ranking it appears.
+
+    Parameters
+    ----------
+    rankings : List[List[int]]
+        Document indexes of every ranking, best first.
+    k : int, optional
+        Smoothing constant that lowers the weight of the top ranks, by default 60
+
+    Returns
+    -------
+    Dict[int, float]
+        Fused score of every document, sorted in descending order.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, ndx in enumerate(ranking, start=1):
+            scores[ndx] = scores.get(ndx, 0.0) + 1.0 / (k + rank)
+    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+
+
+class HybridRetriever:
+    """
+    Combines the dense search of a SemanticRetriever with a BM25 index over its 'content' column using
+    reciprocal rank fusion. Exact matches of the identifiers of a query (e.g. product codes) are flagged
+    with `exact_match` so they can be kept on top without reranking.
+    """
+
+    def __init__(
+        self,
+        semantic_retriever: SemanticRetriever,
+        rrf_k: int = 60,
+        k1: float = 1.2,
+        b: float = 0.75,
+        identifier_pattern: Optional[str] = IDENTIFIER_PATTERN,
+    ):
+        """
+        Parameters
+        ----------
+        semantic_retriever : SemanticRetriever
+            Dense retriever, the sparse index is built over its data.
+        rrf_k : int, optional
+            Smoothing constant of the reciprocal rank fusion, by default 60
+        k1 : float, optional
+            BM25 term frequency saturation, by default 1.2
+        b : float, optional
+            BM25 length normalization, by default 0.75
+        identifier_pattern : str, optional
+            Regex of the query tokens that are matched exactly, by default IDENTIFIER_PATTERN. None disables it.
+        """
+        self.semantic_retriever = semantic_retriever
+        self.rrf_k = rrf_k
+        self.sparse_retriever = BM25Retriever(k1=k1, b=b, identifier_pattern=identifier_pattern)
+        self.refresh_sparse_index()
+
+    def refresh_sparse_index(self):
+        """
+        Rebuilds the sparse index, to be called after the data of the semantic retriever changes.
+        """
+        data = self.semantic_retriever.data
+        self.sparse_retriever.index(data["content"] if data is not None else [])
+
+    def retrieve_from_embeddings(
+        self,
+        queries: List[str],
+        queries_embeddings: torch.Tensor,
+        top_k: int = 5,
+    ) -> List[List[Dict]]:
+        """
+        Returns the fused contexts of the queries.
+        Parameters
+        ----------
+        queries : List[str]
+            Queries, used for the sparse search.
+        queries_embeddings : torch.Tensor
+            Embeddings of the queries, one per row, used for the dense search.
+        top_k : int, optional
+            Number of context to be returned, by default 5. If -1, all context are returned.
+        Returns
+        -------
+        List[List[Dict]]
+            List of lists of dictionaries containing the context, with its dense 'similarity',
+            'rrf_score' and 'exact_match'.
+        """
+        semantic = self.semantic_retriever
+        if not semantic.len_data:
+            return [[] for _ in queries]
+
+        dense_matches = semantic.get_top_matches_from_embeddings(queries_embeddings, top_k=top_k)
+        sparse_matches = self.sparse_retriever.get_top_matches(queries, top_k=top_k)
+
+        results_list = []
+        for query_embedding, (_, dense_indexes), (_, sparse_indexes, exact) in zip(
+            queries_embeddings, dense_matches, sparse_matches
+        ):
+            # the sparse index still has the rows deleted since the store was loaded
+            sparse_indexes = [ndx for ndx in sparse_indexes.tolist() if ndx not in semantic.deleted]
+            exact = {ndx for ndx in exact if ndx not in semantic.deleted}
+            fused = reciprocal_rank_fusion([dense_indexes.tolist(), sparse_indexes], k=self.rrf_k)
+            exact_indexes = sorted(exact, key=lambda ndx: fused.get(ndx, 0.0), reverse=True)
+            indexes = exact_indexes + [ndx for ndx in fused if ndx not in exact]
+            if top_k != -1:
+                indexes = indexes[:top_k]
+
+            # dense similarity of all the results, including the ones only found by the sparse search
+            rows = semantic.get_rows(indexes)
+            similarities = torch.mv(rows.float(), query_embedding.to(rows.device).float()).cpu().numpy()
+
+            contexts = semantic._get_contexts((similarities, indexes))
+            for context, ndx in zip(contexts, indexes):
+                context["rrf_score"] = fused.get(ndx, 0.0)
+                context["exact_match"] = ndx in exact
+            results_list.append(contexts)
+        return results_list
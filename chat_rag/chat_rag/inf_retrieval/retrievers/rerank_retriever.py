@@ -21,8 +21,4 @@ class ReRankRetriever:
         top_k: int = 5,
     ):
         contexts_retrieved = self.retriever.retrieve(queries, top_k=top_k)  # retrieve contexts
-        contexts_ranked = []
-        for query, contexts in zip(queries, contexts_retrieved):
-            query_contexts = self.reranker(query, contexts)  # rerank and filter contexts
-            contexts_ranked.append(query_contexts)
-        return contexts_ranked
+        return self.reranker.batch_rerank(queries, contexts_retrieved)  # rerank and filter contexts
@@ -1,13 +1,17 @@
-import aiohttp
+from chat_rag.http_pool import PooledSession
 
 class RetrieverClient:
     """Client to retrieve documents from a retriever deployment."""
     def __init__(self, deployment_url):
         self.deployment_url = deployment_url
+        # the requests reuse the keep-alive connections to the deployment
+        self.http = PooledSession()
 
     async def retrieve(self, query, top_k=5):
-        async with aiohttp.ClientSession() as session:
-            data = {"query": query, "top_k": top_k}
-            async with session.post(self.deployment_url, json=data) as response:
-                result = await response.json()
-                return result
\ No newline at end of file
+        data = {"query": query, "top_k": top_k}
+        async with self.http.get().post(self.deployment_url, json=data) as response:
+            result = await response.json()
+            return result
+
+    async def close(self):
+        await self.http.close()
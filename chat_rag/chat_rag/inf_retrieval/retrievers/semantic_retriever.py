@@ -1,10 +1,13 @@
 from typing import List, Tuple, Dict, Optional
 from logging import getLogger
+import json
+import os
 
 import numpy as np
 import torch
 
 from chat_rag.inf_retrieval.embedding_models.base_model import BaseModel
+from chat_rag.inf_retrieval.quantization import quantize, quantized_scores
 
 logger = getLogger(__name__)
 
@@ -19,6 +22,8 @@ class SemanticRetriever:
         data: Dict[str, List[str]] = None,
         embeddings: Optional[np.ndarray] = None,
         embedding_model: Optional[BaseModel] = None,
+        quantization: Optional[str] = None,
+        rescore_multiplier: int = 4,
     ):
         """
         Parameters
@@ -29,6 +34,12 @@ class SemanticRetriever:
             List of embeddings to be used for retrieval, by default None
         embedding_model: BaseModel, optional
             Embedding model to be used for retrieval, by default None
+        quantization: str, optional
+            Search over 'float16', 'int8' or 'binary' quantized embeddings, by default None (full precision).
+            The top_k * rescore_multiplier candidates are then rescored with the full precision embeddings,
+            which only need to be read for those rows, so they can be memory-mapped from disk (see `load`).
+        rescore_multiplier: int, optional
+            Number of candidates per result to rescore when using quantization, by default 4
         """
 
         # assert that the length of every column is the same
@@ -38,12 +49,15 @@ class SemanticRetriever:
             ), "All columns must have the same length"
 
         self.data = data
-        self.len_data = len(data[list(data.keys())[0]]) if data is not None else None
         self.keys_list = list(data.keys()) if data is not None else None
 
         self.embeddings = (
             torch.from_numpy(embeddings) if embeddings is not None else None
         )
+        # The rows added by `upsert` are kept apart from the base embeddings and the deleted rows are only masked,
+        # so the incremental syncs never copy nor re-quantize a (memory-mapped) base, `save` writes them compacted
+        self.delta_embeddings = None
+        self.deleted = set()
 
         if embeddings is None:
             logger.info(f"Embeddings not provided.")
@@ -52,6 +66,83 @@ class SemanticRetriever:
 
         self.embedding_model = embedding_model
 
+        self.quantization = quantization
+        self.rescore_multiplier = rescore_multiplier
+        self.quantized_embeddings, self.quantization_scales = None, None
+        self.delta_quantized_embeddings = None
+        if quantization is not None and self.embeddings is not None:
+            self._quantize()
+
+    @property
+    def n_rows(self) -> int:
+        """
+        Number of rows of the base and the delta embeddings, including the deleted ones.
+        """
+        return len(self.data[self.keys_list[0]]) if self.data is not None else 0
+
+    @property
+    def len_data(self) -> Optional[int]:
+        """
+        Number of rows that are not deleted.
+        """
+        return self.n_rows - len(self.deleted) if self.data is not None else None
+
+    def _quantize(self):
+        self.quantized_embeddings, self.quantization_scales = quantize(
+            self.embeddings.float().cpu().numpy(), self.quantization
+        )
+
+    def _quantize_rows(self, embeddings: torch.Tensor) -> np.ndarray:
+        """
+        Quantizes new rows with the int8 scales of the base embeddings.
+        """
+        return quantize(embeddings.float().cpu().numpy(), self.quantization, scales=self.quantization_scales)[0]
+
+    def to(self, device, dtype):
+        """
+        Moves the base and the delta embeddings, a no-op if they already are on the device with the dtype.
+        """
+        self.embeddings = self.embeddings.to(device, dtype)
+        if self.delta_embeddings is not None:
+            self.delta_embeddings = self.delta_embeddings.to(device, dtype)
+        return self
+
+    def get_rows(self, indexes) -> torch.Tensor:
+        """
+        Returns the embeddings of the rows, reading only those rows of the base and the delta embeddings.
+        """
+        indexes = torch.as_tensor(indexes, dtype=torch.long, device=self.embeddings.device)
+        if self.delta_embeddings is None:
+            return self.embeddings[indexes]
+
+        n_base = len(self.embeddings)
+        in_base = indexes < n_base
+        rows = torch.empty((len(indexes), self.embeddings.shape[1]), dtype=self.embeddings.dtype, device=self.embeddings.device)
+        rows[in_base] = self.embeddings[indexes[in_base]]
+        rows[~in_base] = self.delta_embeddings[indexes[~in_base] - n_base]
+        return rows
+
+    def _mask_deleted(self, scores, indexes=None):
+        """
+        Sets the scores of the deleted rows to -inf, scores has one column per row or per index of indexes.
+        """
+        if not self.deleted:
+            return scores
+        if indexes is None:
+            scores[:, list(self.deleted)] = float("-inf")
+        else:
+            deleted = [ndx for ndx, row in enumerate(np.asarray(indexes).tolist()) if row in self.deleted]
+            scores[:, deleted] = float("-inf")
+        return scores
+
+    def _drop_deleted(self, scores_indexes):
+        if not self.deleted:
+            return scores_indexes
+        return [
+            (score_list[np.isfinite(score_list)], index_list[np.isfinite(score_list)])
+            for score_list, index_list in scores_indexes
+        ]
+
     def get_top_matches(
         self,
         queries: List[str],
@@ -91,50 +182,132 @@ class SemanticRetriever:
         queries_embeddings = self.embedding_model.encode(
             queries, disable_progress_bar=disable_progress_bar
         )
-        scores = (
-            torch.mm(queries_embeddings, self.embeddings.transpose(0, 1)).cpu().numpy()
-        )
 
-        sorted_indices = np.argsort(scores, axis=1)[:, ::-1]
-
-        # Use numpy's advanced indexing to get the sorted scores and indices
-        sorted_scores = np.take_along_axis(scores, sorted_indices, axis=1)[
-            :, :, None
-        ]  # Add a new axis to be able to broadcast
-        sorted_indexes = np.take_along_axis(
-            np.broadcast_to(np.arange(scores.shape[1]), scores.shape),
-            sorted_indices,
-            axis=1,
-        )[
-            :, :, None
-        ]  # Add a new axis to be able to broadcast
-
-        # If threshold is given, create a mask for scores
-        mask = (
-            sorted_scores >= threshold
-            if threshold is not None
-            else np.ones_like(sorted_scores, dtype=bool)
+        return self.get_top_matches_from_embeddings(
+            queries_embeddings, top_k=top_k, threshold=threshold
         )
 
-        # Use the mask to filter values
-        sorted_scores = np.where(mask, sorted_scores, -np.inf).squeeze(-1)
-        sorted_indexes = np.where(mask, sorted_indexes, -1).squeeze(-1)
+    def get_top_matches_from_embeddings(
+        self,
+        queries_embeddings: torch.Tensor,
+        top_k: int = 5,
+        threshold: float = None,
+    ) -> List[Tuple[List[float], List[int]]]:
+        """
+        Returns the top_k most relevant context for the already encoded queries.
+
+        Parameters
+        ----------
+        queries_embeddings : torch.Tensor
+            Embeddings of the queries, one per row.
+        top_k : int, optional
+            Number of context to be returned, by default 5. If -1, all context are returned.
+        threshold : float, optional
+            Minimum score to be returned, by default None.
 
-        # remove the masked values
-        sorted_scores = sorted_scores[sorted_scores != -np.inf].reshape(
-            len(queries), -1
-        )
-        sorted_indexes = sorted_indexes[sorted_indexes != -1].reshape(len(queries), -1)
+        Returns
+        -------
+        list
+            List containing tuples of scores and indexes of the context.
+        """
+        if self.quantization is not None and top_k != -1:
+            return self._get_top_matches_quantized(queries_embeddings, top_k, threshold)
 
-        # If top_k is not -1, truncate results
-        if top_k != -1:
-            sorted_scores = sorted_scores[:, :top_k]
-            sorted_indexes = sorted_indexes[:, :top_k]
+        queries_embeddings = queries_embeddings.to(self.embeddings.device, self.embeddings.dtype)
+        # topk is not implemented for half precision on CPU
+        scores = torch.mm(queries_embeddings, self.embeddings.transpose(0, 1)).float()
+        if self.delta_embeddings is not None:
+            scores = torch.cat((scores, torch.mm(queries_embeddings, self.delta_embeddings.transpose(0, 1)).float()), dim=1)
+        scores = self._mask_deleted(scores)
 
-        scores_indexes = [
-            (score_list, index_list)
-            for score_list, index_list in zip(sorted_scores, sorted_indexes)
+        return self._drop_deleted(self.select_top_matches(scores, top_k=top_k, threshold=threshold))
+
+    def _get_top_matches_quantized(
+        self,
+        queries_embeddings: torch.Tensor,
+        top_k: int,
+        threshold: float = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Searches the quantized embeddings for candidates and rescores them with the full precision embeddings.
+        """
+        queries_embeddings = queries_embeddings.float().cpu()
+        approx_scores = [
+            quantized_scores(
+                queries_embeddings.numpy(),
+                quantized,
+                self.quantization,
+                scales=self.quantization_scales,
+                dim=self.embeddings.shape[1],
+            )
+            for quantized in (self.quantized_embeddings, self.delta_quantized_embeddings)
+            if quantized is not None
         ]
+        approx_scores = self._mask_deleted(torch.from_numpy(np.concatenate(approx_scores, axis=1)))
+        n_candidates = min(top_k * max(self.rescore_multiplier, 1), self.n_rows)
+        candidates = torch.topk(approx_scores, n_candidates, dim=1).indices
+
+        scores_indexes = []
+        for query_embedding, query_candidates in zip(queries_embeddings, candidates):
+            # only the candidate rows of the (possibly memory-mapped) full precision embeddings are read
+            candidate_embeddings = self.get_rows(query_candidates)
+            exact_scores = torch.mv(candidate_embeddings.float(), query_embedding.to(candidate_embeddings.device))
+            exact_scores = self._mask_deleted(exact_scores[None, :], query_candidates)
+            score_list, positions = self.select_top_matches(exact_scores, top_k, threshold)[0]
+            scores_indexes.append((score_list, query_candidates.numpy()[positions]))
+        return self._drop_deleted(scores_indexes)
+
+    @staticmethod
+    def select_top_matches(
+        scores: torch.Tensor,
+        top_k: int = 5,
+        threshold: float = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Selects the top_k scores of every row sorted in descending order.
+        Only the top_k candidates are sorted (O(N + k log k) per query instead of sorting all the N scores)
+        and when all the results are requested the threshold is applied before sorting.
+
+        Parameters
+        ----------
+        scores : torch.Tensor
+            Scores of every query (rows) against every context (columns).
+        top_k : int, optional
+            Number of context to be returned, by default 5. If -1, all context are returned.
+        threshold : float, optional
+            Minimum score to be returned, by default None.
+
+        Returns
+        -------
+        list
+            List containing tuples of scores and indexes of the context.
+        """
+        n_contexts = scores.shape[1]
+
+        if top_k != -1 and top_k < n_contexts:
+            top_scores, top_indexes = torch.topk(scores, top_k, dim=1, sorted=True)
+            top_scores, top_indexes = top_scores.cpu().numpy(), top_indexes.cpu().numpy()
+
+            scores_indexes = []
+            for score_list, index_list in zip(top_scores, top_indexes):
+                if threshold is not None:
+                    # the scores are sorted, so the ones above the threshold are a prefix
+                    n_above = int(np.count_nonzero(score_list >= threshold))
+                    score_list, index_list = score_list[:n_above], index_list[:n_above]
+                scores_indexes.append((score_list, index_list))
+            return scores_indexes
+
+        scores = scores.cpu().numpy()
+        scores_indexes = []
+        for score_list in scores:
+            index_list = (
+                np.flatnonzero(score_list >= threshold)
+                if threshold is not None
+                else np.arange(n_contexts)
+            )
+            order = np.argsort(-score_list[index_list], kind="stable")
+            index_list = index_list[order]
+            scores_indexes.append((score_list[index_list], index_list))
         return scores_indexes
 
     def _get_contexts(
@@ -157,7 +330,7 @@ class SemanticRetriever:
         # Iterate through the matches
         for match in zip(*matches):
             context_dict = {}
-            context_dict['similarity'] = match[0]
+            context_dict['similarity'] = float(match[0])
             # Extract data based on the keys and the matched index
             for key in self.keys_list:  # Using `self.keys_list` here
                 context_dict[key] = self.data[key][match[1]]
@@ -217,3 +390,202 @@ class SemanticRetriever:
         )
 
         return self.get_contexts(matches_batch)
+
+    def retrieve_from_embeddings(
+        self,
+        queries_embeddings: torch.Tensor,
+        top_k: int = 5,
+        threshold: float = None,
+    ) -> List[List[Dict[str, str]]]:
+        """
+        Returns the context for the already encoded queries.
+        Parameters
+        ----------
+        queries_embeddings : torch.Tensor
+            Embeddings of the queries, one per row.
+        top_k : int, optional
+            Number of context to be returned, by default 5. If -1, all context are returned.
+        threshold : float, optional
+            Minimum score to be returned, by default None.
+        Returns
+        -------
+        List[List[Dict[str, str]]]
+            List of lists of dictionaries containing the context.
+        """
+        matches_batch = self.get_top_matches_from_embeddings(
+            queries_embeddings, top_k=top_k, threshold=threshold
+        )
+
+        return self.get_contexts(matches_batch)
+
+    def upsert(
+        self, key: str, data: Dict[str, List], embeddings: np.ndarray
+    ):
+        """
+        Inserts new rows or replaces the existing ones, rows are identified by the `key` column.
+        The replaced rows are written in place (only their pages of a memory-mapped base are copied) and the new ones
+        are appended to the delta embeddings, only these rows are quantized.
+        Parameters
+        ----------
+        key : str
+            Name of the column that identifies the rows.
+        data : Dict[str, List]
+            Dictionary with the columns of the rows to upsert.
+        embeddings : np.ndarray
+            Embeddings of the rows to upsert.
+        """
+        if len(data[key]) == 0:
+            return
+
+        embeddings = torch.from_numpy(np.ascontiguousarray(embeddings))
+
+        if self.data is None:
+            self.data = {col: list(values) for col, values in data.items()}
+            self.keys_list = list(data.keys())
+            self.embeddings = embeddings
+            if self.quantization is not None:
+                self._quantize()
+            return
+
+        embeddings = embeddings.to(self.embeddings.device, self.embeddings.dtype)
+        quantized = self._quantize_rows(embeddings) if self.quantization is not None else None
+        positions = {row_id: ndx for ndx, row_id in enumerate(self.data[key])}
+        n_base = len(self.embeddings)
+
+        new_rows = []
+        for ndx, row_id in enumerate(data[key]):
+            if row_id in positions:  # replace in place
+                position = positions[row_id]
+                for col in self.keys_list:
+                    self.data[col][position] = data[col][ndx]
+                self.deleted.discard(position)
+                if position < n_base:
+                    self.embeddings[position] = embeddings[ndx]
+                    if quantized is not None:
+                        self.quantized_embeddings[position] = quantized[ndx]
+                else:
+                    self.delta_embeddings[position - n_base] = embeddings[ndx]
+                    if quantized is not None:
+                        self.delta_quantized_embeddings[position - n_base] = quantized[ndx]
+            else:
+                new_rows.append(ndx)
+
+        if new_rows:
+            for col in self.keys_list:
+                self.data[col].extend(data[col][ndx] for ndx in new_rows)
+            new_embeddings = embeddings[new_rows]
+            self.delta_embeddings = (
+                new_embeddings if self.delta_embeddings is None else torch.cat((self.delta_embeddings, new_embeddings))
+            )
+            if quantized is not None:
+                new_quantized = quantized[new_rows]
+                self.delta_quantized_embeddings = (
+                    new_quantized
+                    if self.delta_quantized_embeddings is None
+                    else np.concatenate((self.delta_quantized_embeddings, new_quantized))
+                )
+
+    def delete(self, key: str, row_ids: List):
+        """
+        Deletes the rows whose `key` column is in `row_ids`, they are masked in the searches until the store is saved.
+        Parameters
+        ----------
+        key : str
+            Name of the column that identifies the rows.
+        row_ids : List
+            Identifiers of the rows to delete.
+        """
+        if self.data is None or not row_ids:
+            return
+
+        row_ids = set(row_ids)
+        self.deleted.update(ndx for ndx, row_id in enumerate(self.data[key]) if row_id in row_ids)
+
+    def _live_quantized_embeddings(self, live: List[int]) -> np.ndarray:
+        quantized = self.quantized_embeddings
+        if self.delta_quantized_embeddings is not None:
+            quantized = np.concatenate((quantized, self.delta_quantized_embeddings))
+        return quantized[live]
+
+    def compact(self):
+        """
+        Merges the delta embeddings into the base ones and drops the deleted rows. It copies all the embeddings,
+        so it is meant for building a store, the replicas that serve it load the compacted copy saved on disk.
+        """
+        if self.delta_embeddings is None and not self.deleted:
+            return
+
+        live = [ndx for ndx in range(self.n_rows) if ndx not in self.deleted]
+        embeddings = self.get_rows(live)
+        if self.quantized_embeddings is not None:
+            self.quantized_embeddings = self._live_quantized_embeddings(live)
+        self.data = {col: [self.data[col][ndx] for ndx in live] for col in self.keys_list}
+        self.embeddings = embeddings
+        self.delta_embeddings, self.delta_quantized_embeddings = None, None
+        self.deleted = set()
+
+    def save(self, path: str):
+        """
+        Saves the data and the embeddings as .npy files that `load` can memory-map,
+        the delta embeddings are merged with the base ones and the deleted rows are left out.
+        Parameters
+        ----------
+        path : str
+            Directory where to save the files.
+        """
+        live = [ndx for ndx in range(self.n_rows) if ndx not in self.deleted]
+        data = {col: [self.data[col][ndx] for ndx in live] for col in self.keys_list} if self.data is not None else None
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "data.json"), "w") as f:
+            json.dump(data, f)
+        np.save(os.path.join(path, "embeddings.npy"), self.get_rows(live).float().cpu().numpy())
+        if self.quantization is not None:
+            np.save(os.path.join(path, f"embeddings_{self.quantization}.npy"), self._live_quantized_embeddings(live))
+            if self.quantization_scales is not None:
+                np.save(os.path.join(path, f"scales_{self.quantization}.npy"), self.quantization_scales)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        embedding_model: Optional[BaseModel] = None,
+        quantization: Optional[str] = None,
+        rescore_multiplier: int = 4,
+        mmap: bool = True,
+    ):
+        """
+        Loads a retriever saved with `save`.
+        With mmap the embeddings are memory-mapped copy-on-write, so the processes of the same node
+        that load the same files share the pages of the OS cache instead of each holding its own copy.
+        Parameters
+        ----------
+        path : str
+            Directory where the files were saved.
+        embedding_model : BaseModel, optional
+            Embedding model to be used for retrieval, by default None
+        quantization : str, optional
+            Quantization to use, it is computed if it was not saved, by default None
+        rescore_multiplier : int, optional
+            Number of candidates per result to rescore when using quantization, by default 4
+        mmap : bool, optional
+            Whether to memory-map the embeddings, by default True
+        """
+        mmap_mode = "c" if mmap else None
+        with open(os.path.join(path, "data.json")) as f:
+            data = json.load(f)
+
+        instance = cls(data=data, embedding_model=embedding_model, rescore_multiplier=rescore_multiplier)
+        instance.embeddings = torch.from_numpy(np.load(os.path.join(path, "embeddings.npy"), mmap_mode=mmap_mode))
+        instance.quantization = quantization
+
+        quantized_path = os.path.join(path, f"embeddings_{quantization}.npy")
+        if quantization is not None and os.path.exists(quantized_path):
+            instance.quantized_embeddings = np.load(quantized_path, mmap_mode=mmap_mode)
+            scales_path = os.path.join(path, f"scales_{quantization}.npy")
+            if os.path.exists(scales_path):
+                instance.quantization_scales = np.load(scales_path)
+        elif quantization is not None:
+            instance._quantize()
+
+        return instance
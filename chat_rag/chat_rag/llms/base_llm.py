@@ -1,9 +1,9 @@
-from typing import List, Dict, Optional
-import os
-
-from transformers import AutoTokenizer, AutoConfig
+from functools import cached_property
+from typing import List, Dict, Optional, Tuple
 
 from chat_rag.exceptions import PromptTooLongException
+from chat_rag.llms.prompt_fitting import TokenCountCache, fit_counts
+from chat_rag.llms.tokenizers import get_model_max_length, get_tokenizer
 
 
 CONTEXT_PREFIX = {
@@ -18,39 +18,66 @@ NO_CONTEXT_SUFFIX = {
     "es": "No se proporciona información.",
 }
 
+# Estimate of the tokens a chat template adds around every message, the fitted prompt is checked anyway
+CHAT_TEMPLATE_MESSAGE_TOKENS = 10
+
 
 
 
 class RAGLLM:
+    # counts the tokens of the prompts instead of the HuggingFace tokenizer of the model, set by the remote clients
+    token_counter = None
+
     def __init__(
         self,
         llm_name: str,
         model_max_length: int = None,
         trust_remote_code_tokenizer: bool = False,
         trust_remote_code_model: bool = False,
+        token_counter=None,
         **kwargs,
     ) -> None:
+        """
+        Nothing is loaded here, the tokenizer and the config of the model are loaded from the process-wide registry
+        the first time they are needed, so the clients can be built offline and in no time.
+        """
+        self.llm_name = llm_name
+        self.trust_remote_code_tokenizer = trust_remote_code_tokenizer
+        self.trust_remote_code_model = trust_remote_code_model
+        if model_max_length is not None:
+            self.model_max_length = model_max_length
+        if token_counter is not None:
+            self.token_counter = token_counter
 
-        auth_token = os.environ["HUGGINGFACE_KEY"]
+    @cached_property
+    def tokenizer(self):
+        return get_tokenizer(self.llm_name, self.trust_remote_code_tokenizer)
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            llm_name, trust_remote_code=trust_remote_code_tokenizer, token=auth_token
-        )
+    @cached_property
+    def model_max_length(self) -> int:
+        model_max_length = get_model_max_length(self.llm_name, self.trust_remote_code_model, self.tokenizer)
+        print(f"Model max length: {model_max_length}")
+        return model_max_length
 
-        if model_max_length is not None:
-            self.model_max_length = model_max_length
-        else:
-            self.config = AutoConfig.from_pretrained(
-                llm_name, trust_remote_code=trust_remote_code_model, token=auth_token
-            )
-            self.model_max_length = (
-                self.config.max_position_embeddings
-                if self.config.max_position_embeddings is not None
-                else self.tokenizer.model_max_length
-            )
+    @cached_property
+    def has_chat_template(self) -> bool:
+        return self.token_counter is None and self.tokenizer.chat_template is not None
 
-        self.has_chat_template = self.tokenizer.chat_template is not None
-        print(f"Model max length: {self.model_max_length}")
+    def load_tokenizer(self):
+        """
+        Loads the tokenizer and the config of the model ahead of the first request, a no-op for the token counters.
+        """
+        if self.token_counter is None:
+            self.has_chat_template
+            self.model_max_length
+
+    def num_tokens(self, text: str) -> int:
+        """
+        Returns the number of tokens of a text, with the token counter of the client if it has one.
+        """
+        if self.token_counter is not None:
+            return self.token_counter.count(text)
+        return len(self.tokenizer.tokenize(text))
 
 
     def format_system_prompt(
@@ -149,31 +176,94 @@ class RAGLLM:
             The language of the prompt, by default 'en'
         """
 
-        n_messages_to_keep = len(messages)
-        n_contexts = n_contexts_to_use if len(contexts) > n_contexts_to_use else len(contexts)
-
-        prompt = self.apply_chat_template(messages, contexts, system_prefix, system_tag, system_end, user_tag, user_end, assistant_tag, assistant_end, lang)
-        num_tokens = len(self.tokenizer.tokenize(prompt))
+        n_contexts = min(n_contexts_to_use, len(contexts))
+        contexts = contexts[:n_contexts]
 
         margin = int(self.model_max_length * 0.1)
+        max_tokens = self.model_max_length - margin
 
-        while num_tokens > (self.model_max_length -  margin):
+        # every message and context is tokenized once and the largest fitting set is found from the counts
+        n_contexts, n_messages_to_keep = fit_counts(
+            *self.estimate_prompt_tokens(messages, contexts, system_prefix, system_tag, system_end, user_tag, user_end, assistant_tag, assistant_end, lang),
+            max_tokens,
+        )
 
-            if n_contexts == 1 and n_messages_to_keep > 1:
+        # the sum of the parts is an estimate of the tokens of the whole prompt, so it is checked once
+        while True:
+            prompt = self.apply_chat_template(messages[len(messages) - n_messages_to_keep:], contexts[:n_contexts], system_prefix, system_tag, system_end, user_tag, user_end, assistant_tag, assistant_end, lang)
+            if self.num_tokens(prompt) <= max_tokens:
+                return prompt, (n_contexts, n_messages_to_keep)
+
+            if n_contexts > 1:
+                n_contexts -= 1
+            elif n_messages_to_keep > 1:
                 n_messages_to_keep -= 1
+            else:
+                raise PromptTooLongException()
 
-            n_contexts = n_contexts - 1 if n_contexts > 1 else 1
+    def count_tokens(self, text: str) -> int:
+        """
+        Returns the number of tokens of a text, cached by its content hash.
+        """
+        if getattr(self, "token_count_cache", None) is None:
+            self.token_count_cache = TokenCountCache(self.num_tokens)
+        return self.token_count_cache.count(text)
 
-            # When we reach the minimum number of contexts and messages and the prompt is still too long, we return None
-            if n_contexts == 1 and n_messages_to_keep == 1:
-                raise PromptTooLongException()
+    def estimate_system_prompt_tokens(self, contexts, system_prefix, lang):
+        """
+        Returns the tokens of the fixed part of the system prompt and of every context.
+        """
+        if contexts:
+            fixed_tokens = self.count_tokens(f"{system_prefix}\n{CONTEXT_PREFIX[lang]}\n")
+            # the newline between contexts
+            contexts_tokens = [self.count_tokens(f"- {context}") + 1 for context in contexts]
+        else:
+            fixed_tokens = self.count_tokens(self.format_system_prompt(contexts, system_prefix, lang))
+            contexts_tokens = []
+        return fixed_tokens, contexts_tokens
 
-            prompt = self.apply_chat_template(messages[:n_messages_to_keep], contexts[:n_contexts], system_prefix, system_tag, system_end, user_tag, user_end, assistant_tag, assistant_end, lang)
+    def fit_chat_prompt(
+        self,
+        messages: List[Dict[str, str]],
+        contexts: List[str],
+        system_prefix: str,
+        n_contexts_to_use: int = 3,
+        lang: str = "en",
+    ) -> Tuple[str, List[Dict[str, str]]]:
+        """
+        Returns the system prompt and the messages for the chat APIs of the remote providers, with the contexts and
+        the oldest messages that do not fit in model_max_length left out, counted with the token counter of the client.
+        """
+        contexts = contexts[:n_contexts_to_use]
+        max_tokens = self.model_max_length - int(self.model_max_length * 0.1)
+
+        fixed_tokens, contexts_tokens = self.estimate_system_prompt_tokens(contexts, system_prefix, lang)
+        # the providers apply their chat template to the system prompt and to every message
+        fixed_tokens += CHAT_TEMPLATE_MESSAGE_TOKENS
+        messages_tokens = [self.count_tokens(message['content']) + CHAT_TEMPLATE_MESSAGE_TOKENS for message in messages]
+        n_contexts, n_messages_to_keep = fit_counts(fixed_tokens, contexts_tokens, messages_tokens, max_tokens)
 
-            # get number of tokens
-            num_tokens = len(self.tokenizer.tokenize(prompt))
+        system_prompt = self.format_system_prompt(contexts[:n_contexts], system_prefix, lang)
+        return system_prompt, messages[len(messages) - n_messages_to_keep:]
 
-        return prompt, (n_contexts, n_messages_to_keep)
+    def estimate_prompt_tokens(self, messages, contexts, system_prefix, system_tag, system_end, user_tag, user_end, assistant_tag, assistant_end, lang):
+        """
+        Returns the tokens of the fixed part of the prompt, of every context and of every message with its tags.
+        """
+        fixed_tokens, contexts_tokens = self.estimate_system_prompt_tokens(contexts, system_prefix, lang)
+
+        if self.has_chat_template:
+            fixed_tokens += CHAT_TEMPLATE_MESSAGE_TOKENS
+            messages_tokens = [self.count_tokens(message['content']) + CHAT_TEMPLATE_MESSAGE_TOKENS for message in messages]
+        else:
+            fixed_tokens += self.count_tokens(f"{system_tag}{system_end or ''}") if system_tag else 1
+            user_tags_tokens = self.count_tokens(f"{user_tag}{user_end}{assistant_tag}")
+            assistant_tags_tokens = self.count_tokens(f"{assistant_end}")
+            messages_tokens = [
+                self.count_tokens(message['content']) + (user_tags_tokens if message['role'] == 'user' else assistant_tags_tokens)
+                for message in messages
+            ]
+        return fixed_tokens, contexts_tokens, messages_tokens
 
     def generate(
         self,
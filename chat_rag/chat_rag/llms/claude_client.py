@@ -4,17 +4,31 @@ from typing import Dict, List
 from anthropic import Anthropic, AsyncAnthropic
 
 from chat_rag.llms import CONTEXT_PREFIX, RAGLLM
+from chat_rag.llms.tokenizers import PROVIDER_MODEL_MAX_LENGTH, get_token_counter
 
 
 class ClaudeChatModel(RAGLLM):
-    def __init__(self, llm_name, **kwargs) -> None:
-        self.llm_name = llm_name
+    def __init__(
+        self,
+        llm_name,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH["claude"],
+            token_counter=get_token_counter("claude", tokenizer_name, chars_per_token),
+            **kwargs,
+        )
         self.client = Anthropic(
             api_key=os.environ.get("ANTHROPIC_API_KEY"),
         )
 
     def format_prompt(
         self,
+        messages: List[Dict[str, str]],
         contexts: List[str],
         system_prefix: str,
         n_contexts_to_use: int = 3,
@@ -25,6 +39,8 @@ class ClaudeChatModel(RAGLLM):
         Formats the prompt to be used by the model.
         Parameters
         ----------
+        messages : List[Tuple[str, str]]
+            The messages to use for the prompt. Pair of (role, message).
         contexts : list
             The context to use.
         system_prefix : str
@@ -43,17 +59,10 @@ class ClaudeChatModel(RAGLLM):
             The tag to indicate the end of the assistant output.
         Returns
         -------
-        list
-            The formatted prompt.
+        Tuple[str, list]
+            The system prompt and the messages that fit in the context of the model.
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
-
-        return system_prompt
+        return self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
 
     def generate(
         self,
@@ -84,7 +93,7 @@ class ClaudeChatModel(RAGLLM):
             The generated text.
         """
 
-        system_prompt = self.format_prompt(contexts, **prompt_structure_dict, lang=lang)
+        system_prompt, messages = self.format_prompt(messages, contexts, **prompt_structure_dict, lang=lang)
 
         message = self.client.messages.create(
             model=self.llm_name,
@@ -127,7 +136,7 @@ class ClaudeChatModel(RAGLLM):
             The generated text.
         """
 
-        system_prompt = self.format_prompt(contexts, **prompt_structure_dict, lang=lang)
+        system_prompt, messages = self.format_prompt(messages, contexts, **prompt_structure_dict, lang=lang)
 
         stream = self.client.messages.create(
             model=self.llm_name,
@@ -146,14 +155,27 @@ class ClaudeChatModel(RAGLLM):
 
         
 class AsyncClaudeChatModel(RAGLLM):
-    def __init__(self, llm_name, **kwargs) -> None:
-        self.llm_name = llm_name
+    def __init__(
+        self,
+        llm_name,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH["claude"],
+            token_counter=get_token_counter("claude", tokenizer_name, chars_per_token),
+            **kwargs,
+        )
         self.client = AsyncAnthropic(
             api_key=os.environ.get("ANTHROPIC_API_KEY")
         )
 
     def format_prompt(
         self,
+        messages: List[Dict[str, str]],
         contexts: List[str],
         system_prefix: str,
         n_contexts_to_use: int = 3,
@@ -164,6 +186,8 @@ class AsyncClaudeChatModel(RAGLLM):
         Formats the prompt to be used by the model.
         Parameters
         ----------
+        messages : List[Tuple[str, str]]
+            The messages to use for the prompt. Pair of (role, message).
         contexts : list
             The context to use.
         system_prefix : str
@@ -182,17 +206,10 @@ class AsyncClaudeChatModel(RAGLLM):
             The tag to indicate the end of the assistant output.
         Returns
         -------
-        list
-            The formatted prompt.
+        Tuple[str, list]
+            The system prompt and the messages that fit in the context of the model.
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
-
-        return system_prompt
+        return self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
     
     async def generate(
         self,
@@ -223,7 +240,7 @@ class AsyncClaudeChatModel(RAGLLM):
             The generated text.
         """
 
-        system_prompt = self.format_prompt(contexts, **prompt_structure_dict, lang=lang)
+        system_prompt, messages = self.format_prompt(messages, contexts, **prompt_structure_dict, lang=lang)
 
         message = await self.client.messages.create(
             model=self.llm_name,
@@ -266,7 +283,7 @@ class AsyncClaudeChatModel(RAGLLM):
             The generated text.
         """
 
-        system_prompt = self.format_prompt(contexts, **prompt_structure_dict, lang=lang)
+        system_prompt, messages = self.format_prompt(messages, contexts, **prompt_structure_dict, lang=lang)
 
         stream = await self.client.messages.create(
             model=self.llm_name,
@@ -6,6 +6,7 @@ from mistralai.client import MistralClient
 from mistralai.models.chat_completion import ChatMessage
 
 from chat_rag.llms import RAGLLM
+from chat_rag.llms.tokenizers import PROVIDER_MODEL_MAX_LENGTH, get_token_counter
 
 
 class MistralChatModel(RAGLLM):
@@ -13,10 +14,18 @@ class MistralChatModel(RAGLLM):
         self,
         llm_name: str,
         base_url: str = None,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
         **kwargs,
     ):
         self.client = MistralClient(api_key=os.environ["MISTRAL_API_KEY"])
-        self.llm_name = llm_name
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH["mistral"],
+            token_counter=get_token_counter("mistral", tokenizer_name, chars_per_token),
+            **kwargs,
+        )
 
     def format_prompt(
         self,
@@ -55,12 +64,7 @@ class MistralChatModel(RAGLLM):
         lang : str, optional
             The language of the prompt, by default 'en'
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
+        system_prompt, messages = self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
         final_messages = [ChatMessage(role='system', content=system_prompt)]  \
             + [ChatMessage(role=message['role'], content=message['content']) for message in messages]
         
@@ -169,10 +173,18 @@ class AsyncMistralChatModel(RAGLLM):
     def __init__(
         self,
         llm_name: str,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
         **kwargs,
     ):
         self.client = MistralAsyncClient(api_key=os.environ["MISTRAL_API_KEY"])
-        self.llm_name = llm_name
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH["mistral"],
+            token_counter=get_token_counter("mistral", tokenizer_name, chars_per_token),
+            **kwargs,
+        )
 
     def format_prompt(
         self,
@@ -211,12 +223,7 @@ class AsyncMistralChatModel(RAGLLM):
         lang : str, optional
             The language of the prompt, by default 'en'
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
+        system_prompt, messages = self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
         final_messages = [ChatMessage(role='system', content=system_prompt)]  \
             + [ChatMessage(role=message['role'], content=message['content']) for message in messages]
         
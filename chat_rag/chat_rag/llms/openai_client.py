@@ -4,6 +4,7 @@ from typing import Dict, List
 from openai import AsyncOpenAI, OpenAI
 
 from chat_rag.llms import RAGLLM
+from chat_rag.llms.tokenizers import PROVIDER_MODEL_MAX_LENGTH, get_token_counter
 
 
 class OpenAIChatModel(RAGLLM):
@@ -11,12 +12,21 @@ class OpenAIChatModel(RAGLLM):
         self,
         llm_name: str,
         base_url: str = None,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
         **kwargs,
     ):  
         # If provided a base_url, then use the Together API key
         api_key = os.environ.get("TOGETHER_API_KEY") if base_url else os.environ.get("OPENAI_API_KEY")
         self.client = OpenAI(api_key=api_key, base_url=base_url)
-        self.llm_name = llm_name
+        provider = "together" if base_url else "openai"
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH[provider],
+            token_counter=get_token_counter(provider, tokenizer_name, chars_per_token),
+            **kwargs,
+        )
 
     def format_prompt(
         self,
@@ -55,12 +65,7 @@ class OpenAIChatModel(RAGLLM):
         lang : str, optional
             The language of the prompt, by default 'en'
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
+        system_prompt, messages = self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
 
         final_messages = [{'role': 'system', 'content': system_prompt}] + messages
 
@@ -172,12 +177,21 @@ class AsyncOpenAIChatModel(RAGLLM):
         self,
         llm_name: str,
         base_url: str = None,
+        model_max_length: int = None,
+        tokenizer_name: str = None,
+        chars_per_token: float = None,
         **kwargs,
     ):
         # If provided a base_url, then use the Together API key
         api_key = os.environ.get("TOGETHER_API_KEY") if base_url else os.environ.get("OPENAI_API_KEY")
         self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
-        self.llm_name = llm_name
+        provider = "together" if base_url else "openai"
+        super().__init__(
+            llm_name,
+            model_max_length=model_max_length or PROVIDER_MODEL_MAX_LENGTH[provider],
+            token_counter=get_token_counter(provider, tokenizer_name, chars_per_token),
+            **kwargs,
+        )
 
     def format_prompt(
         self,
@@ -216,12 +230,7 @@ class AsyncOpenAIChatModel(RAGLLM):
         lang : str, optional
             The language of the prompt, by default 'en'
         """
-        system_prompt = self.format_system_prompt(
-            contexts=contexts,
-            system_prefix=system_prefix,
-            n_contexts_to_use=n_contexts_to_use,
-            lang=lang,
-        )
+        system_prompt, messages = self.fit_chat_prompt(messages, contexts, system_prefix, n_contexts_to_use, lang)
 
         final_messages = [{'role': 'system', 'content': system_prompt}] + messages
 
@@ -0,0 +1,87 @@
+import hashlib
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Callable, List, Tuple
+
+from chat_rag.exceptions import PromptTooLongException
+
+
+class TokenCountCache:
+    """
+    LRU cache of the token counts of texts keyed by their content hash, so the knowledge base contexts and the
+    messages of a conversation are tokenized once instead of on every request.
+    """
+
+    def __init__(self, count_fn: Callable[[str], int], max_size: int = 10000):
+        """
+        Parameters
+        ----------
+        count_fn : Callable[[str], int]
+            Returns the number of tokens of a text.
+        max_size : int, optional
+            Maximum number of cached counts, by default 10000
+        """
+        self.count_fn = count_fn
+        self.max_size = max_size
+        self.counts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, text: str) -> int:
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        n_tokens = self.counts.get(key)
+        if n_tokens is not None:
+            self.counts.move_to_end(key)
+            self.hits += 1
+            return n_tokens
+
+        self.misses += 1
+        n_tokens = self.count_fn(text)
+        self.counts[key] = n_tokens
+        if len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+        return n_tokens
+
+
+def fit_counts(
+    fixed_tokens: int,
+    contexts_tokens: List[int],
+    messages_tokens: List[int],
+    max_tokens: int,
+) -> Tuple[int, int]:
+    """
+    Returns the largest number of contexts (the first ones) and messages (the last ones) whose tokens fit in max_tokens.
+    The contexts are dropped first down to one, then the oldest messages down to one, like the previous
+    iterative fitting, but with binary searches over the cumulative counts instead of re-tokenizing the prompt.
+
+    Parameters
+    ----------
+    fixed_tokens : int
+        Tokens of the parts of the prompt that are always kept (system prefix, tags).
+    contexts_tokens : List[int]
+        Tokens of every context, including its separator, in order of relevance.
+    messages_tokens : List[int]
+        Tokens of every message, including its tags, oldest first.
+    max_tokens : int
+        Token budget of the prompt.
+    """
+    contexts_cumsum = list(accumulate(contexts_tokens, initial=0))
+    # tokens of the last n messages
+    messages_cumsum = list(accumulate(reversed(messages_tokens), initial=0))
+    min_contexts = min(1, len(contexts_tokens))
+    min_messages = min(1, len(messages_tokens))
+
+    # all the messages with as many contexts as possible
+    budget = max_tokens - fixed_tokens - messages_cumsum[-1]
+    n_contexts = bisect_right(contexts_cumsum, budget) - 1
+    if n_contexts >= min_contexts:
+        return n_contexts, len(messages_tokens)
+
+    # the minimum contexts with as many recent messages as possible
+    budget = max_tokens - fixed_tokens - contexts_cumsum[min_contexts]
+    n_messages = bisect_right(messages_cumsum, budget) - 1
+    if n_messages >= min_messages:
+        return min_contexts, n_messages
+
+    raise PromptTooLongException()
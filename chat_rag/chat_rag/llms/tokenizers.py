@@ -0,0 +1,113 @@
+import os
+import threading
+from logging import getLogger
+from typing import Dict, Optional, Tuple
+
+logger = getLogger(__name__)
+
+# Characters per token assumed for the tokenizers of the remote providers. These are rules of thumb, not measurements:
+# about 4 for English text with the OpenAI tokenizers, less for the smaller vocabularies and for other languages.
+# They are on the low side so the counts overestimate, and the prompts keep a 10% margin on top.
+# Give a tokenizer_name or chars_per_token to the client for an exact or a calibrated count.
+PROVIDER_CHARS_PER_TOKEN = {
+    "openai": 3.5,
+    "together": 3.0,
+    "claude": 3.0,
+    "mistral": 3.0,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.0
+# Context length assumed for the models of the remote providers when the client is not given model_max_length,
+# the smallest one of their current chat models
+PROVIDER_MODEL_MAX_LENGTH = {
+    "openai": 16385,
+    "together": 8192,
+    "claude": 200000,
+    "mistral": 32000,
+}
+
+_lock = threading.Lock()
+_tokenizers: Dict[Tuple[str, bool], object] = {}
+_max_lengths: Dict[Tuple[str, bool], int] = {}
+
+
+def get_tokenizer(llm_name: str, trust_remote_code: bool = False):
+    """
+    Returns the HuggingFace tokenizer of a model, loaded on the first call and shared by every client of the process.
+    """
+    key = (llm_name, trust_remote_code)
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(key)
+            if tokenizer is None:
+                from transformers import AutoTokenizer
+
+                logger.info(f"Loading tokenizer of {llm_name}...")
+                tokenizer = AutoTokenizer.from_pretrained(
+                    llm_name, trust_remote_code=trust_remote_code, token=os.environ.get("HUGGINGFACE_KEY")
+                )
+                _tokenizers[key] = tokenizer
+    return tokenizer
+
+
+def get_model_max_length(llm_name: str, trust_remote_code: bool = False, tokenizer=None) -> int:
+    """
+    Returns the max length of a model from its config, or from its tokenizer if the config does not define it.
+    """
+    key = (llm_name, trust_remote_code)
+    max_length = _max_lengths.get(key)
+    if max_length is None:
+        from transformers import AutoConfig
+
+        config = AutoConfig.from_pretrained(
+            llm_name, trust_remote_code=trust_remote_code, token=os.environ.get("HUGGINGFACE_KEY")
+        )
+        max_length = getattr(config, "max_position_embeddings", None)
+        if max_length is None:
+            max_length = (tokenizer or get_tokenizer(llm_name, trust_remote_code)).model_max_length
+        _max_lengths[key] = max_length
+    return max_length
+
+
+class EstimatedTokenCounter:
+    """
+    Estimates the tokens of a text from its length, for the remote providers whose tokenizer is not available locally.
+    """
+
+    def __init__(self, chars_per_token: float = DEFAULT_CHARS_PER_TOKEN):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token) + 1
+
+
+class TokenizerTokenCounter:
+    """
+    Counts the tokens of a text with a HuggingFace tokenizer of the registry, loaded on the first count.
+    """
+
+    def __init__(self, tokenizer_name: str, trust_remote_code: bool = False):
+        self.tokenizer_name = tokenizer_name
+        self.trust_remote_code = trust_remote_code
+
+    def count(self, text: str) -> int:
+        return len(get_tokenizer(self.tokenizer_name, self.trust_remote_code).tokenize(text))
+
+
+def get_token_counter(provider: str, tokenizer_name: Optional[str] = None, chars_per_token: Optional[float] = None):
+    """
+    Returns the token counter of a remote provider: a local tokenizer if tokenizer_name is given,
+    otherwise an estimate calibrated for the provider, none of them needs network access to be built.
+
+    Parameters
+    ----------
+    provider : str
+        The LLM type of the client, one of PROVIDER_CHARS_PER_TOKEN.
+    tokenizer_name : str, optional
+        HuggingFace repo id of a tokenizer equivalent to the one of the provider.
+    chars_per_token : float, optional
+        Overrides the calibration of the provider.
+    """
+    if tokenizer_name is not None:
+        return TokenizerTokenCounter(tokenizer_name)
+    return EstimatedTokenCounter(chars_per_token or PROVIDER_CHARS_PER_TOKEN.get(provider, DEFAULT_CHARS_PER_TOKEN))
@@ -2,10 +2,10 @@ import json
 import os
 from typing import Dict, Iterable, List, AsyncIterable
 
-import aiohttp
 import requests
 from openai import OpenAI, AsyncOpenAI
 
+from chat_rag.http_pool import PooledSession
 from chat_rag.llms import RAGLLM
 from chat_rag.exceptions import ModelNotFoundException, RequestException, PromptTooLongException
 
@@ -171,7 +171,7 @@ class VLLMModel(RAGLLM):
         )
 
         messages = self._format_prompt_openai(
-            messages=messages[:n_messages_to_keep],  # keep only the last n_messages_to_keep
+            messages=messages[len(messages) - n_messages_to_keep:],  # keep only the last n_messages_to_keep
             contexts=contexts[:n_contexts],  # keep only the last n_contexts
             **prompt_structure_dict,
             lang=lang,
@@ -349,7 +349,7 @@ class VLLMModel(RAGLLM):
         )
 
         messages = self._format_prompt_openai(
-            messages=messages[:n_messages_to_keep],  # keep only the last n_messages_to_keep
+            messages=messages[len(messages) - n_messages_to_keep:],  # keep only the last n_messages_to_keep
             contexts=contexts[:n_contexts],  # keep only the last n_contexts
             **prompt_structure_dict,
             lang=lang,
@@ -452,9 +452,20 @@ class AsyncVLLMModel(RAGLLM):
 
         if use_openai_api:
             self.client = AsyncOpenAI(base_url=self.endpoint_url)  # for VLLM OpenAI compatible API
+        else:
+            self.http = PooledSession()  # keep-alive connections to the vLLM server shared by all the requests
         self.use_openai_api = use_openai_api
         print(f"Using vLLM OpenAI compatible API server: {self.use_openai_api}")
 
+    async def close(self):
+        """
+        Closes the open connections to the vLLM server.
+        """
+        if self.use_openai_api:
+            await self.client.close()
+        else:
+            await self.http.close()
+
     def _format_prompt_openai(
         self,
         messages: List[Dict[str, str]],
@@ -515,22 +526,21 @@ class AsyncVLLMModel(RAGLLM):
             "stream": False,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.endpoint_url, json=pload) as response:
-                if response.status != 200:
-                    logger.error(
-                        f"Error with the request to the vLLM server: {await response.text()}"
-                    )
-                    raise RequestException()
+        async with self.http.get().post(self.endpoint_url, json=pload) as response:
+            if response.status != 200:
+                logger.error(
+                    f"Error with the request to the vLLM server: {await response.text()}"
+                )
+                raise RequestException()
 
-                data = await response.json()
-                output = data["text"][0][len(prompt) :]
+            data = await response.json()
+            output = data["text"][0][len(prompt) :]
 
-                if not output:  # if there is an error vllm returns an empty string
-                    logger.error(f"Error with the request to the vLLM server.")
-                    raise RequestException()
+            if not output:  # if there is an error vllm returns an empty string
+                logger.error(f"Error with the request to the vLLM server.")
+                raise RequestException()
 
-                return output
+            return output
 
     async def _generate_openai(
         self,
@@ -549,7 +559,7 @@ class AsyncVLLMModel(RAGLLM):
         )
 
         messages = self._format_prompt_openai(
-            messages=messages[:n_messages_to_keep],
+            messages=messages[len(messages) - n_messages_to_keep:],  # keep only the last n_messages_to_keep
             contexts=contexts[:n_contexts],
             **prompt_structure_dict,
             lang=lang,
@@ -635,23 +645,22 @@ class AsyncVLLMModel(RAGLLM):
             "stream": True,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.endpoint_url, json=pload, stream=True) as response:
-                prev_output = pload["prompt"]
-                async for n_token, chunk in enumerate(response.content.iter_chunks()):
-                    if n_token == 1 and not output:  # if there is an error vllm returns an empty string as the second chunk (the first one is the prompt)
+        async with self.http.get().post(self.endpoint_url, json=pload, stream=True) as response:
+            prev_output = pload["prompt"]
+            async for n_token, chunk in enumerate(response.content.iter_chunks()):
+                if n_token == 1 and not output:  # if there is an error vllm returns an empty string as the second chunk (the first one is the prompt)
+                    raise RequestException()
+                if chunk:
+                    data = json.loads(chunk.decode("utf-8"))
+                    if 'detail' in data:
+                        logger.error(
+                            f"Error with the request to the vLLM server: {data['detail']}"
+                        )
                         raise RequestException()
-                    if chunk:
-                        data = json.loads(chunk.decode("utf-8"))
-                        if 'detail' in data:
-                            logger.error(
-                                f"Error with the request to the vLLM server: {data['detail']}"
-                            )
-                            raise RequestException()
-                        output = data["text"]
-                        output = output[0][len(prev_output) :]
-                        prev_output += output
-                        yield output
+                    output = data["text"]
+                    output = output[0][len(prev_output) :]
+                    prev_output += output
+                    yield output
 
     async def _stream_openai(
         self,
@@ -670,7 +679,7 @@ class AsyncVLLMModel(RAGLLM):
         )
 
         messages = self._format_prompt_openai(
-            messages=messages[:n_messages_to_keep],
+            messages=messages[len(messages) - n_messages_to_keep:],  # keep only the last n_messages_to_keep
             contexts=contexts[:n_contexts],
             **prompt_structure_dict,
             lang=lang,
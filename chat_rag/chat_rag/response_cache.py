@@ -0,0 +1,51 @@
+import json
+import hashlib
+from typing import Dict, List, Optional
+
+from chat_rag.versioned_cache import VersionedLRUCache
+
+
+class ResponseCache(VersionedLRUCache):
+    """
+    LRU cache with TTL of the generated responses, stored as the list of streamed chunks so they can be replayed.
+    Only deterministic generations (temperature 0) of generation configs with `cache_responses` enabled are cached.
+    The key covers everything the prompt is built from: the messages, the retrieved contents, the prompt config
+    and the generation config, and the cache is cleared when its version (the index version of the RAG config) changes.
+    """
+
+    name = "Response cache"
+
+    def __init__(self, max_size: int = 512, ttl_s: float = 24 * 3600):
+        """
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximum number of cached responses, by default 512
+        ttl_s : float, optional
+            Seconds a cached response is valid, by default 24 hours
+        """
+        super().__init__(max_size, ttl_s)
+
+    @staticmethod
+    def is_cacheable(generation_config_dict: dict) -> bool:
+        return bool(generation_config_dict.get("cache_responses")) and generation_config_dict.get("temperature") == 0
+
+    def make_key(
+        self,
+        messages: List[Dict[str, str]],
+        contents: List[str],
+        prompt_structure_dict: dict,
+        generation_config_dict: dict,
+    ) -> str:
+        payload = json.dumps(
+            [self.version, messages, contents, prompt_structure_dict, generation_config_dict],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        return self.lookup(key)
+
+    def put(self, key: str, chunks: List[str]):
+        self.store(key, chunks)
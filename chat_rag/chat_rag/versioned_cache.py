@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import Any, Dict, Hashable, Optional
+
+logger = getLogger(__name__)
+
+
+class VersionedLRUCache:
+    """
+    LRU cache with TTL that is cleared when its version (the index version of the RAG config) changes.
+    Base of the retrieval and response caches of the RAG deployments.
+    """
+
+    name = "Cache"
+
+    def __init__(self, max_size: int, ttl_s: float):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of entries, the least recently used ones are evicted.
+        ttl_s : float
+            Seconds an entry is valid.
+        """
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()  # key -> (expiration, value)
+        self.version = None
+        self.hits, self.misses, self.invalidations = 0, 0, 0
+
+    def set_version(self, version):
+        """
+        Clears the cache if the version changed.
+        """
+        if version != self.version:
+            if self.version is not None:
+                logger.info(f"{self.name} invalidated, version {self.version} -> {version}")
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def lookup(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the value of the key if it is cached and not expired, and marks it as the most recently used.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        return None
+
+    def live_items(self):
+        """
+        Yields the keys and values of the entries that are not expired.
+        """
+        now = time.monotonic()
+        for key, (expiration, value) in self.entries.items():
+            if expiration > now:
+                yield key, value
+
+    def store(self, key: Hashable, value: Any):
+        """
+        Caches the value of a key that missed and evicts the least recently used entries over max_size.
+        """
+        self.misses += 1
+        self.entries[key] = (time.monotonic() + self.ttl_s, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
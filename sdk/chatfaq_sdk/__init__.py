@@ -269,7 +269,7 @@ class ChatFAQSDK:
     async def error_callback(payload):
         logger.error(f"Error from ChatFAQ's back-end server: {payload}")
 
-    async def send_llm_request(self, rag_config_name, input_text, use_conversation_context, only_context, conversation_id, bot_channel_name, user_id=None):
+    async def send_llm_request(self, rag_config_name, input_text, use_conversation_context, only_context, conversation_id, bot_channel_name, user_id=None, streaming=True):
         logger.info(f"[LLM] Requesting LLM (model {rag_config_name})")
         self.llm_request_futures[
             bot_channel_name
@@ -284,6 +284,7 @@ class ChatFAQSDK:
                     "user_id": user_id,
                     "bot_channel_name": bot_channel_name,
                     "only_context": only_context,
+                    "streaming": streaming,
                 }
             )
         )
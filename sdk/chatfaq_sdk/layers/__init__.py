@@ -59,12 +59,13 @@ class LMGeneratedText(Layer):
     _type = "lm_generated_text"
     loaded_model = {}
 
-    def __init__(self, rag_config_name, input_text=None, use_conversation_context=True, only_context=False, *args, **kwargs):
+    def __init__(self, rag_config_name, input_text=None, use_conversation_context=True, only_context=False, streaming=True, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.input_text = input_text
         self.rag_config_name = rag_config_name
         self.use_conversation_context = use_conversation_context
         self.only_context = only_context
+        self.streaming = streaming
 
     async def build_payloads(self, ctx, data):
         """
@@ -89,7 +90,8 @@ class LMGeneratedText(Layer):
         logger.debug(f"Waiting for LLM...")
 
         await ctx.send_llm_request(
-            self.rag_config_name, self.input_text, self.use_conversation_context, self.only_context, data["conversation_id"], data["bot_channel_name"]
+            self.rag_config_name, self.input_text, self.use_conversation_context, self.only_context, data["conversation_id"], data["bot_channel_name"],
+            streaming=self.streaming,
         )
 
         logger.debug(f"...Receive LLM res")